@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+message_rate.py - small message rate between pairs of processes
+
+Even ranks stream windows of small non-blocking sends to the next odd rank,
+which receives them with a window of non-blocking receives and acknowledges
+every window. This is the same setup as the OSU multiple bandwidth / message
+rate test and mostly measures the per message overhead of the library
+(request objects, matching and thread handoffs) rather than the network.
+
+Usage: message_rate.py [iterations] [window] [message size]
+"""
+import sys, time
+
+from mpi import MPI
+
+def main(iterations, window, size):
+    mpi   = MPI()
+    world = mpi.MPI_COMM_WORLD
+    rank  = world.rank()
+    procs = world.size()
+
+    if procs % 2:
+        if rank == 0:
+            print "message_rate needs an even number of processes"
+        mpi.finalize()
+        return
+
+    data = "x" * size
+    peer = rank ^ 1
+    ACK_TAG = 2
+
+    for warmup in (True, False):
+        world.barrier()
+        t1 = time.time()
+
+        for _ in xrange(iterations):
+            if rank % 2 == 0:
+                world.waitall([ world.isend(data, peer) for _ in xrange(window) ])
+                world.recv(peer, ACK_TAG)
+            else:
+                world.waitall([ world.irecv(peer) for _ in xrange(window) ])
+                world.send(None, peer, ACK_TAG)
+
+        elapsed = time.time() - t1
+
+    # Messages per second over all the pairs
+    rate = world.allreduce(iterations * window / elapsed if rank % 2 == 0 else 0, sum)
+    if rank == 0:
+        print "%d pairs, window %d, %d byte messages: %.0f messages/s" % (procs/2, window, size, rate)
+
+    mpi.finalize()
+
+if __name__ == "__main__":
+    try:
+        iterations = int(sys.argv[1])
+    except:
+        iterations = 200
+
+    try:
+        window = int(sys.argv[2])
+    except:
+        window = 64
+
+    try:
+        size = int(sys.argv[3])
+    except:
+        size = 8
+
+    main(iterations, window, size)
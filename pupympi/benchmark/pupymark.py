@@ -32,7 +32,7 @@ from mpi import constants
 from mpi.exceptions import MPIException
 
 import comm_info as ci
-import single, collective, parallel, special, nonsynthetic
+import single, collective, parallel, special, nonsynthetic, striping
 
 
 help_message = '''
@@ -76,7 +76,7 @@ def testrunner(filtered_args,logdir,fixed_module = None, fixed_test = None, limi
     """
     starttime = time.time()
 
-    modules = [single, parallel, collective, special, nonsynthetic]
+    modules = [single, parallel, collective, special, nonsynthetic, striping]
     #DEBUG
     #modules = [special, nonsynthetic, single, parallel, collective]
     resultlist = {}
@@ -114,10 +114,10 @@ def solve(rank, world_size, local_state, offset, epsilon, update_frequency, useG
         # Get (red) borders
         red_recv_requests = []
         if rank != top:
-            upper_red_req = comm.irecv(upper,tag=RED_ROW_TAG)
+            upper_red_req = comm.irecv(upper,tag=RED_ROW_TAG,out=local_state[0])
             red_recv_requests.append(upper_red_req)
         if rank != bottom:
-            lower_red_req = comm.irecv(lower,tag=RED_ROW_TAG)
+            lower_red_req = comm.irecv(lower,tag=RED_ROW_TAG,out=local_state[height-1])
             red_recv_requests.append(lower_red_req)
             
         # wait for red requests to fininsh
@@ -128,10 +128,10 @@ def solve(rank, world_size, local_state, offset, epsilon, update_frequency, useG
         
         # Update local state with red values
         if rank != top:
-            local_state[0] = upper_red_req.wait()
+            upper_red_req.wait()
         # Send border down
         if rank != bottom:
-            local_state[height-1] = lower_red_req.wait()
+            lower_red_req.wait()
 
         
         ### Calculate black
@@ -153,10 +153,10 @@ def solve(rank, world_size, local_state, offset, epsilon, update_frequency, useG
         # Get (black) borders
         black_recv_requests = []
         if rank != top:
-            upper_black_req = comm.irecv(upper,tag=BLACK_ROW_TAG)
+            upper_black_req = comm.irecv(upper,tag=BLACK_ROW_TAG,out=local_state[0])
             black_recv_requests.append(upper_black_req)
         if rank != bottom:
-            lower_black_req = comm.irecv(lower,tag=BLACK_ROW_TAG)
+            lower_black_req = comm.irecv(lower,tag=BLACK_ROW_TAG,out=local_state[height-1])
             black_recv_requests.append(lower_black_req)
             
         # wait for black requests to fininsh
@@ -167,9 +167,9 @@ def solve(rank, world_size, local_state, offset, epsilon, update_frequency, useG
         
         # Update local state with black values
         if rank != top:
-            local_state[0] = upper_black_req.wait()
+            upper_black_req.wait()
         if rank != bottom:
-            local_state[height-1] = lower_black_req.wait()
+            lower_black_req.wait()
 
         # Check delta
         # NOTE: do we want to abs here?
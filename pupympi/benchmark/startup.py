@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+startup.py - job startup time for a growing number of local ranks
+
+Starts an empty job with 1, 2, 4, ... up to the given number of ranks
+through pympirun and reports the wall clock time until every rank is
+through MPI() (contact information exchanged and the network up) and until
+pympirun has exited. Each rank takes the time right after MPI() returns and
+the latest one is reported by rank 0, relative to the launch.
+
+Usage: startup.py [max ranks] [--launcher=path] [pympirun options]
+
+The launcher defaults to the pympirun next to the benchmark directory. Any
+other options are handed to it, eg. --startup-method=popen or
+--disable-full-network-startup.
+"""
+import sys, os, time, subprocess
+
+def child(launched):
+    from mpi import MPI
+
+    mpi = MPI()
+    ready = time.time() - launched
+
+    world = mpi.MPI_COMM_WORLD
+    ready = world.allreduce(ready, max)
+    if world.rank() == 0:
+        print "READY %f" % ready
+
+    mpi.finalize()
+
+def main(max_ranks, launcher, options):
+    print "%8s %13s %13s" % ("#ranks", "ready[sec]", "total[sec]")
+
+    ranks = 1
+    while ranks <= max_ranks:
+        launched = time.time()
+        arguments = [sys.executable, launcher] + options + ["-c", str(ranks), os.path.abspath(__file__), "--", "child", repr(launched)]
+        output = subprocess.Popen(arguments, stdout=subprocess.PIPE).communicate()[0]
+        total = time.time() - launched
+
+        ready = [ float(line.split()[1]) for line in output.splitlines() if line.startswith("READY") ]
+        if ready:
+            print "%8d %13.3f %13.3f" % (ranks, ready[0], total)
+        else:
+            print "%8d %13s %13.3f\t(startup failed)" % (ranks, "-", total)
+        sys.stdout.flush()
+
+        ranks *= 2
+
+if __name__ == "__main__":
+    if "child" in sys.argv:
+        child(float(sys.argv[sys.argv.index("child")+1]))
+        sys.exit(0)
+
+    max_ranks = 1024
+    launcher = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pympirun")
+    options = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--launcher="):
+            launcher = arg.split("=", 1)[1]
+        elif arg.isdigit():
+            max_ranks = int(arg)
+        else:
+            options.append(arg)
+
+    main(max_ranks, launcher, options)
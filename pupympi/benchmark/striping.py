@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+striping.py - bandwidth of large point to point messages striped over a
+varying number of connections (see STRIPE_CONNECTIONS in mpi.settings)
+
+Each test streams windows of non-blocking sends from one process to the
+other, which acknowledges every window, like the OSU bandwidth test. The
+tests only differ in the number of connections the payloads are split over,
+so the Mbytes/sec column shows how the bandwidth scales with it. Messages
+below STRIPE_THRESHOLD always use a single connection.
+"""
+
+import comm_info as ci
+
+meta_processes_required = 2
+meta_enlist_all = False
+
+meta_schedule = {
+    262144: 160,
+    524288: 80,
+    1048576: 40,
+    2097152: 20,
+    4194304: 20,
+    8388608: 10,
+}
+
+WINDOW = 8 # Sends in flight before waiting for the acknowledgement
+
+def bandwidth(size, max_iterations, connections):
+    def Bandwidth(s_tag, r_tag, source, dest, data, max_iterations):
+        for i in xrange(0, max_iterations, WINDOW):
+            window = min(WINDOW, max_iterations - i)
+            if ci.rank == ci.pair0:
+                ci.communicator.waitall([ ci.communicator.isend(data, dest, s_tag) for _ in xrange(window) ])
+                ci.communicator.recv(source, r_tag)
+            elif ci.rank == ci.pair1:
+                ci.communicator.waitall([ ci.communicator.irecv(source, r_tag) for _ in xrange(window) ])
+                ci.communicator.send(None, dest, s_tag)
+            else:
+                raise Exception("Broken state")
+    # end of test
+
+    ci.mpi.settings.STRIPE_CONNECTIONS = connections
+
+    (s_tag, r_tag) = ci.get_tags_single()
+    (source, dest) = ci.get_srcdest_paired() # source for purposes of recv, rank-relative
+    data = ci.data[0:size]
+    ci.synchronize_processes()
+
+    t1 = ci.clock_function()
+
+    # do magic
+    Bandwidth(s_tag, r_tag, source, dest, data, max_iterations)
+
+    t2 = ci.clock_function()
+    time = (t2 - t1)
+
+    ci.mpi.settings.STRIPE_CONNECTIONS = 1
+    return time
+
+def test_Stripes1(size, max_iterations):
+    return bandwidth(size, max_iterations, 1)
+
+def test_Stripes2(size, max_iterations):
+    return bandwidth(size, max_iterations, 2)
+
+def test_Stripes4(size, max_iterations):
+    return bandwidth(size, max_iterations, 4)
+
+def test_Stripes8(size, max_iterations):
+    return bandwidth(size, max_iterations, 8)
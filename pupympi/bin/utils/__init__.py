@@ -24,7 +24,7 @@ class SendSimpleCommand(threading.Thread):
         self.send_data = data
 
         for participant in hostinfo:
-            hostname, portno, rank, security_component, avail = participant
+            hostname, portno, _, rank, security_component, avail = participant
             if rank == self.rank:
                 self.hostname = hostname
                 self.portno = portno
@@ -89,10 +89,13 @@ def parse_extended_args(parser=None):
         all_procs = obj['procs']
         args = obj['args']
 
+        # Messages to and from the processes use their header layout
+        utils.set_header_version(obj.get('header_version', utils.HEADER_VERSION))
+
         return all_procs, args
 
     def get_ranks(ranks, hostinfo):
-        all_ranks = [h[2] for h in hostinfo]
+        all_ranks = [h[3] for h in hostinfo]
         final_ranks = None
         if ranks:
             ranks = ranks.split(",")
@@ -127,7 +127,7 @@ def main():
     senders = []
 
     for participant in hostinfo:
-        remote_host, remote_port, rank, security_component, avail = participant
+        remote_host, remote_port, _, rank, security_component, avail = participant
 
         succ = True
         if not bypass:
@@ -21,6 +21,8 @@ import sys
 import threading
 import time
 
+from collections import deque
+
 from threading import Thread
 
 from mpi.communicator import Communicator
@@ -32,6 +34,8 @@ from mpi import constants
 from mpi.network import utils as utils
 from mpi.syscommands import handle_system_commands, execute_system_commands
 from mpi.request import Request
+from mpi.matching import MessageMatcher
+from mpi.rendezvous import Rendezvous, LargeMessage
 from mpi.commons import pupyprof, yappi, numpy
 from optparse import OptionParser, OptionGroup
 
@@ -95,28 +99,22 @@ class MPI(Thread):
         # Event for handling thread packing.
         self.packing = threading.Event()
 
-        # Data structures for jobs.
-        # The locks are for guarding the data structures
-        # The events are for signalling change in data structures
-
-        # Pending requests are recieve requests where the data may or may not have arrived
-        self.pending_requests = []
-        self.pending_requests_lock = threading.Lock()
-        self.pending_requests_has_work = threading.Event()
-
-        # Raw data are messages that have arrived but not been unpickled yet
-        self.raw_data_queue = []
-        self.raw_data_lock = threading.Lock()
-        self.raw_data_has_work = threading.Event()
+        # Work for the MPI thread. The network threads and the user API add
+        # (kind, item) tuples to the queue and notify the condition. The MPI
+        # thread takes everything queued in one go, so a single wakeup drains
+        # whatever piled up while it was busy. The kinds are
+        #   "message"    - a user message from the network (see run)
+        #   "collective" - a collective request that has to be started
+        self.work_queue = deque()
+        self.work_condition = threading.Condition(threading.Lock())
 
-        # Recieved data are messages that have arrived and are unpickled
-        # (ie. ready for matching with a posted recv request)
-        #There are no events as this is handled through the "pending_request_" event.
-        self.received_data = []
-        self.received_data_lock = threading.Lock()
+        # Posted recieve requests waiting for data and unpickled messages
+        # waiting for a matching recieve. The matcher has its own lock and
+        # requests are matched as soon as either side shows up.
+        self.message_matcher = MessageMatcher()
 
-        # General event to wake up main mpi thread
-        self.has_work_event = threading.Event()
+        # Large messages waiting for the other side (see mpi.rendezvous)
+        self.rendezvous = Rendezvous(self)
 
         # Shutdown signals
         self.shutdown_event = threading.Event() # MPI finalize has been called, shutdown in progress
@@ -131,18 +129,13 @@ class MPI(Thread):
         self.pending_systems_commands = []
         self.pending_systems_commands_lock = threading.Lock()
 
-        # Unstarted collective requests.
-        self.unstarted_collective_requests = []
-        self.unstarted_collective_requests_lock = threading.Lock()
-        self.unstarted_collective_requests_has_work = threading.Event()
-
-        # When the collective requsts are started they are moved to this queue until
-        # they are finished.
-        self.pending_collective_requests = []
-
-        self.received_collective_data_lock = threading.Lock()
-        self.received_collective_data = []
-        self.pending_collective_requests_has_work = threading.Event()
+        # When the collective requsts are started they are moved here until
+        # they are finished. Collective messages that can not be delivered yet
+        # (the request is not started or did not accept them) wait in
+        # received_collective_data. Both are keyed by (comm_id, tag, sequence)
+        # and only touched by the MPI thread.
+        self.pending_collective_requests = {}
+        self.received_collective_data = {}
 
         # The settings module. This will be handle proper by the
         # function ``generate_settings``.
@@ -193,6 +186,7 @@ class MPI(Thread):
 
         # Parse and save settings.
         self.generate_settings(options.settings)
+        utils.set_header_version(self.settings.HEADER_VERSION)
 
         # Attributes for the security component.
         self.disable_utilities = options.disable_utilities
@@ -317,6 +311,8 @@ class MPI(Thread):
         parser.add_option('--process-io', dest='process_io')
         parser.add_option('--disable-full-network-startup', dest='disable_full_network_startup', action="store_true")
         parser.add_option('--disable-unixsockets', dest='unixsockets', default=True, action='store_false')
+        parser.add_option('--disable-shared-memory', dest='shared_memory', default=True, action='store_false')
+        parser.add_option('--inline-matching', dest='inline_matching', default=False, action='store_true')
         parser.add_option('--socket-pool-size', type='int', dest='socket_pool_size')
         parser.add_option('--socket-poll-method', dest='socket_poll_method', default=False)
         parser.add_option('--yappi', dest='yappi', action="store_true", default=False)
@@ -385,8 +381,15 @@ class MPI(Thread):
 
         # The MPI state contains a list of request objects. There can not be a
         # lock object, so only the request state if present now. We restore it
-        # with a helper function.
-        self.pending_requests = [ Request.from_state(state, self) for state in self.pending_requests ]
+        # with a helper function. The messages go back in first so the requests
+        # can match them.
+        for message in self.received_data:
+            self.deliver_message(message)
+        for state in self.pending_requests:
+            self.post_receive(Request.from_state(state, self))
+        for item in self.raw_data_queue:
+            self.add_work("message", item)
+        del self.received_data, self.pending_requests, self.raw_data_queue
 
         # Find a user supplied function (if any) and call it so the user script can restore any
         # unsafe objects if needed.
@@ -448,81 +451,174 @@ class MPI(Thread):
 
         self.resume_function = callback
 
-    def match_collective_pending(self):
+    def start_collective_request(self, request):
         """
-        Look through all the received collective data and see if they can be
-        matched with a pending collective request.
+        Start a collective request and hand it the messages that arrived for
+        it before it was started.
         """
+        request.start()
+
+        key = (request.communicator.id, request.tag, request.sequence)
+        self.pending_collective_requests[key] = request
+        self.match_collective_pending(key)
 
-        prune = False
-        with self.received_collective_data_lock:
-            unmatched_data_list = [] # save the unmatched for later
-            for item in self.received_collective_data:
-                (rank, msg_type, tag, ack, comm_id, coll_class_id, raw_data) = item
+    def deliver_collective_message(self, item):
+        """
+        Route a received collective message to the request it belongs to, or
+        keep it until the request is started.
+        """
+        (rank, msg_type, tag, ack, comm_id, (coll_class_id, sequence), raw_data) = item
+
+        key = (comm_id, tag, sequence)
+        self.received_collective_data.setdefault(key, []).append(item)
+        if key in self.pending_collective_requests:
+            self.match_collective_pending(key)
+
+    def match_collective_pending(self, key):
+        """
+        Offer the waiting messages for a (comm_id, tag, sequence) key to its
+        request. A request can turn down a message it will take once it has
+        seen others, so the messages are offered again for as long as any of
+        them is accepted.
+        """
+        request = self.pending_collective_requests[key]
+        items = self.received_collective_data.get(key, [])
+
+        matched = True
+        while matched and items:
+            matched = False
+            for item in list(items):
+                (rank, msg_type, tag, ack, comm_id, (coll_class_id, sequence), raw_data) = item
                 match = False
-                for request in self.pending_collective_requests:
-                    if request.communicator.id == comm_id and request.tag == tag:
-                        if request._coll_class_id == coll_class_id:
-                            match = request.accept_msg(rank, raw_data, msg_type)
-                        else:
-                            if not request.is_dirty():
-                                cls = request.communicator.collective_controller.class_ids[coll_class_id]
-                                request.overtake(cls)
-                                match = request.accept_msg(rank, raw_data, msg_type)
-
-                        if match:
-                            request.mark_dirty() # from now on the request cannot change algo
-                            # is the request all done?
-                            if request.test():
-                                prune = True
-                            break
-                if not match:
-                    unmatched_data_list.append( item )
-
-            self.received_collective_data = unmatched_data_list
-
-        if prune:
-            # We remove all the requests marked as completed.
-            self.pending_collective_requests = [r for r in self.pending_collective_requests if not r.test()]
-
-    def match_pending(self, request):
-        """
-        Tries to match a pending request with something in the received data.
-
-        If the received data is found we remove it from the list.
-
-        The request is updated with the data if found and this
-        status update returned from the function so it is possible
-        to remove the item from the list.
-        """
-        match = False
-        with self.received_data_lock:
-            #Logger().debug("-- Match pending has lock! received_data:%s" % self.received_data)
-            for element in self.received_data:
-                (sender, tag, acknowledge, communicator_id, message) = element
-                
-                # For a message to match
-                # 1) it must be within the same communicator
-                # 2) participant must match or any rank have been specified
-                # 3) tag must match OR if any-tag has been specified the message should just be any user tag (ie. non-negative)
-                if request.communicator.id == communicator_id \
-                and request.participant in (sender, constants.MPI_SOURCE_ANY) \
-                and ( (request.tag == tag) or (request.tag == constants.MPI_TAG_ANY and tag > 0) ):
-                    # Incoming synchronized communication requires acknowledgement
-                    if acknowledge:
-                        Logger().debug("SSEND RECEIVED request: %s" % request)
-                        # Generate an acknowledge message as an isend
-                        # NOTE: Consider using an empty message string, to save (a little) resources
-                        self.communicators[communicator_id]._isend( "ACKNOWLEDGEMENT", sender, constants.TAG_ACK)
-                    
-                    matched_element = element
-                    match = True
-                    request.update(status="ready", data=message)
-                    break # We can only find matching data for one request and we have
-            
-            if match:
-                self.received_data.remove(matched_element)
-        return match
+                if request._coll_class_id == coll_class_id:
+                    match = request.accept_msg(rank, raw_data, msg_type)
+                else:
+                    if not request.is_dirty():
+                        cls = request.communicator.collective_controller.class_ids[coll_class_id]
+                        request.overtake(cls)
+                        match = request.accept_msg(rank, raw_data, msg_type)
+
+                if match:
+                    request.mark_dirty() # from now on the request cannot change algo
+                    items.remove(item)
+                    matched = True
+
+        if not items:
+            self.received_collective_data.pop(key, None)
+
+        # The request is forgotten as soon as it is completed
+        if request.test():
+            del self.pending_collective_requests[key]
+
+    def add_work(self, kind, item):
+        """
+        Queue an item for the MPI thread and wake it up. See the
+        initialization of work_queue for the kinds of work.
+        """
+        with self.work_condition:
+            self.work_queue.append( (kind, item) )
+            self.work_condition.notify()
+
+    def wake_up(self):
+        """
+        Let the MPI thread through its loop even if there is no work, so it
+        notices that shutdown_event is set.
+        """
+        with self.work_condition:
+            self.work_condition.notify()
+
+    def post_receive(self, request):
+        """
+        Match a recieve request with a message that already arrived or leave
+        it for the next matching message to complete.
+        """
+        message = self.message_matcher.post(request)
+        if message:
+            self._consumed(message)
+            self._complete_receive(request, message)
+
+    def take_message(self, comm_id, source, tag, block=False):
+        """
+        Take a message out of matching for a matched probe, see
+        MessageMatcher.take.
+        """
+        message = self.message_matcher.take(comm_id, source, tag, block)
+        if message:
+            self._consumed(message)
+        return message
+
+    def deliver_message(self, message):
+        """
+        Hand a message to the posted recieve it matches or keep it until one
+        is posted. The message is a tuple of
+        (sender, tag, acknowledge, comm_id, msg_type, data) where data is
+        still serialized unless msg_type is None.
+
+        Called by the MPI thread, by the user thread for messages to self and
+        by the network thread receiving the message with inline matching.
+        """
+        request = self.message_matcher.deliver(message)
+        if request:
+            self._consumed(message)
+            self._complete_receive(request, message)
+
+    def _consumed(self, message):
+        """
+        Give the sender credit back for a message that was matched.
+        """
+        (sender, tag, acknowledge, communicator_id, msg_type, data) = message
+
+        # Messages to self are not flow controlled
+        if msg_type is None:
+            return
+
+        if isinstance(data, LargeMessage):
+            size = data.announcement_size
+        else:
+            size = len(data)
+
+        global_rank = self.communicators[communicator_id].comm_group.members[sender]['global_rank']
+        self.network.flow_control.consumed(global_rank, size)
+
+    def get_metrics(self):
+        """
+        Counters for the point to point traffic of this process:
+
+        * unexpected_messages: received messages waiting for a matching receive
+        * unexpected_messages_peak: the most there have been at one time
+        * stalled_messages: messages waiting for the receiver to give credit
+        * stalled_total: messages that had to wait for credit in all
+        * stall_time: seconds spent waiting for credit by all those messages
+        * startup_bootstrap_time: seconds spent getting the contact information of the other processes
+        * startup_connect_time: seconds spent connecting to the other processes in the full network startup
+        * startup_handshake_time: seconds spent greeting them afterwards
+        * startup_prewarm_time: seconds spent in prewarming connections
+        * connections_closed: connections closed with the drain handshake, eg. when the socket pool evicted them
+        """
+        metrics = self.network.flow_control.get_metrics()
+        metrics["unexpected_messages"] = self.message_matcher.unexpected_count
+        metrics["unexpected_messages_peak"] = self.message_matcher.unexpected_peak
+        for phase in ("bootstrap", "connect", "handshake", "prewarm"):
+            metrics["startup_%s_time" % phase] = self.network.startup_timings.get(phase, 0.0)
+        metrics["connections_closed"] = self.network.disconnect.closed
+        return metrics
+
+    def _complete_receive(self, request, message):
+        (sender, tag, acknowledge, communicator_id, msg_type, data) = message
+
+        # Incoming synchronized communication requires acknowledgement
+        if acknowledge:
+            Logger().debug("SSEND RECEIVED request: %s" % request)
+            # Generate an acknowledge message as an isend
+            # NOTE: Consider using an empty message string, to save (a little) resources
+            self.communicators[communicator_id]._isend( "ACKNOWLEDGEMENT", sender, constants.TAG_ACK)
+
+        # The payload of a large message is only sent when asked for
+        if isinstance(data, LargeMessage):
+            self.rendezvous.accept(request, message)
+            return
+
+        request.update(constants.REQUEST_READY, data=data, msg_type=msg_type)
 
     def run(self):
 
@@ -530,66 +626,34 @@ class MPI(Thread):
             yappi.start(builtins=True)
 
         while not self.shutdown_event.is_set():
-            # NOTE: If someone sets this event between the wait and the clear that
-            # signal will be missed, but that is just fine since we are about to
-            # check the queues anyway
-            self.has_work_event.wait()
-            self.has_work_event.clear()
-            
-            # Unpickle raw data (received messages) and put them in received queue
-            if self.raw_data_has_work.is_set():
-                self.raw_data_has_work.clear() # rather have an empty queue than hold the lock too long
-                with self.raw_data_lock:
-                    for element in self.raw_data_queue:
-                        (rank, msg_type, tag, ack, comm_id, coll_class_id, raw_data) = element
-
-                        if tag in constants.COLLECTIVE_TAGS:
-                            # Messages that are part of a collective request, are handled
-                            # on a seperate queue and matched and deserialized later
-                            with self.received_collective_data_lock:
-                                self.received_collective_data.append(element)
-                                self.pending_collective_requests_has_work.set()
-
-                        else:
-                            data = utils.deserialize_message(raw_data, msg_type)
-                            with self.received_data_lock:
-                                self.received_data.append( (rank, tag, ack, comm_id, data) )
-                                self.pending_requests_has_work.set()
-                    self.raw_data_queue = []
-
-            # Collective requests
-            if self.unstarted_collective_requests_has_work.is_set():
-                self.unstarted_collective_requests_has_work.clear() # rather have an empty queue than hold the lock too long
-                with self.unstarted_collective_requests_lock:
-                    for coll_req in self.unstarted_collective_requests:
-                        coll_req.start()
-
-                    self.pending_collective_requests.extend(self.unstarted_collective_requests)
-                    
-                    self.unstarted_collective_requests = []
-                self.pending_collective_requests_has_work.set()
-
-            if self.pending_collective_requests_has_work.is_set():
-                #Logger().debug("Trying to match collective pending")
-                self.match_collective_pending()
-                # If the list is empty we matched them all so clear the signal
-                if not self.pending_collective_requests:
-                    self.pending_collective_requests_has_work.clear()
-
-            # Pending requests are receive requests they may have a matching recv posted (actual message recieved)
-            if self.pending_requests_has_work.is_set():
-                self.pending_requests_has_work.clear() # rather have an empty queue than hold the lock too long
-                with self.pending_requests_lock:
-                    removal = [] # Remember succesfully matched requests so we can remove them
-                    for request in self.pending_requests:
-                        if self.match_pending(request):
-                            # The matcher function does the actual request update
-                            # and will remove matched data from received_data queue
-                            # we only need to update our own queue
-                            removal.append(request)
-
-                    for request in removal:
-                        self.pending_requests.remove(request)
+            # Swap out the whole queue so the lock is only held for as long
+            # as it takes to see if there is anything to do
+            with self.work_condition:
+                while not self.work_queue and not self.shutdown_event.is_set():
+                    self.work_condition.wait()
+                work = self.work_queue
+                self.work_queue = deque()
+
+            for (kind, item) in work:
+                if kind == "message":
+                    (rank, msg_type, tag, ack, comm_id, coll_header, raw_data) = item
+
+                    if coll_header[0] in constants.RENDEZVOUS_STEPS:
+                        # Steps of the protocol for large messages
+                        self.rendezvous.handle(item)
+
+                    elif tag in constants.COLLECTIVE_TAGS:
+                        # Messages that are part of a collective request are routed
+                        # to their request which deserializes them
+                        self.deliver_collective_message(item)
+
+                    else:
+                        # The payload is left serialized until a receive
+                        # matches it, see Request.wait
+                        self.deliver_message( (rank, tag, ack, comm_id, msg_type, raw_data) )
+
+                elif kind == "collective":
+                    self.start_collective_request(item)
 
         # Start built-in profiling facility
         if self._profiler_enabled:
@@ -627,9 +691,9 @@ class MPI(Thread):
         return {
             # TRW
             #'unstarted_requests' : [r.get_state() for r in self.unstarted_requests],
-            'pending_requests' : [r.get_state() for r in self.pending_requests],
-            'raw_data_queue' : self.raw_data_queue,
-            'received_data' : self.received_data,
+            'pending_requests' : [r.get_state() for r in self.message_matcher.get_pending_requests()],
+            'raw_data_queue' : [ item for (kind, item) in self.work_queue if kind == "message" ],
+            'received_data' : self.message_matcher.get_received_data(),
             'current_request_id' : self.current_request_id,
             'pending_systems_commands' : self.pending_systems_commands,
             'migrate_onpack' : getattr(self, "migrate_onpack", None),
@@ -769,8 +833,11 @@ class MPI(Thread):
             finalize.
         """
         #Logger().debug("--- Finalize has been called ---")
+        # Large messages only leave once their receivers ask for them
+        self.rendezvous.flush()
+
         self.shutdown_event.set() # signal shutdown to mpi thread
-        self.has_work_event.set() # let mpi thread once through the run loop in case it is stalled waiting for work
+        self.wake_up() # let mpi thread once through the run loop in case it is stalled waiting for work
 
         # We have now flushed all messages to the network layer. So we signal that it's time
         # to close
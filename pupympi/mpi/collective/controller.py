@@ -38,6 +38,12 @@ class Controller(object):
         }
         
         self.generate_class_ids()
+
+        # Every process starts the collective operations on a communicator in
+        # the same order, so numbering them gives each operation an id that
+        # is the same everywhere. It is sent along with the messages so they
+        # can be routed straight to their request.
+        self.sequence = 0
         
     def generate_class_ids(self):
         """
@@ -73,16 +79,13 @@ class Controller(object):
         for req_class in req_class_list:
             obj = req_class.accept(self.communicator, self.communicator.mpi.settings, self.cache, *args, **kwargs)
             if obj:
-                # Set the tag on the object.
+                # Set the tag and sequence number on the object.
                 obj.tag = tag
+                obj.sequence = self.sequence
+                self.sequence += 1
 
-                # Add the object to the MPI environment and send the start signal.
-                with self.mpi.unstarted_collective_requests_lock:
-                    self.mpi.unstarted_collective_requests.append(obj)
-
-                    # Signal
-                    self.mpi.unstarted_collective_requests_has_work.set()
-                    self.mpi.has_work_event.set()
+                # Hand the object to the MPI thread which starts it
+                self.mpi.add_work("collective", obj)
 
                 return obj
 
@@ -1,16 +1,22 @@
 import threading, sys
 from mpi import constants
 from mpi.logger import Logger
+from mpi.request import completion
 from mpi.topology import tree
 
 class BaseCollectiveRequest(object):
     def __init__(self, *args, **kwargs):
         self.tag = None
+        self.sequence = None # Position among the collective requests on the communicator, set by the controller
 
         # This object (with the acquire() and release() methods) defined below
         # opens for the pythonic way to lock an object (with-keyword)
         self._lock = threading.Lock()
-        self._finished = threading.Event()
+
+        # Set by done(). Waiting is done on the completion condition shared
+        # with the point to point requests.
+        self._finished = False
+        self.waiter = None # (Waiter, handle) of a wait_for_some call waiting on this request
         self._dirty = False
         self._overtaken_request = None
         self._parent_request = None
@@ -38,20 +44,33 @@ class BaseCollectiveRequest(object):
         Test if the collective operation is finished. That is if the :func:`wait`
         function will return right away.
         """
-        return self._finished.is_set()
+        return self._finished
     
     def done(self):
         "Each algorithm must call this method when the internal flow is done."
-        if self._parent_request:
-            self._parent_request._finished.set()
-            
-        self._finished.set()
+        with completion:
+            if self._parent_request:
+                self._parent_request._finished = True
+                self._parent_request._signal()
+
+            self._finished = True
+            self._signal()
+            completion.notifyAll()
+
+    def _signal(self):
+        # Called with the completion lock held
+        if self.waiter is not None:
+            (waiter, handle) = self.waiter
+            waiter.signal(handle)
 
     def wait(self):
         """
         Wait until the collective operation has finished and then return the data.
         """
-        self._finished.wait()
+        if not self._finished:
+            with completion:
+                while not self._finished:
+                    completion.wait()
 
         if self._overtaken_request:
             return self._overtaken_request._get_data()
@@ -91,6 +110,7 @@ class BaseCollectiveRequest(object):
         self._overtaken_request = request
         request._parent_request = self
         request._dirty = True
+        request.sequence = self.sequence
         
         for method_name in ("acquire", "release", "test", "wait", "accept_msg", "is_dirty", "mark_dirty"):
             setattr(self, method_name, getattr(request, method_name))
@@ -111,9 +131,10 @@ class BaseCollectiveRequest(object):
         # Mark the request as dirty
         self.mark_dirty()
         
-        # Find the extra header information useful for changing request classes on the fly.
+        # Find the extra header information useful for changing request classes on the fly
+        # and for routing the message to the matching request on the other side.
         coll_class_id = self.__class__._coll_class_id
-        kwargs["collective_header_information"] = (coll_class_id, )
+        kwargs["collective_header_information"] = (coll_class_id, self.sequence)
         
         self.communicator._multisend(*args, **kwargs)
     
@@ -126,7 +147,7 @@ class BaseCollectiveRequest(object):
         # Find the extra header information useful for changing request classes on the fly.
         coll_class_id = self.__class__._coll_class_id
 
-        kwargs["collective_header_information"] = (coll_class_id, )
+        kwargs["collective_header_information"] = (coll_class_id, self.sequence)
         return self.communicator._isend(*args, **kwargs)
     
     def direct_send(self, *args, **kwargs):
@@ -135,7 +156,7 @@ class BaseCollectiveRequest(object):
         # Find the extra header information useful for changing request classes on the fly.
         coll_class_id = self.__class__._coll_class_id
 
-        kwargs["collective_header_information"] = (coll_class_id, )
+        kwargs["collective_header_information"] = (coll_class_id, self.sequence)
         return self.communicator._direct_send(*args, **kwargs)
         
     
@@ -59,7 +59,7 @@ class NaiveAllToAll(BaseCollectiveRequest):
     def accept_msg(self, rank, raw_data, msg_type):
 
         # A finished request does not accept messages.
-        if self._finished.is_set():            
+        if self._finished:            
             return False
 
         # And we only accept messages from the ones we havn't hear from
@@ -158,7 +158,7 @@ class NaiveAllToAllPickless(BaseCollectiveRequest):
     def accept_msg(self, rank, raw_data, msg_type):
 
         # A finished request does not accept messages.
-        if self._finished.is_set():            
+        if self._finished:            
             return False
 
         # And we only accept messages from the ones we havn't hear from
@@ -187,7 +187,7 @@ class NaiveAllToAllPickless(BaseCollectiveRequest):
             if i == self.rank:
                 self.data[-1][i*chunk_size:(i+1)*chunk_size] = data
             else:
-                self.data[-1][i*chunk_size:(i+1)*chunk_size] = numpy.fromstring(data,numpy.uint8)
+                self.data[-1][i*chunk_size:(i+1)*chunk_size] = numpy.frombuffer(data,numpy.uint8)
                 
 
     def _get_data(self):
@@ -200,7 +200,7 @@ class NaiveAllToAllPickless(BaseCollectiveRequest):
             if i == self.rank:
                 tempdata[-1][i*chunk_size:(i+1)*chunk_size] = data
             else:
-                tempdata[-1][i*chunk_size:(i+1)*chunk_size] = numpy.fromstring(data,numpy.uint8)
+                tempdata[-1][i*chunk_size:(i+1)*chunk_size] = numpy.frombuffer(data,numpy.uint8)
 
         #Logger().debug("AFTER tempdata:%s self.received:%s" % (tempdata, self.received_data) )
         data = utils.deserialize_message(tempdata, self.msg_type)
@@ -56,7 +56,7 @@ class TreeBarrier(BaseCollectiveRequest):
         # any data.
 
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if self.wait_parent:
@@ -138,7 +138,7 @@ class RingBarrier(BaseCollectiveRequest):
 
     def accept_msg(self, rank, data, msg_type=None):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if rank != self.previous:
@@ -47,7 +47,7 @@ class TreeBCast(BaseCollectiveRequest):
 
     def accept_msg(self, rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if rank == self.parent:
@@ -79,7 +79,12 @@ class TreeBCast(BaseCollectiveRequest):
         if self.parent is None:
             return self.data
         else:
-            return utils.deserialize_message(self.data, self.msg_type)
+            raw_data = self.data
+            if self.children and isinstance(raw_data, bytearray):
+                # The received buffer may still be queued for forwarding to
+                # our children, so the user gets a private copy of it
+                raw_data = bytearray(raw_data)
+            return utils.deserialize_message(raw_data, self.msg_type)
 
 class FlatTreeBCast(FlatTreeAccepter, TreeBCast):
     pass
@@ -116,7 +121,7 @@ class RingBCast(BaseCollectiveRequest):
 
     def accept_msg(self, rank, data):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if rank != self.previous:
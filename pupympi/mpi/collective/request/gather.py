@@ -74,7 +74,7 @@ class DisseminationAllGather(BaseCollectiveRequest):
         """
         Check that the message is expected and send off messages as appropriate
         """
-        if self._finished.is_set() or rank not in self.recv_from:
+        if self._finished or rank not in self.recv_from:
             return False
 
         # Put valid data in proper place
@@ -211,7 +211,7 @@ class DisseminationAllGatherPickless(BaseCollectiveRequest):
         """
         Check that the message is expected and send off messages as appropriate
         """
-        if self._finished.is_set() or rank not in self.recv_from:
+        if self._finished or rank not in self.recv_from:
             return False
 
         # Check if the accept puts the algorithm into next iteration
@@ -318,12 +318,12 @@ class TreeGather(BaseCollectiveRequest):
 
     def send_parent(self):
         # Send data to the parent (if any)
-        if (not self._finished.is_set()) and self.parent is not None:
+        if (not self._finished) and self.parent is not None:
             self.isend(self.data, self.parent, tag=constants.TAG_GATHER)
         self.done()
 
     def accept_msg(self, rank, raw_data, msg_type=None):
-        if self._finished.is_set() or rank not in self.missing_children:
+        if self._finished or rank not in self.missing_children:
             return False
 
         self.missing_children.remove(rank)
@@ -391,7 +391,7 @@ class TreeGatherPickless(BaseCollectiveRequest):
 
     def send_parent(self):
         # Send data to the parent (if any)
-        if (not self._finished.is_set()) and self.parent is not None:
+        if (not self._finished) and self.parent is not None:
             payloads =  []
             for d in self.data:
                 if d is None:
@@ -410,7 +410,7 @@ class TreeGatherPickless(BaseCollectiveRequest):
         self.done()
 
     def accept_msg(self, child_rank, raw_data, msg_type):
-        if self._finished.is_set() or child_rank not in self.missing_children:
+        if self._finished or child_rank not in self.missing_children:
             return False
 
         self.missing_children.remove(child_rank)
@@ -92,7 +92,7 @@ class TreeAllReduce(BaseCollectiveRequest):
 
     def accept_msg(self, rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         # Deserialize data
@@ -227,7 +227,7 @@ class TreeAllReducePickless(BaseCollectiveRequest):
 
     def accept_msg(self, rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if self.phase == "up":
@@ -278,7 +278,12 @@ class TreeAllReducePickless(BaseCollectiveRequest):
             # Root has the data in another form
             return utils.deserialize_message(self.data_list, self.msg_type)
         else:
-            return utils.deserialize_message(self.data_list[0], self.msg_type)
+            raw_data = self.data_list[0]
+            if self.children and isinstance(raw_data, bytearray):
+                # The received buffer may still be queued for forwarding to
+                # our children, so the user gets a private copy of it
+                raw_data = bytearray(raw_data)
+            return utils.deserialize_message(raw_data, self.msg_type)
 
     def to_children(self):
         # since data_list is a singleton list on the way down, we can just give it directly to direct_send
@@ -394,7 +399,7 @@ class TreeReduce(BaseCollectiveRequest):
     def accept_msg(self, rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
 
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if rank not in self.missing_children:
@@ -522,7 +527,7 @@ class TreeReducePickless(BaseCollectiveRequest):
 
     def accept_msg(self, child_rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if child_rank not in self.missing_children:
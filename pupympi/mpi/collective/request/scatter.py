@@ -38,7 +38,7 @@ class TreeScatter(BaseCollectiveRequest):
 
     def accept_msg(self, rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
 
         if rank == self.parent:
@@ -114,7 +114,7 @@ class TreeScatterPickless(BaseCollectiveRequest):
 
     def accept_msg(self, rank, raw_data, msg_type):
         # Do not do anything if the request is completed.
-        if self._finished.is_set():
+        if self._finished:
             return False
         
         if rank == self.parent:
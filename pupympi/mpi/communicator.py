@@ -19,9 +19,11 @@
 from mpi import constants
 from mpi.exceptions import MPINoSuchRankException, MPIInvalidTagException, MPICommunicatorGroupNotSubsetOf, MPICommunicatorNoNewIdAvailable, MPIException, NotImplementedException, MPIInvalidRankException
 from mpi.logger import Logger
-from mpi.request import Request
+from mpi.request import Request, PersistentRequest, wait_for_some
+from mpi.matching import Message
 from mpi.syscommands import handle_system_commands, execute_system_commands
 import mpi.network.utils as utils
+from mpi.network import compression
 
 import sys, time
 import numpy
@@ -37,6 +39,9 @@ class Communicator:
         self.MPI_COMM_WORLD = comm_root or self
         self.cmd = constants.CMD_USER
 
+        # Compression of the point to point messages sent on this communicator
+        self.compressor = compression.Compressor.from_settings(mpi.settings)
+
         self.mpi.communicators[self.id] = self
 
         self.attr = {}
@@ -86,6 +91,75 @@ class Communicator:
         execute_system_commands(self.mpi)
         self.name = name
 
+    def set_compression(self, codec="zlib", min_size=None, max_ratio=None):
+        """
+        Turn compression of the point to point messages sent on this
+        communicator on or off. Communicators start out as the COMPRESSION
+        setting says. Collective operations are never compressed.
+
+        Messages smaller than min_size bytes are sent as they are, and so are
+        messages that do not shrink to max_ratio of their size. The
+        COMPRESSION_MIN_SIZE and COMPRESSION_MAX_RATIO settings are used if
+        they are not given. Pass None as codec to turn compression off.
+
+        Only the sending side decides, receivers decompress whatever they get.
+
+        **Example**
+        Compress the pickled dictionaries sent over a slow link::
+
+            from mpi import MPI
+
+            mpi = MPI()
+            world = mpi.MPI_COMM_WORLD
+            world.set_compression("zlib", min_size=1024)
+
+            if world.rank() == 0:
+                world.send(dict((str(i), "value") for i in range(10000)), 1)
+            elif world.rank() == 1:
+                table = world.recv(0)
+
+            mpi.finalize()
+        """
+        if codec is None:
+            self.compressor = None
+            return
+
+        settings = self.mpi.settings
+        if min_size is None:
+            min_size = settings.COMPRESSION_MIN_SIZE
+        if max_ratio is None:
+            max_ratio = settings.COMPRESSION_MAX_RATIO
+        self.compressor = compression.Compressor(codec, min_size, max_ratio)
+
+    def prewarm(self, ranks):
+        """
+        Connect to the given ranks of this communicator right away rather
+        than on the first message to each of them. Only of use when the job
+        is started with --disable-full-network-startup, where connections
+        are otherwise made on demand. Ranks already connected to are
+        skipped. Returns the ranks new connections were made to.
+
+        **Example**
+        Connect to the neighbours in a ring before the first round::
+
+            from mpi import MPI
+
+            mpi = MPI()
+            world = mpi.MPI_COMM_WORLD
+            rank, size = world.rank(), world.size()
+            world.prewarm([(rank-1) % size, (rank+1) % size])
+
+            mpi.finalize()
+        """
+        execute_system_commands(self.mpi)
+
+        global_ranks = {}
+        for rank in ranks:
+            global_ranks[self.get_network_details(rank)['global_rank']] = rank
+
+        connected = self.network.prewarm(global_ranks.keys())
+        return sorted(global_ranks[global_rank] for global_rank in connected)
+
     ################################################################################################################
     #### Communicator creation, deletion
     ################################################################################################################
@@ -345,7 +419,7 @@ class Communicator:
 
         return rl
 
-    def irecv(self, sender=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY):
+    def irecv(self, sender=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY, out=None):
         #Logger().debug(" -- irecv called -- sender:%s" % (sender) )
         """
         Starts a non-blocking receive, returning a handle like :func:`isend`. The
@@ -369,13 +443,24 @@ class Communicator:
 
             mpi.finalize()
 
+        A preallocated numpy array or bytearray can be given as ``out``. The
+        message is then written into it and the same object is returned from
+        wait(). The message must have the exact dtype and shape (or length)
+        of the buffer, otherwise wait() raises an MPIException. This saves
+        an allocation per message when the same sized data is received over
+        and over, like halo rows in a stencil computation::
+
+            row = numpy.zeros(512)
+            for i in range(iterations):
+                world.irecv(upper, out=row).wait()
+
         .. note::
             It's possible for rank N to receive data from N.
         """
         execute_system_commands(self.mpi)
-        return self._irecv(sender, tag)
+        return self._irecv(sender, tag, out)
 
-    def _irecv(self, sender=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY):
+    def _irecv(self, sender=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY, out=None):
 
         # Check that destination exists
         if not sender is constants.MPI_SOURCE_ANY and not self.have_rank(sender):
@@ -385,16 +470,15 @@ class Communicator:
         if not isinstance(tag, int):
             raise MPIInvalidTagException("All tags should be integers")
 
+        if out is not None:
+            utils.check_receive_buffer(out)
+
         # Create a receive request object
-        handle = Request("recv", self, sender, tag)
+        handle = Request("recv", self, sender, tag, out=out)
 
-        # Add the request to the MPI layer unstarted requests queue. We
-        # signal the condition variable to wake the MPI thread and have
-        # it handle the request start.
-        with self.mpi.pending_requests_lock:
-            self.mpi.pending_requests.append(handle)
-            self.mpi.pending_requests_has_work.set()
-            self.mpi.has_work_event.set()
+        # Match it against the messages already received or leave it for
+        # the MPI thread to complete when the message arrives
+        self.mpi.post_receive(handle)
 
         return handle
 
@@ -405,19 +489,24 @@ class Communicator:
         # Create the proper data structure and pickle the data
         request.prepare_send()
 
-        self.network.t_out.add_out_request(request)
+        if request.collective_header_information:
+            # Collective messages and protocol replies are not matched by
+            # the receiver, so they are not subject to flow control
+            self.network.t_out.add_out_request(request)
+        elif self.mpi.rendezvous.is_large(request):
+            # The payload follows when the receiver asks for it
+            self.mpi.rendezvous.start_send(request)
+        else:
+            self.network.flow_control.submit(request)
 
     # Add a request for communication with self
     def _send_to_self(self, request):
         # The sending request is complete, so we update it right away
         # so the user will be able to wait() for it.
-        request.update("ready")
+        request.update(constants.REQUEST_READY)
 
-        queue_item = (self.rank(), request.tag, False, self.id, request.data)
-        with self.mpi.received_data_lock:
-            self.mpi.received_data.append(queue_item)
-            self.mpi.pending_requests_has_work.set()
-            self.mpi.has_work_event.set()
+        queue_item = (self.rank(), request.tag, False, self.id, None, request.data)
+        self.mpi.deliver_message(queue_item)
 
     def isend(self, content, destination, tag = constants.MPI_TAG_ANY):
         #Logger().debug(" -- isend called -- content:%s, destination:%s, tag:%s" % (content, destination, tag) )
@@ -573,13 +662,7 @@ class Communicator:
         # Create a recv request object to catch the acknowledgement message coming in
         # when this request is matched it also triggers the unacked->ready transition on the request handle
         handle = Request("recv", self, destination, constants.TAG_ACK)
-        # Add the request to the MPI layer unstarted requests queue. We
-        # signal the condition variable to wake the MPI thread and have
-        # it handle the request start.
-        with self.mpi.pending_requests_lock:
-            self.mpi.pending_requests.append(handle)
-            self.mpi.pending_requests_has_work.set()
-            self.mpi.has_work_event.set()
+        self.mpi.post_receive(handle)
 
         # Add the send request but wait on the recv handle
         self._add_unstarted_request(dummyhandle)
@@ -623,6 +706,86 @@ class Communicator:
         execute_system_commands(self.mpi)
         return self._issend(content, destination, tag).wait()
 
+    def send_init(self, content, destination, tag = constants.MPI_TAG_ANY):
+        """
+        Create a persistent send request for sending content to destination
+        with the given tag over and over. Nothing is sent until the request
+        is started with :func:`start <mpi.request.PersistentRequest.start>` or
+        :func:`startall`, and every start must be waited for like an
+        :func:`isend` before the next one.
+
+        The destination is looked up once here. If content is a contiguous
+        numpy array or a bytearray the message header is built once too, and
+        every start sends what the buffer holds at that time. The buffer must
+        keep its size. Other objects are serialized again on every start::
+
+            from mpi import MPI
+            import numpy
+            mpi = MPI()
+            world = mpi.MPI_COMM_WORLD
+            rank = world.rank()
+
+            row = numpy.zeros(100)
+            if rank == 0:
+                request = world.send_init(row, 1)
+            else:
+                request = world.recv_init(0, out=row)
+
+            for i in range(1000):
+                if rank == 0:
+                    row[:] = i
+                request.start()
+                request.wait()
+
+            mpi.finalize()
+
+        .. note::
+            See also the :func:`recv_init` and :func:`startall` functions.
+        """
+        execute_system_commands(self.mpi)
+
+        # Check that destination exists
+        if not self.have_rank(destination):
+            if isinstance(destination, int):
+                raise MPINoSuchRankException("No process with rank %d in communicator %s." % (destination, self.name))
+            else:
+                raise MPIInvalidRankException("Rank %s is not a valid rank (a rank should be an integer)." % (destination))
+
+        # Check that tag is valid
+        if not isinstance(tag, int):
+            raise MPIInvalidTagException("All tags should be integers")
+
+        return PersistentRequest("send", self, destination, tag, data=content)
+
+    def recv_init(self, source=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY, out=None):
+        """
+        Create a persistent receive request, the receiving counterpart of
+        :func:`send_init`. Each start posts a receive like :func:`irecv`
+        with the same source, tag and optional ``out`` buffer.
+        """
+        execute_system_commands(self.mpi)
+
+        # Check that source exists
+        if not source is constants.MPI_SOURCE_ANY and not self.have_rank(source):
+            raise MPINoSuchRankException("No process with rank %d in communicator %s. " % (source, self.name))
+
+        # Check that tag is valid
+        if not isinstance(tag, int):
+            raise MPIInvalidTagException("All tags should be integers")
+
+        if out is not None:
+            utils.check_receive_buffer(out)
+
+        return PersistentRequest("recv", self, source, tag, out=out)
+
+    def startall(self, request_list):
+        """
+        Start all the persistent requests in the list, see :func:`send_init`.
+        """
+        execute_system_commands(self.mpi)
+        for request in request_list:
+            request.start()
+
     def probe(self, source=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY):
         """
         Function that inspects if a message from a given ``source`` with
@@ -655,12 +818,7 @@ class Communicator:
         **See also**: :func:`iprobe`
         """
         execute_system_commands(self.mpi)
-        while True:
-            res = self._iprobe(source, tag)
-            if res:
-                return
-
-            self.mpi.pending_requests_has_work.wait()
+        self.mpi.message_matcher.probe(self.id, source, tag, block=True)
 
     def iprobe(self, source=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY):
         """
@@ -674,22 +832,76 @@ class Communicator:
 
     def _iprobe(self, source, tag):
         """
-        The inner works of iprobe() and probe()
+        The inner works of iprobe(). A message is reported if a recv with the
+        same source and tag would match it.
         """
-        with self.mpi.received_data_lock:
-            for element in self.mpi.received_data:
-                (sender, recv_tag, _, communicator_id, _) = element
+        return self.mpi.message_matcher.probe(self.id, source, tag) is not None
 
-                # Any communication must take place within the same communicator
-                if self.id == communicator_id:
+    def mprobe(self, source=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY):
+        """
+        Matched probe. Blocks like :func:`probe` until a message from
+        ``source`` with ``tag`` can be received, but also takes the message
+        out so no other receive can match it, and returns it as a
+        :class:`Message <mpi.matching.Message>` for :func:`mrecv`.
 
-                    # The participant must match or any rank have been specified
-                    if source in (sender, constants.MPI_SOURCE_ANY):
+        The message tells the size of the payload and for numpy arrays the
+        dtype and shape, so a buffer can be set up before receiving::
 
-                        # The tag must match or any tag have been specified or it must be an acknowledgement (system message)
-                        if tag in (recv_tag, constants.MPI_TAG_ANY):
-                            return True
-        return False
+            from mpi import MPI
+            from mpi import constants
+            import numpy
+            mpi = MPI()
+            world = mpi.MPI_COMM_WORLD
+
+            if world.rank() == 0:
+                world.send(numpy.arange(42.0), 1)
+            elif world.rank() == 1:
+                message = world.mprobe(constants.MPI_SOURCE_ANY)
+                buffer = numpy.empty(message.shape, message.dtype)
+                world.mrecv(message, out=buffer)
+
+            mpi.finalize()
+
+        **See also**: :func:`improbe`
+        """
+        execute_system_commands(self.mpi)
+        return Message(self, self.mpi.take_message(self.id, source, tag, block=True))
+
+    def improbe(self, source=constants.MPI_SOURCE_ANY, tag=constants.MPI_TAG_ANY):
+        """
+        Non blocking matched probe. Like :func:`mprobe` but returns None
+        right away if no matching message has arrived.
+        """
+        execute_system_commands(self.mpi)
+        message = self.mpi.take_message(self.id, source, tag)
+        if message is None:
+            return None
+        return Message(self, message)
+
+    def mrecv(self, message, out=None):
+        """
+        Receive a message returned from :func:`mprobe` or :func:`improbe`.
+        The message is not matched again, so this never blocks on the
+        network. A numpy array or bytearray to receive into can be given as
+        ``out`` like for :func:`recv`.
+        """
+        return self.imrecv(message, out).wait()
+
+    def imrecv(self, message, out=None):
+        """
+        Non blocking version of :func:`mrecv`. The returned request is
+        already complete.
+        """
+        execute_system_commands(self.mpi)
+        if message.communicator is not self:
+            raise MPIException("The message was probed on communicator %s" % message.communicator.name)
+
+        if out is not None:
+            utils.check_receive_buffer(out)
+
+        request = Request("recv", self, message.source, message.tag, out=out)
+        self.mpi._complete_receive(request, message.consume())
+        return request
 
 
     def send(self, content, destination, tag = constants.MPI_TAG_ANY):
@@ -737,7 +949,7 @@ class Communicator:
         execute_system_commands(self.mpi)
         return self._isend(content, destination, tag).wait()
 
-    def recv(self, source, tag = constants.MPI_TAG_ANY):
+    def recv(self, source, tag = constants.MPI_TAG_ANY, out=None):
         """
         Basic receive function. Receives from the destination rank a message
         with the specified tag.
@@ -753,6 +965,9 @@ class Communicator:
         POSSIBLE ERRORS: If you specify a destination rank out of scope for
         this communicator.
 
+        A preallocated numpy array or bytearray to receive into can be given
+        as ``out``, see :func:`irecv`.
+
         .. note:: See also the :func:`irecv` and :func:`send` functions
 
         .. note::
@@ -762,12 +977,12 @@ class Communicator:
             See the :ref:`TagRules` page for rules about your custom tags
         """
         execute_system_commands(self.mpi)
-        return self._irecv(source, tag).wait()
+        return self._irecv(source, tag, out).wait()
 
     #def _recv(self, source, tag = constants.MPI_TAG_ANY):
     #    return self._irecv(source, tag).wait()
 
-    def sendrecv(self, senddata, dest, sendtag=constants.MPI_TAG_ANY, source=None, recvtag=constants.MPI_TAG_ANY):
+    def sendrecv(self, senddata, dest, sendtag=constants.MPI_TAG_ANY, source=None, recvtag=constants.MPI_TAG_ANY, out=None):
         """
 
         The send-receive operation combine in one call the sending of a message
@@ -782,6 +997,9 @@ class Communicator:
 
         **Default values**: If no ``source`` is defined it is defined same as the ``dest``.
 
+        The message can be received into a preallocated numpy array or
+        bytearray given as ``out``, see :func:`irecv`.
+
         **Example usage**:
         The following code will send a token string between all messages. All
         ranks receive the token from their lower neighbour and pass it to the
@@ -822,7 +1040,7 @@ class Communicator:
         if source is None:
             source = dest
 
-        recvhandle = self._irecv(source, recvtag)
+        recvhandle = self._irecv(source, recvtag, out)
         self._isend(senddata, dest, sendtag).wait()
         return recvhandle.wait()
 
@@ -1566,20 +1784,9 @@ class Communicator:
         return self._waitall(request_list)
 
     def _waitall(self, request_list):
-        remaining = len(request_list)
-        incomplete = [True for _ in range(remaining)]
-        return_list = [None for _ in range(remaining)]
-
-        while remaining > 0:
-            for idx, request in enumerate(request_list):
-                if incomplete[idx] and request.test():
-                    return_list[idx] = request.wait()
-                    incomplete[idx] = False
-                    remaining -= 1
-
-            time.sleep(0.00001)
-
-        return return_list
+        # Every request has to complete anyway, so the order they are
+        # waited for in makes no difference
+        return [ request.wait() for request in request_list ]
 
     def waitany(self, request_list):
         """
@@ -1626,14 +1833,8 @@ class Communicator:
         if len(request_list) == 0:
             raise MPIException("The request_list argument to waitany can't be empty.. ")
 
-        sleep_time = 0.1
-        while True:
-            for request in request_list:
-                if request.test():
-                    data = request.wait()
-                    return (request, data)
-            time.sleep(sleep_time)
-            sleep_time *= 2
+        request = wait_for_some(request_list)[0]
+        return (request, request.wait())
 
     def waitsome(self, request_list):
         """
@@ -1695,17 +1896,10 @@ class Communicator:
 
         """
         execute_system_commands(self.mpi)
-        return_list = []
-
-        for request in request_list:
-            if request.test():
-                data = request.wait()
-                return_list.append( (request, data))
-
-        if return_list:
-            return return_list
+        if len(request_list) == 0:
+            raise MPIException("The request_list argument to waitsome can't be empty.. ")
 
-        return [ self._waitany(request_list) ]
+        return [ (request, request.wait()) for request in wait_for_some(request_list) ]
 
     def Wtime(self):
         """
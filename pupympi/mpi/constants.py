@@ -110,6 +110,20 @@ TAG_GATHER = -15
 TAG_GATHERPL = -1515
 TAG_SCAN = -16
 TAG_SHUTDOWN = -17
+TAG_RENDEZVOUS = -18
+TAG_CREDIT = -19
+TAG_PREWARM = -20
+TAG_DISCONNECT = -21
+
+# Steps of the rendezvous protocol for large point to point messages (see
+# mpi.rendezvous). A step is sent in the collective class id field of the
+# header, which is otherwise unused for point to point messages, and the
+# rendezvous id goes in the sequence field.
+RENDEZVOUS_RTS = -2     # Sender has a message ready, carries the user tag
+RENDEZVOUS_CTS = -3     # Receiver matched it and is ready for the payload
+RENDEZVOUS_DATA = -4    # The payload itself
+RENDEZVOUS_STRIPE = -5  # Part of the payload, when it is split over several connections
+RENDEZVOUS_STEPS = (RENDEZVOUS_RTS, RENDEZVOUS_CTS, RENDEZVOUS_DATA, RENDEZVOUS_STRIPE)
 
 # A list with all the collective tags for easy testing if a received message is
 # actually part of a collective operation.
@@ -119,6 +133,14 @@ COLLECTIVE_TAGS = [TAG_GATHERPL, TAG_BCAST, TAG_BARRIER, TAG_REDUCE, TAG_ALLREDU
 # NOT IMPLEMENTED:
 # MPI_COMM_SELF (MPI 2.x)
 
+# Status of a point to point request. A request only moves up this list,
+# everything from REQUEST_READY and up means that wait() returns at once.
+REQUEST_NEW = 0         # Newly created. The lower layer can start sending the data
+REQUEST_UNACKED = 1     # An ssend that has been sent but not acknowledged yet
+REQUEST_READY = 2       # Data received (recv) or sent (send), wait() and test() can complete
+REQUEST_FINISHED = 3    # wait() has returned
+REQUEST_CANCELLED = 4   # Cancelled by the user, will be removed at some later point
+
 JOB_INITIALIZING = -1
 
 # Utilities commands
@@ -137,4 +159,10 @@ CMD_RAWTYPE = 100
 # > CMD_RAWTYPE for rawtypes
 CMD_USER = CMD_RAWTYPE # indicate that this is a user command (not a system command)
 
-CMD_BYTEARRAY = 301
\ No newline at end of file
+CMD_BYTEARRAY = 301
+# Pickled user messages with their numpy arrays sent out of band, after the
+# pickle (see mpi.network.utils.serialize_message). 999 is not a typeint.
+CMD_OUT_OF_BAND = 999
+# Compressed user messages have the codec id times this added to their cmd
+# (see mpi.network.compression). It is well above any shapelen*1000 + typeint.
+CMD_COMPRESSED = 2**24
@@ -0,0 +1,293 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+import threading, itertools
+from collections import deque
+
+from mpi import constants
+from mpi.exceptions import MPIException
+import mpi.network.utils as utils
+from mpi.network import compression
+from mpi.rendezvous import LargeMessage
+
+class MessageMatcher(object):
+    """
+    Matches point to point receive requests with incoming messages.
+
+    Two queues are kept. Posted receives that are still waiting for a message
+    and unexpected messages that arrived before anyone asked for them. Both
+    are indexed so finding a match does not mean scanning everything that
+    is outstanding:
+
+    * posted receives are queued by (comm_id, source, tag) exactly as they
+      were posted, wildcards included. An incoming message can only match the
+      queues for its own source and tag and the wildcard variants of those,
+      so at most four queue heads are compared.
+    * unexpected messages are queued by communicator, then sender, then tag.
+      A receive without wildcards looks at a single queue, a wildcard receive
+      only at the queue heads for the senders or tags it covers.
+
+    Every queued item carries a sequence number so the oldest candidate wins
+    between several queues, which keeps the MPI ordering guarantees. The
+    matching rules are the ones pupyMPI always had: the communicator must be
+    the same, the source must be the sender or MPI_SOURCE_ANY, and the tag
+    must be the same or MPI_TAG_ANY for a message with a positive (user) tag.
+
+    Messages are kept as the (sender, tag, acknowledge, comm_id, msg_type,
+    data) tuples the MPI thread builds, with the payload still serialized.
+    The matcher only does the bookkeeping, completing the request is left to
+    the caller.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Notified when an unexpected message is queued (used by probe)
+        self.message_arrived = threading.Condition(self.lock)
+
+        self.posted = {} # (comm_id, source, tag) -> deque of (sequence, request)
+        self.unexpected = {} # comm_id -> sender -> tag -> deque of (sequence, message)
+
+        self.sequence = itertools.count()
+
+        # Depth of the unexpected queues, now and at most
+        self.unexpected_count = 0
+        self.unexpected_peak = 0
+
+    def post(self, request):
+        """
+        Find the oldest unexpected message matching a receive request and
+        remove it from the queue. If there is none the request is queued for
+        the next matching message and None is returned.
+        """
+        with self.lock:
+            found = self._find_unexpected(request.communicator.id, request.participant, request.tag)
+            if found:
+                return self._take_unexpected(*found)
+
+            key = (request.communicator.id, request.participant, request.tag)
+            self.posted.setdefault(key, deque()).append( (self.sequence.next(), request) )
+            return None
+
+    def withdraw(self, request):
+        """
+        Remove a posted receive that is being cancelled from its queue so no
+        message can match it any more. Returns False if it was not waiting
+        for a message (any longer).
+        """
+        key = (request.communicator.id, request.participant, request.tag)
+        with self.lock:
+            queue = self.posted.get(key)
+            if not queue:
+                return False
+
+            for item in queue:
+                if item[1] is request:
+                    queue.remove(item)
+                    if not queue:
+                        del self.posted[key]
+                    return True
+            return False
+
+    def deliver(self, message):
+        """
+        Find the oldest posted receive matching an incoming message and
+        remove it from the queue. If there is none the message is queued as
+        unexpected and None is returned.
+        """
+        (sender, tag, _, comm_id, _, _) = message
+
+        with self.lock:
+            keys = [(comm_id, sender, tag), (comm_id, constants.MPI_SOURCE_ANY, tag)]
+            if tag > 0:
+                keys.extend([ (comm_id, sender, constants.MPI_TAG_ANY), (comm_id, constants.MPI_SOURCE_ANY, constants.MPI_TAG_ANY) ])
+
+            best = None
+            for key in keys:
+                queue = self.posted.get(key)
+                if queue and (best is None or queue[0][0] < best[0][0]):
+                    best = (queue[0], key)
+
+            if best:
+                ((_, request), key) = best
+                queue = self.posted[key]
+                queue.popleft()
+                if not queue:
+                    del self.posted[key]
+                return request
+
+            senders = self.unexpected.setdefault(comm_id, {})
+            tags = senders.setdefault(sender, {})
+            tags.setdefault(tag, deque()).append( (self.sequence.next(), message) )
+            self.unexpected_count += 1
+            self.unexpected_peak = max(self.unexpected_peak, self.unexpected_count)
+            self.message_arrived.notifyAll()
+            return None
+
+    def probe(self, comm_id, source, tag, block=False):
+        """
+        Return the oldest unexpected message matching the source and tag
+        without removing it. With block the call waits until there is one,
+        otherwise None is returned if nothing matches.
+        """
+        with self.lock:
+            while True:
+                found = self._find_unexpected(comm_id, source, tag)
+                if found:
+                    (sender, message_tag, queue) = found
+                    return queue[0][1]
+                elif not block:
+                    return None
+
+                self.message_arrived.wait()
+
+    def take(self, comm_id, source, tag, block=False):
+        """
+        Like probe, but the message is removed from the queue so no receive
+        can match it any more.
+        """
+        with self.lock:
+            while True:
+                found = self._find_unexpected(comm_id, source, tag)
+                if found:
+                    return self._take_unexpected(*found)
+                elif not block:
+                    return None
+
+                self.message_arrived.wait()
+
+    def _find_unexpected(self, comm_id, source, tag):
+        """
+        Locate the oldest unexpected message matching a receive. Returns a
+        (sender, tag, queue) tuple with the message at the head of the queue
+        or None.
+
+        NOTE: Caller makes sure the lock is held
+        """
+        senders = self.unexpected.get(comm_id)
+        if not senders:
+            return None
+
+        if source == constants.MPI_SOURCE_ANY:
+            candidates = senders.iteritems()
+        elif source in senders:
+            candidates = [ (source, senders[source]) ]
+        else:
+            return None
+
+        best = None
+        for (sender, tags) in candidates:
+            if tag == constants.MPI_TAG_ANY:
+                queues = [ (t, q) for (t, q) in tags.iteritems() if t > 0 or t == tag ]
+            elif tag in tags:
+                queues = [ (tag, tags[tag]) ]
+            else:
+                continue
+
+            for (message_tag, queue) in queues:
+                if best is None or queue[0][0] < best[2][0][0]:
+                    best = (sender, message_tag, queue)
+
+        return best
+
+    def _take_unexpected(self, sender, tag, queue):
+        """
+        Remove the message at the head of an unexpected queue found by
+        _find_unexpected and prune the index of empty entries.
+
+        NOTE: Caller makes sure the lock is held
+        """
+        (_, message) = queue.popleft()
+        self.unexpected_count -= 1
+        if not queue:
+            comm_id = message[3]
+            tags = self.unexpected[comm_id][sender]
+            del tags[tag]
+            if not tags:
+                del self.unexpected[comm_id][sender]
+                if not self.unexpected[comm_id]:
+                    del self.unexpected[comm_id]
+        return message
+
+    def get_pending_requests(self):
+        """
+        The posted receives still waiting for a message, oldest first.
+        """
+        with self.lock:
+            items = [ item for queue in self.posted.values() for item in queue ]
+        items.sort()
+        return [ request for (_, request) in items if request.status != constants.REQUEST_CANCELLED ]
+
+    def get_received_data(self):
+        """
+        The unexpected messages in the order they arrived.
+        """
+        with self.lock:
+            items = [ item for senders in self.unexpected.values() for tags in senders.values() for queue in tags.values() for item in queue ]
+        items.sort()
+        return [ message for (_, message) in items ]
+
+class Message(object):
+    """
+    A message taken out of the matching by :func:`improbe
+    <mpi.communicator.Communicator.improbe>` or :func:`mprobe
+    <mpi.communicator.Communicator.mprobe>`. No other receive can get it, it
+    is received exactly once with :func:`mrecv
+    <mpi.communicator.Communicator.mrecv>` or :func:`imrecv
+    <mpi.communicator.Communicator.imrecv>`.
+
+    The source and tag of the message are available as attributes, and
+    size is the number of bytes in the serialized payload. For numpy arrays
+    dtype and shape tell what the array will look like, so a buffer for it
+    can be allocated before receiving. They are None for other messages.
+    """
+    def __init__(self, communicator, message):
+        self.communicator = communicator
+        self.message = message
+
+        (self.source, self.tag, ack, comm_id, msg_type, data) = message
+
+        # The size and type of a compressed message are only known once it
+        # is decompressed, which has to be done before receiving it anyway.
+        # Large messages that are not transferred yet are left as they are.
+        large = isinstance(data, LargeMessage)
+        if compression.is_compressed(msg_type) and not large:
+            data, msg_type = compression.decompress(data, msg_type)
+            self.message = (self.source, self.tag, ack, comm_id, msg_type, data)
+
+        # Messages to self are never serialized
+        self.size = None
+        self.dtype = None
+        self.shape = None
+        if msg_type is not None:
+            self.size = len(data)
+            if large:
+                info = utils.get_array_info(data.prefix, msg_type, data.size)
+            else:
+                info = utils.get_array_info(data, msg_type)
+            if info:
+                (self.dtype, self.shape) = info
+
+    def consume(self):
+        """
+        Hand over the message for receiving. This can only be done once.
+        """
+        if self.message is None:
+            raise MPIException("The message has already been received")
+
+        message = self.message
+        self.message = None
+        return message
@@ -48,7 +48,7 @@ class MigratePack(object):
         # Pause the threads. Note that pause.set() might be called two times on
         # one network thread, if we are using the combo version.
         self.mpi.shutdown_event.set()
-        self.mpi.has_work_event.set()
+        self.mpi.wake_up()
 
         self.network.finalize()
 
@@ -99,7 +99,7 @@ class MigratePack(object):
         rank = self.mpi.MPI_COMM_WORLD.comm_group.rank()
 
         # Find all connections in the socket pool.
-        write_connections = [ s for s in self.pool.sockets ]
+        write_connections = self.pool.sockets.values()
         read_connections = [ s for s in write_connections ]
 
         # Try to find a socket to -1 (the admin). We don't want to close that one
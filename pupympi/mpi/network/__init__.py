@@ -15,11 +15,16 @@
 # You should have received a copy of the GNU General Public License 2
 # along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
 #
-import socket, threading, struct, select, time
+import socket, threading, struct, select, time, os, errno, fcntl
 
 from mpi.exceptions import MPIException
 from mpi.network.socketpool import SocketPool
+from mpi.network import sharedmemory
+from mpi.network.sharedmemory import SharedMemoryChannel, SPACE_RETRY_INTERVAL
 from mpi.network import utils # Some would like the rest of the utils to be more explicitly used ... maybe later
+from mpi.network.flowcontrol import FlowControl
+from mpi.network.disconnect import Disconnect
+from mpi.network import bootstrap
 from mpi.network.utils import create_random_socket, get_raw_message, prepare_message, pickle
 from mpi import constants, syscommands
 from mpi.logger import Logger
@@ -60,19 +65,40 @@ def get_communicator_class(socket_poll_method=False):
     #Logger().debug("Found communicator class of type %s, called with socket_poll_method parameter %s" % (c_class, socket_poll_method))
     return c_class
 
+def mesh_peers(rank, size):
+    """
+    The ranks the process with the given rank opens connections to when
+    every process is connected to every other. That is the ranks up to half
+    way around the ring of ranks after it, nearest first, so each pair is
+    connected once.
+    """
+    peers = [ (rank + distance) % size for distance in range(1, (size+1) / 2) ]
+    if size % 2 == 0 and size > 1 and rank < size / 2:
+        peers.append(rank + size / 2)
+    return peers
+
+def mesh_accepted(rank, size):
+    """
+    The ranks that open connections to the process with the given rank when
+    every process is connected to every other, the reverse of mesh_peers.
+    That is the ranks up to half way around the ring before it, nearest
+    first.
+    """
+    accepted = [ (rank - distance) % size for distance in range(1, (size+1) / 2) ]
+    if size % 2 == 0 and size > 1 and rank >= size / 2:
+        accepted.append(rank - size / 2)
+    return accepted
+
 class Network(object):
     def __init__(self, mpi, options):
-        # Structures to keep information regarding a potential connection
-        # closing. Always take the lock before manipulating the data. The dict
-        # structure contains a tuple with information for each connection. The
-        # elements of the tuple is as follows:
-        #  (1) A threading.Event() used for waiting / testing if the connection
-        #      is fully closed.
-        #  (2) A status flag (string) indicating if the connection is considered
-        #      closed on either side. The flash can contain the following values:
-        #      "remote" (other endpoint closed the connection), "local", we closed it.
-        self.closing_socket_lock = threading.Lock()
-        self.closing_socket_data = {}
+        # Connections the socket pool lets go of are closed with a drain
+        # handshake (see mpi.network.disconnect). Once they are, the network
+        # threads stop watching them and the last one to do so closes the
+        # socket. The dict holds the number of threads still to let go of
+        # each of them.
+        self.disconnect = Disconnect(self)
+        self.releasing_lock = threading.Lock()
+        self.releasing = {}
 
         if options.disable_full_network_startup:
             socket_pool_size = options.socket_pool_size
@@ -80,7 +106,15 @@ class Network(object):
             # We need extra room for an admin connection.
             socket_pool_size = options.size+1
 
-        self.socket_pool = SocketPool(socket_pool_size)
+        self.socket_pool = SocketPool(socket_pool_size, int(options.rank), self.disconnect.start)
+
+        # Seconds spent in each phase of getting the network up, see
+        # start_full_network
+        self.startup_timings = {}
+
+        # Credit for the point to point messages sent to and received from
+        # each of the other processes
+        self.flow_control = FlowControl(self, mpi.settings.FLOW_CONTROL_BUDGET)
 
         communicator_class = get_communicator_class(options.socket_poll_method)
 
@@ -103,6 +137,11 @@ class Network(object):
             self.t_out.type = "out"
             self.t_in.type = "in"
 
+        # Every other process may connect several times at once when large
+        # messages are striped, and connections that do not fit the backlog
+        # are retried by the kernel only after a long timeout
+        backlog = max(options.size-1, socket.SOMAXCONN)
+
         if self.options.unixsockets:
             # Create a unix socket for communicating with other ranks
             # on the same host.
@@ -110,21 +149,31 @@ class Network(object):
             unix_socket_filename = NamedTemporaryFile().name
             uxs = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             uxs.bind(unix_socket_filename)
-            uxs.listen(options.size-1)
+            uxs.listen(backlog)
             self.unix_socket_filename = unix_socket_filename
 
             self.t_in.add_in_socket(uxs) # Put unix receive sockets on incoming list
             self.t_in.unix_socket = uxs # Set unix receive socket for comparison in _handle_readlist
+
+            # Ranks on the same host that use shared memory channels connect
+            # to a second unix socket next to the first one. The connection
+            # becomes the doorbell of the channel.
+            shs = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            shs.bind(unix_socket_filename + ".shm")
+            shs.listen(backlog)
+            self.t_in.add_in_socket(shs)
+            self.t_in.shared_memory_socket = shs
         else:
             # These values are convenient dummies (just so we don't have to check for self.options.unixsockets everywhere)
             self.unix_socket_filename = ""
             self.t_in.unix_socket = None
+            self.t_in.shared_memory_socket = None
 
         # Create the main receive socket
         (server_socket, hostname, port_no) = create_random_socket()
         self.port = port_no
         self.hostname = hostname
-        server_socket.listen(options.size-1)
+        server_socket.listen(backlog)
 
         # Put main receive socket on incoming list
         self.t_in.add_in_socket(server_socket)
@@ -145,8 +194,8 @@ class Network(object):
         For mpirun to have this information we first send all the data
         from our own process. So we can bind a socket.
 
-        The data sent back to mpirun.py is a tuple containing the following
-        elements:
+        The record sent to mpirun.py (see mpi.network.bootstrap) contains the
+        following elements:
 
             * hostname           : Our hostname
             * port               : Our port number. Together with hostname, this
@@ -160,50 +209,58 @@ class Network(object):
                                    other than the starting user.
             * availability       : Information about each system commands
                                    availability on this host.
+            * bootstrap port     : A socket the table of all the processes is
+                                   handed to us on, by mpirun.py or the process
+                                   above us in the bootstrap tree.
 
-        mpirun.py sends a tuple back containing:
-
-            * all_procs          : Prior to release 0.8.0 this was the only data
-                                   sent (and it was not in a tuple).
-            * script-path        : The user script path. This is only used when we
-                                   are resuming a packed job and need to import and
-                                   run it.
-            * state              : The state of the program when the job was packed.
+        The table contains the contact information of all the processes, and
+        when a packed job is resumed the state of the program when the job
+        was packed.
         """
+        started = time.time()
         sec_comp = self.mpi.generate_security_component()
         avail = syscommands.availablity()
 
-        # Packing the data
-        data = (self.hostname, self.port, self.unix_socket_filename, internal_rank, sec_comp, avail)
+        # The table arrives on a socket of its own, so it can not be mixed
+        # up with connections from processes that are already running
+        (bootstrap_socket, _, bootstrap_port) = create_random_socket()
+        bootstrap_socket.listen(1)
 
         # Connection to the mpirun processs
         s_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         recipient = (mpirun_hostname, mpirun_port)
         s_conn.connect(recipient)
 
-        # Pack the data with our special format
-        header,payloads = prepare_message(data, internal_rank, comm_id=-1, tag=constants.TAG_INITIALIZING)
-        utils.robust_send_multi(s_conn, [header]+payloads)
+        record = bootstrap.pack_record(internal_rank, self.hostname, self.port, self.unix_socket_filename, bootstrap_port, sec_comp, avail, utils.header_version)
+        bootstrap.send_blob(s_conn, record)
+        s_conn.close()
 
-        # Receiving data about the communicator, by unpacking the head etc.
-        # first _ is rank
-        from mpi import dill
-        _, _, _, _, _, _, data = get_raw_message(s_conn)
-        all_procs, state = dill.loads(data)
+        (conn, _) = bootstrap_socket.accept()
+        message = bootstrap.receive_blob(conn)
+        conn.close()
+        bootstrap_socket.close()
 
-        if state:
-            self.mpi.resume = True
-            self.mpi.resume_state = state
+        # Pass the table on before looking at it so the processes below us
+        # are not kept waiting
+        (lo, hi, table, contacts, sessions) = bootstrap.unpack_message(message)
+        bootstrap.scatter(lo, hi, table, contacts, sessions)
 
-        s_conn.close()
+        if sessions and sessions[internal_rank]:
+            self.mpi.resume = True
+            self.mpi.resume_state = sessions[internal_rank]
 
         self.all_procs = {}
 
-        for (host, port, unx_filename, global_rank) in all_procs:
+        for (global_rank, (host, port, unx_filename, _)) in enumerate(contacts):
 
-            # Check if this rank lives on the same host as we do. If so use the
-            # unix socket instead of the TCP information.
-            if host == self.hostname and self.options.unixsockets:
+            # Check if this rank lives on the same host as we do. If so use a
+            # shared memory channel or the unix socket instead of the TCP
+            # information. Shared memory is only used on machines where the
+            # rings are safe without memory barriers.
+            if host == self.hostname and self.options.unixsockets and self.options.shared_memory and sharedmemory.SUPPORTED:
+                connection_info = (unx_filename + ".shm", self.mpi.settings.SHARED_MEMORY_RING_SIZE)
+                connection_type = "shm"
+            elif host == self.hostname and self.options.unixsockets:
                 connection_info = unx_filename
                 connection_type = "local"
             else:
@@ -211,28 +268,186 @@ class Network(object):
                 connection_type = "tcp"
             self.all_procs[global_rank] = {'connection_info' : connection_info, 'connection_type' : connection_type, 'global_rank' : global_rank}
 
+        self.startup_timings["bootstrap"] = time.time() - started
+
     def start_full_network(self):
-        # We make a full network startup by receiving from all with lower ranks and
-        # sending to higher ranks
+        """
+        Connect every process to every other at startup. The connections
+        are opened at once with non-blocking connects (see connect). After
+        that every process sends a TAG_FULL_NETWORK message over the
+        connections it opened and waits for one over each of the connections
+        opened to it, so all the pairs are in both socket pools when this
+        returns.
+
+        Each pair has a single connection, opened by the process for which
+        the other one is at most half way around the ring of ranks (see
+        mesh_peers and mesh_accepted). Every process thus starts out connecting to a
+        different neighbour, instead of all of them connecting to rank 0
+        first.
+
+        The time taken by the two phases is kept in startup_timings.
+        """
+        world = self.mpi.MPI_COMM_WORLD
+        our_rank = world.comm_group.rank()
+        size = world.comm_group.size()
+
+        peers = mesh_peers(our_rank, size)
+        accepted = mesh_accepted(our_rank, size)
+
+        started = time.time()
+        self.connect(peers)
+        connected = time.time()
+
+        # Receive from everybody connecting to us and greet everybody we
+        # connected to
+        handles = [ world._irecv(rank, constants.TAG_FULL_NETWORK) for rank in accepted ]
+        handles.extend( world._isend(our_rank, rank, constants.TAG_FULL_NETWORK) for rank in peers )
+        for handle in handles:
+            handle.wait()
+
+        self.startup_timings["connect"] = connected - started
+        self.startup_timings["handshake"] = time.time() - connected
+        Logger().debug("Full network startup: %s" % self.startup_timings)
+
+    def connect(self, ranks):
+        """
+        Open connections to the processes with the given global ranks that
+        are not already in the socket pool, and put them in it. Returns the
+        ranks connections were opened to.
+
+        TCP connections are opened without blocking and completed with a
+        single poller, at most CONNECT_WINDOW of them at a time so a large
+        job does not flood the listen backlogs of the other processes.
+        Shared memory channels and unix sockets are local and opened one by
+        one.
+
+        Every new connection is greeted with a TAG_PREWARM message right
+        away. The network thread of the other side reads the first message
+        of a connection as soon as it accepts it, and learns from it which
+        rank the connection belongs to. The greeting is dropped after that.
+        """
+        # Imported here since mpi.request needs the network package itself
+        from mpi.request import Request
+
+        window = max(1, self.mpi.settings.CONNECT_WINDOW)
+        world = self.mpi.MPI_COMM_WORLD
+        greeting = utils.prepare_header(world.comm_group.rank(), cmd=constants.CMD_USER, tag=constants.TAG_PREWARM, comm_id=world.id)
+
+        if hasattr(select, "epoll"):
+            poller = select.epoll()
+            WRITE = select.EPOLLOUT
+        else:
+            poller = select.poll()
+            WRITE = select.POLLOUT
+
+        waiting = [ rank for rank in ranks if not self.socket_pool.has_socket(rank) ]
+        waiting.reverse()
+        in_progress = {} # file descriptor -> (rank, socket)
+        connected = []
+
+        def established(rank, client_socket):
+            if not self.socket_pool.add_connected_socket(rank, client_socket):
+                # The other side connected to us meanwhile
+                client_socket.close()
+                return
+
+            self.t_in.add_in_socket(client_socket)
+            self.t_out.add_out_socket(client_socket)
+
+            request = Request("send", world, rank, constants.TAG_PREWARM, data=[])
+            request.header = greeting
+            request.global_rank = rank
+            request.is_prepared = True
+            self.t_out.queue_request(client_socket, request)
+            connected.append(rank)
+
+        try:
+            while waiting or in_progress:
+                while waiting and len(in_progress) < window:
+                    rank = waiting.pop()
+                    connection_info = self.all_procs[rank]['connection_info']
+                    connection_type = self.all_procs[rank]['connection_type']
+
+                    if connection_type != "tcp":
+                        established(rank, self.socket_pool.connect(connection_info, connection_type))
+                        continue
+
+                    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    client_socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+                    client_socket.setblocking(0)
+                    error = client_socket.connect_ex(connection_info)
+                    if error not in (0, errno.EINPROGRESS):
+                        client_socket.close()
+                        raise MPIException("Could not connect to rank %d: %s" % (rank, os.strerror(error)))
+
+                    in_progress[client_socket.fileno()] = (rank, client_socket)
+                    poller.register(client_socket.fileno(), WRITE)
+
+                if not in_progress:
+                    continue
+
+                for (fd, _) in poller.poll():
+                    (rank, client_socket) = in_progress.pop(fd)
+                    poller.unregister(fd)
+
+                    error = client_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error:
+                        client_socket.close()
+                        raise MPIException("Could not connect to rank %d: %s" % (rank, os.strerror(error)))
+
+                    # The receiving thread relies on blocking reads
+                    client_socket.setblocking(1)
+                    established(rank, client_socket)
+        finally:
+            for (_, client_socket) in in_progress.values():
+                client_socket.close()
+            poller.close()
+
+        return connected
+
+    def prewarm(self, ranks):
+        """
+        Connect to the processes with the given global ranks ahead of the
+        first message to them. Meant for jobs started without the full
+        network, where connections are otherwise made on demand, when the
+        ranks a process will talk to are known up front. Returns the ranks
+        new connections were made to.
+        """
         our_rank = self.mpi.MPI_COMM_WORLD.comm_group.rank()
-        size = self.mpi.MPI_COMM_WORLD.comm_group.size()
 
-        receiver_ranks = [x for x in range(0, our_rank)]
-        sender_ranks = range(our_rank+1, size)
+        started = time.time()
+        connected = self.connect( [ rank for rank in ranks if rank != our_rank ] )
+        self.startup_timings["prewarm"] = self.startup_timings.get("prewarm", 0.0) + time.time() - started
+        return connected
 
-        recv_handles = []
-        # Start all the receive
-        for r_rank in receiver_ranks:
-            handle = self.mpi.MPI_COMM_WORLD._irecv(r_rank, constants.TAG_FULL_NETWORK)
-            recv_handles.append(handle)
+    def release(self, client_socket):
+        """
+        Let go of a connection for good. The network threads stop watching
+        it and the last of them closes it (see released).
+        """
+        threads = set([self.t_in, self.t_out])
+        with self.releasing_lock:
+            if client_socket in self.releasing:
+                return
+            self.releasing[client_socket] = len(threads)
 
-        # Send all
-        for s_rank in sender_ranks:
-            self.mpi.MPI_COMM_WORLD._isend(our_rank, s_rank, constants.TAG_FULL_NETWORK).wait()
+        for thread in threads:
+            thread.remove_socket(client_socket)
 
-        # Finish the receives
-        for handle in recv_handles:
-            handle.wait()
+    def released(self, client_socket):
+        """
+        A network thread no longer watches a connection given to release.
+        """
+        with self.releasing_lock:
+            self.releasing[client_socket] -= 1
+            if self.releasing[client_socket]:
+                return
+            del self.releasing[client_socket]
+
+        try:
+            client_socket.close()
+        except Exception, e:
+            Logger().debug("Got error when closing socket: %s" % e)
 
     def finalize(self):
         """
@@ -240,6 +455,9 @@ class Network(object):
         CommunicationHandlerSelect.finalize for a deeper description of
         the shutdown procedure.
         """
+        # Messages waiting for a connection to close have to get out first
+        self.disconnect.wait()
+
         self.t_in.finalize()
 
         if not self.options.single_communication_thread:
@@ -265,6 +483,43 @@ class BaseCommunicationHandler(threading.Thread):
         self.socket_to_request = {}
 
         self.outbound_requests = 0 # Number of send requests queued (only acessed with socket_to_request_lock)
+
+        # Sockets that have queued requests. Maintained under the
+        # socket_to_request_lock by whoever adds or removes requests and read
+        # by the thread itself to decide which sockets it should wait for
+        # writability on. Sockets without pending data are never polled for
+        # writing.
+        self.pending_out_sockets = set()
+        self.write_interest = set() # What the poller currently waits for (only touched by the thread itself)
+
+        # Sockets are written without blocking, so a large request may go out
+        # over several rounds. A socket with a partially written request maps
+        # to its write cursor here (only touched by the thread itself).
+        self.write_cursors = {}
+
+        # Buffered readers for the sockets the thread receives on, so several
+        # small messages can be parsed from a single read (only touched by
+        # the thread itself)
+        self.readers = {}
+
+        # Shared memory channels can not be polled for writability, their
+        # doorbell socket always is. Instead the thread checks for room in
+        # the rings itself and is woken by the doorbell when room is freed.
+        self.ready_channels = [] # Channels with pending data and room in the ring
+        self.blocked_channels = False # Whether some channel with pending data has a full ring
+
+        # Accepted shared memory channels that have not yet told us which
+        # rank they belong to (only touched by the thread itself)
+        self.unpooled_channels = set()
+
+        # Connections the thread should stop watching, see remove_socket
+        # (guarded by the socket_to_request_lock)
+        self.removed_sockets = []
+
+        # Match point to point messages against posted receives right here
+        # instead of handing them to the MPI thread first
+        self.inline_matching = network.options.inline_matching
+
         self.rank = rank
         self.socket_pool = socket_pool
 
@@ -272,7 +527,13 @@ class BaseCommunicationHandler(threading.Thread):
         self.main_receive_socket = None # For threads handling incoming this is the main socket on which new connections can be accepted
 
         self.shutdown_event = threading.Event() # signal for shutdown
-        #self.outbound_requests_event = threading.Event() # signal for something to send
+
+        # Self-pipe used to wake the thread from a blocking poll when there
+        # is something new to do (a request to send, a new socket to watch
+        # or shutdown). The read end is watched along with the sockets.
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
         # Locks for proper access to the internal socket->request structure and counter
         self.socket_to_request_lock = threading.Lock()
@@ -281,10 +542,76 @@ class BaseCommunicationHandler(threading.Thread):
 
     def finalize(self):
         self.shutdown_event.set()
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        Wake the thread if it is blocked polling its sockets. Safe to call
+        from any thread.
+        """
+        try:
+            os.write(self.wakeup_write_fd, "x")
+        except OSError, e:
+            # A full pipe means a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        """
+        Empty the wakeup pipe after the poller reported it readable.
+        """
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _update_write_interest(self):
+        """
+        Make the poller wait for writability on exactly the sockets that have
+        data queued. Only called from the thread itself.
+        """
+        with self.socket_to_request_lock:
+            wanted = set(self.pending_out_sockets)
+
+        channels = [c for c in wanted if isinstance(c, SharedMemoryChannel)]
+        self.ready_channels = [c for c in channels if c.writable()]
+        self.blocked_channels = len(self.ready_channels) < len(channels)
+        wanted.difference_update(channels)
+
+        for client_socket in wanted - self.write_interest:
+            self._set_write_interest(client_socket, True)
+        for client_socket in self.write_interest - wanted:
+            self._set_write_interest(client_socket, False)
+
+        self.write_interest = wanted
+
+    def _set_write_interest(self, client_socket, interested):
+        """
+        Start or stop polling a socket for writability. Implemented by the
+        poll method specific subclasses.
+        """
+        raise NotImplementedError("The _set_write_interest() method was not implemented by the inheriting class.")
+
+    def _poll_timeout(self):
+        """
+        How long the poller may block in seconds, None meaning until woken.
+        Shared memory channels with room to write must not wait at all, and
+        full ones are looked at again every now and then in case a doorbell
+        went missing.
+        """
+        if self.ready_channels:
+            return 0
+        elif self.blocked_channels:
+            return SPACE_RETRY_INTERVAL
+        return None
 
-    def add_out_request(self, request):
+    def add_out_request(self, request, stripe=0):
         """
-        Put a requested out operation (eg. send) on the out list
+        Put a requested out operation (eg. send) on the out list. Stripes of
+        a large payload other than the first go over connections of their
+        own.
         """
 
         # Create the proper data structure and pickle the data
@@ -293,30 +620,102 @@ class BaseCommunicationHandler(threading.Thread):
         # Find a socket and port of recipient process
         connection_info = self.network.all_procs[request.global_rank]['connection_info']
         connection_type = self.network.all_procs[request.global_rank]['connection_type']
+        disconnect = self.network.disconnect
 
-        # TODO: This call should be extended to allow asking for a persistent connection
-        client_socket, newly_created = self.socket_pool.get_socket(request.global_rank, connection_info, connection_type)
-        # If the connection is a new connection it is added to the socket lists of the respective thread(s)
-        if newly_created:
-            self.network.t_in.add_in_socket(client_socket)
-            self.network.t_out.add_out_socket(client_socket)
+        while True:
+            # Messages for a process whose connection is being closed wait
+            # for a new connection
+            if not stripe and disconnect.parking and disconnect.park(request):
+                return
 
+            # TODO: This call should be extended to allow asking for a persistent connection
+            if stripe:
+                client_socket, newly_created = self.socket_pool.get_stripe_socket(request.global_rank, stripe, connection_info, connection_type)
+            else:
+                client_socket, newly_created = self.socket_pool.get_socket(request.global_rank, connection_info, connection_type)
+            # If the connection is a new connection it is added to the socket lists of the respective thread(s)
+            if newly_created:
+                self.network.t_in.add_in_socket(client_socket)
+                self.network.t_out.add_out_socket(client_socket)
+
+            # The pool may have let go of the connection since, then the
+            # request is parked
+            if self.queue_request(client_socket, request, stripe == 0):
+                return
+
+    def queue_request(self, client_socket, request, unless_closing=False):
+        """
+        Queue a request on a connection. With unless_closing it is not
+        queued if the connection is being closed, and False is returned.
+        """
+        wake = False
         with self.socket_to_request_lock:
-            try:
-                self.network.t_out.socket_to_request[client_socket].append(request) # socket already exists just add another request to the list
-                self.outbound_requests += 1
-            except Exception, e: # This should not happen
-                Logger().error("Network-thread (%s) got error: %s of type: %s, socket_to_request was: %s" % (self.type, e, type(e), self.network.t_out.socket_to_request ) )
+            if unless_closing and self.network.disconnect.is_closing(client_socket):
+                return False
+
+            self.socket_to_request.setdefault(client_socket, []).append(request)
+            self.outbound_requests += 1
+
+            # Only a socket going from idle to pending needs the thread
+            # to look at its poll set again
+            if client_socket not in self.pending_out_sockets:
+                self.pending_out_sockets.add(client_socket)
+                wake = True
+
+        if wake:
+            self.wakeup()
+        return True
 
     def add_in_socket(self, client_socket):
         self.sockets_in.append(client_socket)
 
+        # Sockets are also added from other threads so make sure a blocking
+        # poll picks up the new one
+        self.wakeup()
+
     def add_out_socket(self, client_socket):
         with self.socket_to_request_lock:
-            self.socket_to_request[client_socket] = []
+            self.socket_to_request.setdefault(client_socket, [])
+
+        if isinstance(client_socket, SharedMemoryChannel):
+            client_socket.on_space = self.wakeup
 
         self.sockets_out.append(client_socket)
 
+    def remove_socket(self, client_socket):
+        """
+        Stop watching a connection. Safe to call from any thread, the thread
+        lets go of it the next time around its loop and tells the network.
+        """
+        with self.socket_to_request_lock:
+            self.removed_sockets.append(client_socket)
+        self.wakeup()
+
+    def _handle_removals(self):
+        with self.socket_to_request_lock:
+            removed, self.removed_sockets = self.removed_sockets, []
+            for client_socket in removed:
+                self.outbound_requests -= len(self.socket_to_request.pop(client_socket, []))
+                self.pending_out_sockets.discard(client_socket)
+
+        for client_socket in removed:
+            for sockets in (self.sockets_in, self.sockets_out):
+                if client_socket in sockets:
+                    sockets.remove(client_socket)
+            self.readers.pop(client_socket, None)
+            self.write_cursors.pop(client_socket, None)
+            self.unpooled_channels.discard(client_socket)
+            self.write_interest.discard(client_socket)
+            self._unregister(client_socket)
+            self.network.released(client_socket)
+
+    def _unregister(self, client_socket):
+        """
+        Stop polling a socket. Implemented by the poll method specific
+        subclasses that keep a registration.
+        """
+        pass
+
     def close_all_sockets(self):
         for s in self.sockets_in + self.sockets_out:
             try:
@@ -324,6 +723,9 @@ class BaseCommunicationHandler(threading.Thread):
             except Exception, e:
                 Logger().error("Got error when closing socket: %s" % e)
 
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            os.close(fd)
+
     def _handle_readlist(self, readlist):
 
         for read_socket in readlist:
@@ -344,43 +746,107 @@ class BaseCommunicationHandler(threading.Thread):
                 except Exception, e:
                     Logger().error("_handle_readlist: Unknown error. Error was: %s" % e)
                     continue
+            elif read_socket is self.shared_memory_socket:
+                try:
+                    # _ is sender_address
+                    (doorbell, _) = read_socket.accept()
+                    channel = SharedMemoryChannel.accept(doorbell)
+
+                    self.network.t_in.add_in_socket(channel)
+                    self.network.t_out.add_out_socket(channel)
+
+                    # The channel joins the pool with its first message
+                    self.unpooled_channels.add(channel)
+                except Exception, e:
+                    Logger().error("_handle_readlist: Could not set up shared memory channel. Error was: %s" % e)
+                # The first message is read when the doorbell rings
+                continue
             else:
                 conn = read_socket
 
-            try:
-                rank, msg_type, tag, ack, comm_id, coll_class_id, raw_data = get_raw_message(conn, self.network.mpi.settings.SOCKET_RECEIVE_BYTECOUNT)
-            except MPIException, e:
+            if isinstance(conn, SharedMemoryChannel):
+                # The doorbell only tells that something happened. Once it is
+                # drained it will not ring again for data already in the ring,
+                # so everything there is read now.
+                while conn.ready():
+                    add_to_pool = conn in self.unpooled_channels
+                    if not self._receive_message(conn, add_to_pool):
+                        break
+                    self.unpooled_channels.discard(conn)
+                received = not conn.peer_closed
+            else:
+                received = self._receive_message(conn, add_to_pool)
+
+                # Whole messages left in the read buffer will not make the
+                # socket readable again, so they are handled now
+                reader = self.readers.get(conn)
+                while received and reader.has_message():
+                    received = self._receive_message(conn, False)
+
+            if not received:
                 # Broken connection is ok when shutdown is going on
                 if self.shutdown_event.is_set():
                     break # We don't care about incoming during shutdown
-                else:
-                    # TODO: We should check for a specific Exception thrown from get_raw_message to signify when other side has closed connection
-                    # We have no way of knowing whether other party has reached shutdown or this was indeed an error
-                    # so we just try listening to next socket
-                    continue
-            except Exception, e:
-                Logger().error("_handle_readlist: Unexpected error thrown from get_raw_message. Error was: %s" % e)
-                continue
 
-            # Now that we know the rank of sender we can add the socket to the pool
-            if add_to_pool:
-                self.network.socket_pool.add_accepted_socket(conn, rank)
+                # Otherwise the other side closed it, or is gone
+                self.network.disconnect.lost(conn)
 
-            # user messages have a cmd field larger than CMD_RAWTYPE
-            if msg_type >= constants.CMD_RAWTYPE:
-                try:
-                    with self.network.mpi.raw_data_lock:
-                        self.network.mpi.raw_data_queue.append( (rank, msg_type, tag, ack, comm_id, coll_class_id, raw_data) )
-                        self.network.mpi.raw_data_has_work.set()
-                        self.network.mpi.has_work_event.set()
-                except AttributeError, e:
-                    Logger().error("Strange error:%s" % e)
-                    raise e
-                except Exception, e:
-                    Logger().error("Strange error - Failed grabbing raw_data_lock! error:%s" % e)
-                    raise e
+    def _receive_message(self, conn, add_to_pool):
+        """
+        Read one message from a connection and pass it on to the MPI thread,
+        or with inline matching complete a matching receive directly.
+        Returns False if nothing could be read.
+        """
+        bytecount = self.network.mpi.settings.SOCKET_RECEIVE_BYTECOUNT
+        try:
+            if isinstance(conn, SharedMemoryChannel):
+                bytecount = conn.rx.size # No kernel buffer to go easy on, take all there is
+                rank, msg_type, tag, ack, comm_id, coll_header, raw_data = get_raw_message(conn, bytecount, self.network.mpi.rendezvous.receive_buffer)
+            else:
+                reader = self.readers.get(conn)
+                if reader is None:
+                    reader = self.readers[conn] = utils.MessageReader(conn, bytecount=bytecount)
+                rank, msg_type, tag, ack, comm_id, coll_header, raw_data = reader.read_message(self.network.mpi.rendezvous.receive_buffer)
+        except MPIException, e:
+            # TODO: We should check for a specific Exception thrown from get_raw_message to signify when other side has closed connection
+            # We have no way of knowing whether other party has reached shutdown or this was indeed an error
+            # so we just try listening to next socket
+            self.readers.pop(conn, None)
+            return False
+        except Exception, e:
+            Logger().error("_handle_readlist: Unexpected error thrown from get_raw_message. Error was: %s" % e)
+            return False
+
+        # Now that we know the rank of sender we can add the socket to the pool.
+        # Extra connections made for stripes stay out of it, nothing but
+        # stripes is ever sent over them.
+        if add_to_pool and coll_header[0] != constants.RENDEZVOUS_STRIPE:
+            self.network.socket_pool.add_accepted_socket(conn, rank)
+
+        # user messages have a cmd field larger than CMD_RAWTYPE
+        if msg_type >= constants.CMD_RAWTYPE:
+            step = coll_header[0]
+            if tag == constants.TAG_CREDIT:
+                self.network.flow_control.returned(rank, raw_data)
+            elif tag == constants.TAG_PREWARM:
+                pass # Only there to get the connection into the pool
+            elif tag == constants.TAG_DISCONNECT:
+                self.network.disconnect.received(conn, rank, raw_data)
+            elif step in constants.RENDEZVOUS_STEPS:
+                if step != constants.RENDEZVOUS_RTS or self.inline_matching:
+                    # Only announcements are matched, the replies and
+                    # payloads of large messages are handled right here
+                    self.network.mpi.rendezvous.handle( (rank, msg_type, tag, ack, comm_id, coll_header, raw_data) )
+                else:
+                    self.network.mpi.add_work("message", (rank, msg_type, tag, ack, comm_id, coll_header, raw_data))
+            elif self.inline_matching and tag not in constants.COLLECTIVE_TAGS:
+                self.network.mpi.deliver_message( (rank, tag, ack, comm_id, msg_type, raw_data) )
             else:
-                self.network.mpi.handle_system_message(rank, msg_type, raw_data, conn)
+                self.network.mpi.add_work("message", (rank, msg_type, tag, ack, comm_id, coll_header, raw_data))
+        else:
+            self.network.mpi.handle_system_message(rank, msg_type, raw_data, conn)
+
+        return True
 
     def _handle_writelist(self, writelist):
         for write_socket in writelist:
@@ -392,36 +858,54 @@ class BaseCommunicationHandler(threading.Thread):
                 except Exception as e:
                     #Logger().debug("rank:%i trying to find %s on socket_to_request:%s" % (self.rank, write_socket, self.socket_to_request ) )
                     raise e
-            for request in request_list:
-                if request.status == "cancelled":
-                    removal.append(request)
-                elif request.status == "new":
-                        # Send the data on the socket
-                    try:
-                        if request.multi:
-                            utils.robust_send(write_socket,request.header)
-                            utils.robust_send_multi(write_socket,request.data)
-                        else:
-                            utils.robust_send_multi(write_socket,[request.header]+request.data)
-                    except socket.error, e:
-                        Logger().error("got:%s for socket:%s with data:%s" % (e,write_socket,request.data ) )
-                        # TODO: Make sure we really want to continue here, instead of reacting
-                        # Send went wrong, do not update, but hope for better luck next time
-                        continue
-                        #raise e
-                    except Exception, e:
-                        Logger().error("Other exception got:%s for socket:%s with header:%s payload:%s" % (e,write_socket,request.header, request.data ) )
-                        # Send went wrong, do not update, but hope for better luck next time
-                        raise e
-                    
+            position = 0
+            while position < len(request_list):
+                cursor = self.write_cursors.get(write_socket)
+                if cursor is None:
+                    batch, position = self._gather_batch(request_list, position, removal)
+                    if not batch:
+                        break
+                else:
+                    # A batch that is partially on the wire has to be finished
+                    # even if requests in it were cancelled meanwhile, or the
+                    # stream is corrupted
+                    batch = cursor[0]
+                    position = request_list.index(batch[-1]) + 1
+
+                try:
+                    completed = self._write_batch(write_socket, batch)
+                except socket.error, e:
+                    if self.shutdown_event.is_set():
+                        # The other side is gone, there is no next time
+                        self.network.disconnect.lost(write_socket)
+                        break
+                    Logger().error("got:%s for socket:%s with data:%s" % (e,write_socket,[r.data for r in batch] ) )
+                    # TODO: Make sure we really want to continue here, instead of reacting
+                    # Send went wrong, do not update, but hope for better luck next time
+                    break
+                except Exception, e:
+                    Logger().error("Other exception got:%s for socket:%s with headers:%s payloads:%s" % (e,write_socket,[r.header for r in batch], [r.data for r in batch] ) )
+                    # Send went wrong, do not update, but hope for better luck next time
+                    raise e
+
+                if not completed:
+                    # The socket buffer is full. Move on to the other
+                    # sockets and continue from the cursor when this one
+                    # becomes writable again.
+                    break
+
+                for request in batch:
                     removal.append(request)
-                    
-                    if request.acknowledge:
-                        request.update("unacked") # update status to wait for acknowledgement
+
+                    if request.status == constants.REQUEST_CANCELLED:
+                        pass
+                    elif request.acknowledge:
+                        request.update(constants.REQUEST_UNACKED) # update status to wait for acknowledgement
                     else:
-                        request.update("ready") # update status and signal anyone waiting on this request
-                else:
-                    pass
+                        request.update(constants.REQUEST_READY) # update status and signal anyone waiting on this request
+
+                    if request.tag == constants.TAG_DISCONNECT:
+                        self.network.disconnect.written(write_socket, request)
 
             # Remove the requests (messages) that was successfully sent from the list for that socket
             if removal:
@@ -432,80 +916,133 @@ class BaseCommunicationHandler(threading.Thread):
                         live_requests.remove(req)
                     self.outbound_requests -= removed
 
-    def run(self):
-        emptyreads = 0
-        emptywrites = 0
+                    # Nothing more to send means no more polling for writability
+                    if not live_requests:
+                        self.pending_out_sockets.discard(write_socket)
+
+    def _gather_batch(self, request_list, position, removal):
+        """
+        Collect the requests from position on that can be written together.
+        Consecutive small requests are batched up to SEND_BATCH_LIMIT bytes,
+        a request larger than SEND_COALESCE_LIMIT goes alone. Cancelled
+        requests passed on the way are added to removal. Returns the batch
+        and the position after it.
+        """
+        batch = []
+        batch_size = 0
+        while position < len(request_list):
+            request = request_list[position]
+            if request.status == constants.REQUEST_CANCELLED:
+                removal.append(request)
+            elif request.status == constants.REQUEST_NEW:
+                size = len(request.header) + sum(len(segment) for segment in request.data)
+                if batch and (size > utils.SEND_COALESCE_LIMIT or batch_size + size > utils.SEND_BATCH_LIMIT):
+                    break
+
+                batch.append(request)
+                batch_size += size
+                if size > utils.SEND_COALESCE_LIMIT:
+                    position += 1
+                    break
+            position += 1
+
+        return batch, position
+
+    def _write_batch(self, write_socket, batch):
+        """
+        Write as much of a batch of requests as the socket takes without
+        blocking. Returns True when the whole batch has been written.
+        Otherwise the position is kept in the write cursor of the socket, a
+        [batch, segments, segment index, byte offset] list, so the next
+        call continues where this one stopped.
+        """
+        cursor = self.write_cursors.get(write_socket)
+        if cursor is None:
+            if len(batch) == 1:
+                # Header and payload segments are handed over together so
+                # small ones can be coalesced into a single send call
+                request = batch[0]
+                segments = utils.gather_segments([request.header]+request.data)
+            else:
+                # Only small requests are batched, they all go out in one buffer
+                segments = []
+                for request in batch:
+                    segments.append(request.header)
+                    segments.extend(request.data)
+                segments = utils.gather_segments(segments, utils.SEND_BATCH_LIMIT)
+            cursor = [batch, segments, 0, 0]
+
+        segments = cursor[1]
+        cursor[2], cursor[3] = utils.send_segments(write_socket, segments, cursor[2], cursor[3])
+
+        if cursor[2] == len(segments):
+            self.write_cursors.pop(write_socket, None)
+            return True
+
+        self.write_cursors[write_socket] = cursor
+        return False
 
+    def run(self):
         # Stall until network thread type is set
         # TODO: This hack should be refactored.
         while not self.type in ("combo","in","out"):
             time.sleep(0.001)
 
+        # All the loops below block in the poller without a timeout. Anything
+        # that should make the thread look again (a queued send, a new socket,
+        # shutdown) writes to the wakeup pipe.
         if self.type == "combo":
 
             # Main loop
             while not self.shutdown_event.is_set():
+                if self.removed_sockets:
+                    self._handle_removals()
+                self._update_write_interest()
+
                 # _ is errorlist
-                (in_list, out_list, _) = self.select_combo()
+                (in_list, out_list, _) = self.select_combo(self._poll_timeout())
                 self._handle_readlist(in_list)
-
-                # Only look at outbound if there are any
-                # (we don't take the socket_to_request_lock but worst case is we
-                # might miss postpone a send for one iteration or handle_writelist
-                # once too much, both are acceptable compared to locking)
-                if self.outbound_requests > 0:
-                    self._handle_writelist(out_list)
-
-
-                # NOTE:
-                # This microsleep is to avoid busy waiting which starves the other threads
-                # especially on a single node (localhost testing) this has significant effect
-                # but also on the cluster it halves the time required for the single module!
-                # And furthermore increases max transferrate by 25% to about 40MB/s!
-                # Also it seems to improve the speed of high computation-to-communication like
-                # in the Monte Carlo Pi application where 20% speed increase has been observed
-                time.sleep(0.00001)
+                self._handle_writelist(out_list + self.ready_channels)
 
         elif self.type == "in":
-            #Logger().debug("- - in")
             while not self.shutdown_event.is_set():
-                #Logger().debug("Select in - for base communication handler type:%s" %(self.type))
-                (in_list, _, _) = self.select_in()
-
-                #if not in_list:
-                #    emptyreads += 1
-
+                if self.removed_sockets:
+                    self._handle_removals()
+                (in_list, _, _) = self.select_in(None)
                 self._handle_readlist(in_list)
-                time.sleep(0.00001)
 
         elif self.type == "out":
-            #Logger().debug("- - out")
             while not self.shutdown_event.is_set():
-                if self.outbound_requests > 0:
-                    (_, out_list, _) = self.select_out()
-                    #if not out_list:
-                    #    emptywrites += 1
-                    self._handle_writelist(out_list)
-
-                time.sleep(0.00001)
-
+                if self.removed_sockets:
+                    self._handle_removals()
+                self._update_write_interest()
+                (_, out_list, _) = self.select_out(self._poll_timeout())
+                self._handle_writelist(out_list + self.ready_channels)
 
         # The shutdown events is called, so we're finishing the network. This means
         # flushing all the send jobs we have and then closing the sockets.
         if self.type in ("combo","out"):
-            while self.socket_to_request:
-                (_, out_list, _) = self.select_out()
-                #Logger().debug("rank:%i calling final HW for out_list:%s" % (self.rank, out_list ) )
-                #Logger().debug("rank:%i calling final HW for %i sockets" % (self.rank, len(out_list) ) )
-                self._handle_writelist(out_list)
+            while True:
+                # Whatever is queued on connections let go of is dropped
+                if self.removed_sockets:
+                    self._handle_removals()
+
+                with self.socket_to_request_lock:
+                    removal = []
+                    for wsocket in self.socket_to_request:
+                        if not self.socket_to_request[wsocket]:
+                            removal.append(wsocket)
 
-                removal = []
-                for wsocket in self.socket_to_request:
-                    if not self.socket_to_request[wsocket]:
-                        removal.append(wsocket)
+                    for r in removal:
+                        del self.socket_to_request[r]
 
-                for r in removal:
-                    del self.socket_to_request[r]
+                if not self.socket_to_request:
+                    break
+
+                self._update_write_interest()
+                (_, out_list, _) = self.select_out(self._poll_timeout())
+                #Logger().debug("rank:%i calling final HW for out_list:%s" % (self.rank, out_list ) )
+                self._handle_writelist(out_list + self.ready_channels)
 
 class CommunicationHandlerEpoll(BaseCommunicationHandler):
     def __init__(self, *args, **kwargs):
@@ -518,54 +1055,83 @@ class CommunicationHandlerEpoll(BaseCommunicationHandler):
         self.in_fd_to_socket = {}
         self.out_fd_to_socket = {}
 
+        # The event mask each file descriptor is currently registered with.
+        # Sockets are added from several threads so the lock guards the
+        # read-modify-write of the masks.
+        self.fd_events = {}
+        self.fd_events_lock = threading.Lock()
+
+        self.epoll.register(self.wakeup_fd, select.EPOLLIN)
+
+    def _register(self, client_socket, events):
+        """
+        Register or modify the event mask for a socket. A socket can only be
+        registered once per epoll object, so read and write interest share
+        one registration.
+        """
+        fileno = client_socket.fileno()
+        if fileno in self.fd_events:
+            self.epoll.modify(fileno, events)
+        else:
+            self.epoll.register(fileno, events) # Default mode is level triggered
+        self.fd_events[fileno] = events
+
     def add_in_socket(self, client_socket):
         super(CommunicationHandlerEpoll, self).add_in_socket(client_socket)
         self.in_fd_to_socket[client_socket.fileno()] = client_socket
-        self.epoll.register(client_socket, select.EPOLLIN) # Default mode is level triggered
-        #self.epoll.register(client_socket, select.EPOLLIN | select.EPOLLET) # Edge triggered
+        with self.fd_events_lock:
+            self._register(client_socket, self.fd_events.get(client_socket.fileno(), 0) | select.EPOLLIN)
 
     def add_out_socket(self, client_socket):
         super(CommunicationHandlerEpoll, self).add_out_socket(client_socket)
         self.out_fd_to_socket[client_socket.fileno()] = client_socket
-        self.epoll.register(client_socket, select.EPOLLOUT)
 
-    def select_combo(self):
+    def _unregister(self, client_socket):
+        fileno = client_socket.fileno()
+        if self.in_fd_to_socket.get(fileno) is client_socket:
+            del self.in_fd_to_socket[fileno]
+        if self.out_fd_to_socket.get(fileno) is client_socket:
+            del self.out_fd_to_socket[fileno]
+        with self.fd_events_lock:
+            if fileno in self.fd_events:
+                self.epoll.unregister(fileno)
+                del self.fd_events[fileno]
+
+    def _set_write_interest(self, client_socket, interested):
+        with self.fd_events_lock:
+            events = self.fd_events.get(client_socket.fileno(), 0)
+            if interested:
+                events |= select.EPOLLOUT
+            else:
+                events &= ~select.EPOLLOUT
+            self._register(client_socket, events)
+
+    def _poll(self, timeout):
         in_list = []
         out_list = []
-        error_list = []
-
-        events = self.epoll.poll(1)
-        #events = self.epoll.poll()
-        for fileno, event in events:
-            if event & select.EPOLLIN:
-                in_list.append(self.in_fd_to_socket.get(fileno))
-            if event & select.EPOLLOUT:
-                out_list.append(self.out_fd_to_socket.get(fileno))
-
-        return (in_list, out_list, error_list)
 
-    def select_in(self):
-        in_list = []
-        error_list = []
+        if timeout is None:
+            timeout = -1
 
-        events = self.epoll.poll(0.001)
-        for fileno, event in events:
-            if event & select.EPOLLIN:
-                in_list.append(self.in_fd_to_socket.get(fileno))
+        for fileno, event in self.epoll.poll(timeout):
+            if fileno == self.wakeup_fd:
+                self._drain_wakeup()
+                continue
+            if event & select.EPOLLIN and fileno in self.in_fd_to_socket:
+                in_list.append(self.in_fd_to_socket[fileno])
+            if event & select.EPOLLOUT and fileno in self.out_fd_to_socket:
+                out_list.append(self.out_fd_to_socket[fileno])
 
-        return (in_list, [], error_list)
+        return (in_list, out_list, [])
 
-    def select_out(self):
-        out_list = []
-        error_list = []
+    def select_combo(self, timeout):
+        return self._poll(timeout)
 
-        #events = self.epoll.poll(1)
-        events = self.epoll.poll()
-        for fileno, event in events:
-            if event & select.EPOLLOUT:
-                out_list.append(self.out_fd_to_socket.get(fileno))
+    def select_in(self, timeout):
+        return self._poll(timeout)
 
-        return ([], out_list, error_list)
+    def select_out(self, timeout):
+        return self._poll(timeout)
 
 
 class CommunicationHandlerPoll(BaseCommunicationHandler):
@@ -579,75 +1145,107 @@ class CommunicationHandlerPoll(BaseCommunicationHandler):
         self.in_fd_to_socket = {}
         self.out_fd_to_socket = {}
 
+        # The event mask each file descriptor is currently registered with.
+        # Sockets are added from several threads so the lock guards the
+        # read-modify-write of the masks.
+        self.fd_events = {}
+        self.fd_events_lock = threading.Lock()
+
+        self.poll.register(self.wakeup_fd, select.POLLIN)
+
+    def _register(self, client_socket, events):
+        # Registering an already registered descriptor replaces its mask
+        self.poll.register(client_socket, events)
+        self.fd_events[client_socket.fileno()] = events
+
     def add_in_socket(self, client_socket):
-        super(CommunicationHandlerPoll, self).add_in_socket(client_socket)
         self.in_fd_to_socket[client_socket.fileno()] = client_socket
-        self.poll.register(client_socket, select.POLLIN)
+        with self.fd_events_lock:
+            self._register(client_socket, self.fd_events.get(client_socket.fileno(), 0) | select.POLLIN)
+        super(CommunicationHandlerPoll, self).add_in_socket(client_socket)
 
     def add_out_socket(self, client_socket):
         super(CommunicationHandlerPoll, self).add_out_socket(client_socket)
         self.out_fd_to_socket[client_socket.fileno()] = client_socket
-        self.poll.register(client_socket, select.POLLOUT)
-
-    def select_combo(self):
-        in_list = []
-        out_list = []
-        error_list = []
 
-        events = self.poll.poll(0.00001)
-        #events = self.poll.poll()
-        for fileno, event in events:
-            if event & select.POLLIN:
-                in_list.append(self.in_fd_to_socket.get(fileno))
-            if event & select.POLLOUT:
-                out_list.append(self.out_fd_to_socket.get(fileno))
+    def _unregister(self, client_socket):
+        fileno = client_socket.fileno()
+        if self.in_fd_to_socket.get(fileno) is client_socket:
+            del self.in_fd_to_socket[fileno]
+        if self.out_fd_to_socket.get(fileno) is client_socket:
+            del self.out_fd_to_socket[fileno]
+        with self.fd_events_lock:
+            if fileno in self.fd_events:
+                self.poll.unregister(fileno)
+                del self.fd_events[fileno]
+
+    def _set_write_interest(self, client_socket, interested):
+        with self.fd_events_lock:
+            events = self.fd_events.get(client_socket.fileno(), 0)
+            if interested:
+                events |= select.POLLOUT
+            else:
+                events &= ~select.POLLOUT
 
-        return (in_list, out_list, error_list)
+            if events:
+                self._register(client_socket, events)
+            else:
+                self.poll.unregister(client_socket)
+                del self.fd_events[client_socket.fileno()]
 
-    def select_in(self):
+    def _poll(self, timeout):
         in_list = []
-        error_list = []
+        out_list = []
 
-        events = self.poll.poll(0.00001)
-        for fileno, event in events:
-            if event & select.POLLIN:
-                in_list.append(self.in_fd_to_socket.get(fileno))
+        if timeout is not None:
+            timeout = timeout * 1000 # poll wants milliseconds
 
-        return (in_list, [], error_list)
+        for fileno, event in self.poll.poll(timeout):
+            if fileno == self.wakeup_fd:
+                self._drain_wakeup()
+                continue
+            if event & select.POLLIN and fileno in self.in_fd_to_socket:
+                in_list.append(self.in_fd_to_socket[fileno])
+            if event & select.POLLOUT and fileno in self.out_fd_to_socket:
+                out_list.append(self.out_fd_to_socket[fileno])
 
-    def select_out(self):
-        out_list = []
-        error_list = []
+        return (in_list, out_list, [])
 
-        #events = self.poll.poll(1)
-        events = self.poll.poll()
-        for fileno, event in events:
-            if event & select.POLLOUT:
-                out_list.append(self.out_fd_to_socket.get(fileno))
+    def select_combo(self, timeout):
+        return self._poll(timeout)
 
-        return ([], out_list, error_list)
+    def select_in(self, timeout):
+        return self._poll(timeout)
+
+    def select_out(self, timeout):
+        return self._poll(timeout)
 
 class CommunicationHandlerSelect(BaseCommunicationHandler):
     """
     This is a single thread doing both in and out or there are two threaded instances one for each
     """
-    def select_combo(self):
-        try:
-            #return select.select( self.sockets_in, self.sockets_out, self.sockets_in + self.sockets_out)
-            return select.select( self.sockets_in, self.sockets_out, self.sockets_in + self.sockets_out, 1)
-        except Exception, e:
-            Logger().error("Network-thread (%s) Got exception: %s of type: %s" % (self.type, e, type(e)) )
+    def _set_write_interest(self, client_socket, interested):
+        # The write list is handed to select as is, see _select
+        pass
 
-    def select_in(self):
+    def _select(self, in_list, out_list, timeout):
         try:
-            #return select.select( self.sockets_in, [], self.sockets_in)
-            return select.select( self.sockets_in, [], self.sockets_in, 1)
+            (in_list, out_list, error_list) = select.select( [self.wakeup_fd] + in_list, out_list, in_list + out_list, timeout)
         except Exception, e:
             Logger().error("Network-thread (%s) Got exception: %s of type: %s" % (self.type, e, type(e)) )
+            return ([], [], [])
 
-    def select_out(self):
-        try:
-            #return select.select( [], self.sockets_out, self.sockets_out)
-            return select.select( [], self.sockets_out, self.sockets_out, 1)
-        except Exception, e:
-            Logger().error("Network-thread (%s) Got exception: %s of type: %s" % (self.type, e, type(e)) )
+        if self.wakeup_fd in in_list:
+            self._drain_wakeup()
+            in_list.remove(self.wakeup_fd)
+
+        return (in_list, out_list, error_list)
+
+    def select_combo(self, timeout):
+        return self._select(self.sockets_in, list(self.write_interest), timeout)
+
+    def select_in(self, timeout):
+        return self._select(self.sockets_in, [], timeout)
+
+    def select_out(self, timeout):
+        return self._select([], list(self.write_interest), timeout)
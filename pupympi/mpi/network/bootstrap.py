@@ -0,0 +1,296 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Bootstrap of a job: collecting the contact information of all the
+processes and handing the complete table to every one of them.
+
+Every process phones in to mpirun with a record of its contact information,
+including the port of a bootstrap socket it listens on. mpirun accepts the
+records from all the processes at once with a poller, and once it has them
+all it sends the table to rank 0 only. From there the table is scattered
+down a binomial tree. A process responsible for the ranks [lo, hi) passes
+the table on to its children in that range, each of them responsible for a
+part of it. mpirun sends a single message and no process sends more than
+log2(N).
+
+Records and tables are encoded with struct in network byte order rather
+than pickled. Host names are stored once in the table. When a packed job
+is resumed the states of the processes go along with the table, each
+subtree only getting the states of its own ranks.
+"""
+import socket, struct, select, errno, time
+
+from mpi.exceptions import MPIException
+from mpi.network import utils
+
+LENGTH_FORMAT = "!l"
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+# Seconds mpirun waits for all the processes to phone in
+STARTUP_TIMEOUT = 300
+
+class _Reader(object):
+    """
+    Walks through an encoded record or table.
+    """
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def long(self):
+        value = struct.unpack_from(LENGTH_FORMAT, self.data, self.offset)[0]
+        self.offset += LENGTH_SIZE
+        return value
+
+    def string(self):
+        length = self.long()
+        if length < 0:
+            return None
+        value = str(self.data[self.offset:self.offset+length])
+        self.offset += length
+        return value
+
+def _pack_string(value):
+    if value is None:
+        return struct.pack(LENGTH_FORMAT, -1)
+    return struct.pack(LENGTH_FORMAT, len(value)) + value
+
+def pack_record(rank, hostname, port, unix_filename, bootstrap_port, security_component, availability, header_version):
+    """
+    Encode the contact information a process sends to mpirun. The
+    availability is a dict of system command ids to booleans. The header
+    version (see mpi.network.utils) is handed on to the utilities.
+    """
+    parts = [struct.pack("!llll", rank, port, bootstrap_port, header_version), _pack_string(hostname), _pack_string(unix_filename), _pack_string(security_component)]
+    parts.append(struct.pack(LENGTH_FORMAT, len(availability)))
+    for (command, available) in availability.items():
+        parts.append(struct.pack("!l?", command, available))
+    return "".join(parts)
+
+def unpack_record(data):
+    """
+    Decode a record. Returns (rank, hostname, port, unix_filename,
+    bootstrap_port, security_component, availability, header_version).
+    """
+    (rank, port, bootstrap_port, header_version) = struct.unpack_from("!llll", data)
+    reader = _Reader(data, struct.calcsize("!llll"))
+    hostname = reader.string()
+    unix_filename = reader.string()
+    security_component = reader.string()
+
+    availability = {}
+    for _ in range(reader.long()):
+        (command, available) = struct.unpack_from("!l?", data, reader.offset)
+        reader.offset += struct.calcsize("!l?")
+        availability[command] = available
+
+    return rank, hostname, port, unix_filename, bootstrap_port, security_component, availability, header_version
+
+def pack_table(contacts):
+    """
+    Encode the table of (hostname, port, unix_filename, bootstrap_port) for
+    all ranks, in rank order.
+    """
+    hosts = []
+    host_index = {}
+    entries = []
+    for (hostname, port, unix_filename, bootstrap_port) in contacts:
+        if hostname not in host_index:
+            host_index[hostname] = len(hosts)
+            hosts.append(hostname)
+        entries.append(struct.pack("!lll", host_index[hostname], port, bootstrap_port) + _pack_string(unix_filename))
+
+    parts = [struct.pack(LENGTH_FORMAT, len(hosts))]
+    parts.extend(_pack_string(hostname) for hostname in hosts)
+    parts.append(struct.pack(LENGTH_FORMAT, len(entries)))
+    parts.extend(entries)
+    return "".join(parts)
+
+def pack_message(lo, hi, table, sessions=None):
+    """
+    Encode the message for the process responsible for the ranks [lo, hi),
+    the already encoded table followed by the states of those ranks if the
+    job is resumed. sessions is indexed by rank.
+    """
+    parts = [struct.pack("!ll?", lo, hi, sessions is not None), _pack_string(table)]
+    if sessions is not None:
+        parts.extend(_pack_string(sessions[rank]) for rank in range(lo, hi))
+    return "".join(parts)
+
+def unpack_message(data):
+    """
+    Decode a message. Returns (lo, hi, table, contacts, sessions) where table
+    is the encoded table for passing on, contacts the decoded table and
+    sessions a dict of the states of the ranks in [lo, hi), or None if the
+    job is not resumed.
+    """
+    (lo, hi, resumed) = struct.unpack_from("!ll?", data)
+    reader = _Reader(data, struct.calcsize("!ll?"))
+    table = reader.string()
+
+    sessions = None
+    if resumed:
+        sessions = dict( (rank, reader.string()) for rank in range(lo, hi) )
+
+    reader = _Reader(table)
+    hosts = [ reader.string() for _ in range(reader.long()) ]
+    contacts = []
+    for _ in range(reader.long()):
+        (host, port, bootstrap_port) = struct.unpack_from("!lll", table, reader.offset)
+        reader.offset += struct.calcsize("!lll")
+        contacts.append( (hosts[host], port, reader.string(), bootstrap_port) )
+
+    return lo, hi, table, contacts, sessions
+
+def children(lo, hi):
+    """
+    The children of the process with rank lo in a binomial tree over the
+    ranks [lo, hi), as (child, child_hi) pairs with the largest subtree
+    first.
+    """
+    result = []
+    step = 1
+    while step < hi - lo:
+        step *= 2
+    step /= 2
+
+    while step >= 1:
+        if lo + step < hi:
+            result.append( (lo + step, hi) )
+            hi = lo + step
+        step /= 2
+    return result
+
+def send_blob(client_socket, data):
+    utils.robust_send(client_socket, struct.pack(LENGTH_FORMAT, len(data)) + data)
+
+def receive_blob(client_socket):
+    """
+    Receive a length prefixed blob from a blocking socket.
+    """
+    def receive_fixed(length):
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            received_now = client_socket.recv_into(view[received:], length - received)
+            if received_now == 0:
+                raise MPIException("Connection closed during bootstrap (still missing %d bytes)" % (length - received))
+            received += received_now
+        return data
+
+    length = struct.unpack(LENGTH_FORMAT, str(receive_fixed(LENGTH_SIZE)))[0]
+    return str(receive_fixed(length))
+
+def send_message(hostname, bootstrap_port, message):
+    """
+    Connect to the bootstrap socket of a process and hand it a message.
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect( (hostname, bootstrap_port) )
+        send_blob(client_socket, message)
+    finally:
+        client_socket.close()
+
+def scatter(lo, hi, table, contacts, sessions):
+    """
+    Pass the table on to the children of the process responsible for the
+    ranks [lo, hi).
+    """
+    for (child, child_hi) in children(lo, hi):
+        (hostname, _, _, bootstrap_port) = contacts[child]
+        send_message(hostname, bootstrap_port, pack_message(child, child_hi, table, sessions))
+
+def collect_records(server_socket, count, timeout=STARTUP_TIMEOUT):
+    """
+    Accept count processes phoning in on a listening socket and return their
+    records as decoded by unpack_record, in rank order. All connections are
+    served at once with a poller so no process waits for another to finish.
+    An MPIException naming the missing ranks is raised if they have not all
+    phoned in within timeout seconds.
+    """
+    if hasattr(select, "epoll"):
+        poller = select.epoll()
+        READ = select.EPOLLIN
+        scale = 1 # epoll takes the timeout in seconds
+    else:
+        poller = select.poll()
+        READ = select.POLLIN
+        scale = 1000 # and poll in milliseconds
+
+    server_socket.setblocking(0)
+    poller.register(server_socket.fileno(), READ)
+
+    connections = {} # file descriptor -> [socket, data received so far]
+    records = {}
+    deadline = time.time() + timeout
+    try:
+        while len(records) < count:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                missing = [ rank for rank in range(count) if rank not in records ]
+                raise MPIException("Timed out after %d seconds waiting for ranks %s to phone in" % (timeout, missing))
+
+            for (fd, _) in poller.poll(remaining * scale):
+                if fd == server_socket.fileno():
+                    # Take every connection waiting in the backlog
+                    while True:
+                        try:
+                            (conn, _) = server_socket.accept()
+                        except socket.error, e:
+                            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                break
+                            raise
+                        conn.setblocking(0)
+                        connections[conn.fileno()] = [conn, ""]
+                        poller.register(conn.fileno(), READ)
+                    continue
+
+                entry = connections[fd]
+                try:
+                    data = entry[0].recv(65536)
+                except socket.error, e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    raise
+                if not data:
+                    raise MPIException("A process closed its connection before sending its contact information")
+
+                entry[1] += data
+                if len(entry[1]) < LENGTH_SIZE:
+                    continue
+                length = struct.unpack_from(LENGTH_FORMAT, entry[1])[0]
+                if len(entry[1]) < LENGTH_SIZE + length:
+                    continue
+
+                record = unpack_record(entry[1][LENGTH_SIZE:LENGTH_SIZE+length])
+                records[record[0]] = record
+
+                poller.unregister(fd)
+                entry[0].close()
+                del connections[fd]
+    finally:
+        for (conn, _) in connections.values():
+            conn.close()
+        poller.unregister(server_socket.fileno())
+        if hasattr(poller, "close"): # Only epoll holds a file descriptor
+            poller.close()
+        server_socket.setblocking(1)
+
+    return [ records[rank] for rank in sorted(records) ]
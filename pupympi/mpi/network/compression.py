@@ -0,0 +1,161 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Optional compression of point to point payloads.
+
+A compressed payload is marked in the msg_type field of the header: the id
+of the codec times constants.CMD_COMPRESSED is added to the msg_type of the
+uncompressed payload. The receiver takes it off again before deserializing,
+so everything above the network layer sees the original msg_type.
+
+Codecs are registered by name and id. The id travels in the header so it
+must be the same on all ranks, which means a codec has to be registered
+on import of a settings module or before MPI() is called. zlib is built in.
+"""
+import zlib
+
+from mpi.exceptions import MPIException
+from mpi import constants
+
+# codec id -> (name, compressor factory, decompress function)
+codecs = {}
+codec_ids = {} # name -> codec id
+
+# Once a payload did not compress well enough the next few payloads are sent
+# as they are without trying. The number doubles with every further poor
+# result, up to this many.
+MAX_BYPASS = 64
+
+def register_codec(name, codec_id, compressobj, decompress):
+    """
+    Make a codec available under a name. compressobj is called without
+    arguments and must return an object with compress(data) and flush()
+    like the ones from zlib.compressobj, decompress is called with the
+    whole compressed payload and returns the original bytes.
+    """
+    if not 0 < codec_id < 128:
+        raise MPIException("Codec ids must be between 1 and 127")
+    if codec_id in codecs and codecs[codec_id][0] != name:
+        raise MPIException("Codec id %d is already used by %s" % (codec_id, codecs[codec_id][0]))
+
+    codecs[codec_id] = (name, compressobj, decompress)
+    codec_ids[name] = codec_id
+
+# Level 1 since the point is to spend less time on the wire, not on compressing
+register_codec("zlib", 1, lambda: zlib.compressobj(1), zlib.decompress)
+
+def is_compressed(msg_type):
+    return msg_type is not None and msg_type >= constants.CMD_COMPRESSED
+
+def decompress(raw_data, msg_type):
+    """
+    Undo the compression of a received payload. Returns the payload and the
+    msg_type it had before compression. Anything not compressed is returned
+    as it is.
+    """
+    if not is_compressed(msg_type):
+        return raw_data, msg_type
+
+    codec_id = msg_type / constants.CMD_COMPRESSED
+    try:
+        decompress_function = codecs[codec_id][2]
+    except KeyError:
+        raise MPIException("Received a payload compressed with unknown codec id %d" % codec_id)
+
+    if isinstance(raw_data, bytearray):
+        raw_data = buffer(raw_data)
+
+    return decompress_function(raw_data), msg_type % constants.CMD_COMPRESSED
+
+class Compressor(object):
+    """
+    Compresses the payloads sent on one communicator.
+
+    Payloads below min_size are not worth the trouble. A payload that does
+    not shrink to max_ratio of its size is sent uncompressed, and the
+    following payloads are sent uncompressed without trying, so a stream of
+    incompressible data (typically numpy arrays of floats) costs little.
+    """
+    def __init__(self, codec, min_size, max_ratio):
+        try:
+            self.codec_id = codec_ids[codec]
+        except KeyError:
+            raise MPIException("Unknown compression codec %s" % codec)
+
+        self.codec = codec
+        self.compressobj = codecs[self.codec_id][1]
+        self.min_size = min_size
+        self.max_ratio = max_ratio
+
+        self.bypass = 0 # Payloads left to send without trying
+        self.bypass_length = 1 # How many to skip after the next poor result
+
+        # Totals for payloads that were tried
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        The compressor the settings ask for, or None if compression is off.
+        """
+        codec = getattr(settings, "COMPRESSION", None)
+        if not codec:
+            return None
+        return cls(codec, settings.COMPRESSION_MIN_SIZE, settings.COMPRESSION_MAX_RATIO)
+
+    def compress(self, segments, cmd, length):
+        """
+        Compress a list of serialized segments with a combined size of
+        length bytes. Returns (segments, cmd, length) for what should be
+        sent, the input itself if compression does not pay off.
+        """
+        if length < self.min_size:
+            return segments, cmd, length
+
+        if self.bypass:
+            self.bypass -= 1
+            return segments, cmd, length
+
+        compressor = self.compressobj()
+        parts = []
+        for segment in segments:
+            if isinstance(segment, bytearray):
+                segment = buffer(segment)
+            parts.append(compressor.compress(segment))
+        parts.append(compressor.flush())
+        compressed = "".join(parts)
+
+        self.bytes_in += length
+        self.bytes_out += len(compressed)
+
+        if len(compressed) > length * self.max_ratio:
+            self.bypass = self.bypass_length
+            self.bypass_length = min(self.bypass_length * 2, MAX_BYPASS)
+            return segments, cmd, length
+
+        self.bypass_length = 1
+        return [compressed], cmd + self.codec_id * constants.CMD_COMPRESSED, len(compressed)
+
+    def ratio(self):
+        """
+        Compressed size over original size for all payloads tried so far.
+        """
+        if not self.bytes_in:
+            return 1.0
+        return float(self.bytes_out) / self.bytes_in
@@ -0,0 +1,229 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Closing connections between processes without losing messages.
+
+The socket pool only holds so many connections (see
+mpi.network.socketpool). A connection it lets go of, or one of two
+connections made by a pair of processes at the same time, is closed with a
+drain handshake of TAG_DISCONNECT messages:
+
+ * Each side sends CLOSING after whatever was queued on the connection
+   before it. Nothing but REPLY follows it.
+ * Reading CLOSING means everything the other side sent has been read, and
+   is answered with REPLY (along with CLOSING if it was not sent yet).
+ * A side closes the connection once it has written its REPLY and read the
+   other one. By then both sides have read all there was to read.
+
+While a pooled connection is being closed, messages for the process at the
+other end are parked here and sent over a new connection once the close is
+complete. That way they can not overtake messages still on the old one. A
+connection that breaks without the handshake is let go of right away.
+"""
+import threading, struct, weakref
+
+from mpi import constants
+from mpi.network import utils
+
+FLAGS_FORMAT = "l"
+
+CLOSING = 1
+REPLY = 2
+
+class _Closing(object):
+    """
+    The state of a connection being closed.
+    """
+    __slots__ = ('rank', 'parks', 'closing_sent', 'reply_written', 'reply_read')
+
+    def __init__(self, rank, parks):
+        self.rank = rank
+        self.parks = parks # Whether messages for the rank wait for the close
+        self.closing_sent = False
+        self.reply_written = False
+        self.reply_read = False
+
+class Disconnect(object):
+    def __init__(self, network):
+        self.network = network
+        self.lock = threading.RLock() # Reentrant, parked requests are sent on with it held
+        self.drained = threading.Condition(self.lock) # Notified when parked requests are sent on
+
+        self.closing = {} # socket -> _Closing
+        self.finished = weakref.WeakKeyDictionary() # Connections let go of, nothing more is queued on them
+        self.parked = {} # global rank -> list of requests waiting for connections to it to close
+        self.parking = {} # global rank -> number of its connections being closed that park messages
+
+        self.closed = 0 # Connections closed with the handshake, for the metrics
+
+    def start(self, client_socket, rank, parks=True):
+        """
+        Start closing a connection to the process with the given global
+        rank. Called when the socket pool lets go of it, so by default
+        messages for the rank are parked until it is closed.
+        """
+        with self.lock:
+            state = self.closing.get(client_socket)
+            if state is not None and state.closing_sent:
+                return
+            if state is None:
+                state = self.closing[client_socket] = _Closing(rank, parks)
+                if parks:
+                    self._park(state)
+            self._send(client_socket, state, CLOSING)
+
+    def received(self, client_socket, rank, raw_data):
+        """
+        A TAG_DISCONNECT message was read from a connection. Only called by
+        the network thread receiving on it.
+        """
+        flags = struct.unpack_from(FLAGS_FORMAT, raw_data)[0]
+
+        with self.lock:
+            state = self.closing.get(client_socket)
+            if state is None:
+                # The other side started. We only have to hold messages
+                # back if we sent over the connection.
+                parks = self.network.socket_pool.remove_socket(client_socket)
+                state = self.closing[client_socket] = _Closing(rank, parks)
+                if parks:
+                    self._park(state)
+
+            if flags & CLOSING:
+                answer = REPLY
+                if not state.closing_sent:
+                    answer |= CLOSING
+                self._send(client_socket, state, answer)
+
+            if flags & REPLY:
+                state.reply_read = True
+                self._check(client_socket, state)
+
+    def written(self, client_socket, request):
+        """
+        A TAG_DISCONNECT message was written. Only called by the network
+        thread sending on the connection.
+        """
+        flags = struct.unpack_from(FLAGS_FORMAT, request.data[0])[0]
+        if not flags & REPLY:
+            return
+
+        with self.lock:
+            state = self.closing.get(client_socket)
+            if state is not None:
+                state.reply_written = True
+                self._check(client_socket, state)
+
+    def lost(self, client_socket):
+        """
+        A connection broke or was closed by the other side without (the
+        rest of) the handshake. Let go of it and send whatever was waiting
+        for it to close.
+        """
+        with self.lock:
+            self.finished[client_socket] = True
+            state = self.closing.pop(client_socket, None)
+            if state is None:
+                self.network.socket_pool.remove_socket(client_socket)
+            elif state.parks:
+                self._unpark(state.rank)
+
+        self.network.release(client_socket)
+
+    def park(self, request):
+        """
+        Hold a request back if a connection to its receiver is being closed.
+        Returns True if it was parked.
+        """
+        with self.lock:
+            if request.global_rank not in self.parking:
+                return False
+            self.parked.setdefault(request.global_rank, []).append(request)
+            return True
+
+    def is_closing(self, client_socket):
+        """
+        Tell whether a connection is being closed or already let go of, so
+        messages must not be queued on it.
+        """
+        return client_socket in self.closing or client_socket in self.finished
+
+    def wait(self):
+        """
+        Wait until the requests parked for processes that are still around
+        to answer have been sent on. Returned credit is not waited for,
+        as the process it is for may have shut down already.
+        """
+        with self.lock:
+            while any(request.tag != constants.TAG_CREDIT for requests in self.parked.values() for request in requests):
+                self.drained.wait()
+
+    def _send(self, client_socket, state, flags):
+        """
+        Queue a TAG_DISCONNECT message behind everything else on the
+        connection. Called with the lock held.
+        """
+        # Imported here since mpi.request needs the network package itself
+        from mpi.request import Request
+
+        world = self.network.mpi.MPI_COMM_WORLD
+        payload = struct.pack(FLAGS_FORMAT, flags)
+
+        request = Request("send", world, state.rank, constants.TAG_DISCONNECT, data=[payload])
+        request.header = utils.prepare_header(world.comm_group.rank(), cmd=constants.CMD_USER, tag=constants.TAG_DISCONNECT, comm_id=world.id, payload_length=len(payload))
+        request.global_rank = state.rank
+        request.is_prepared = True
+
+        if flags & CLOSING:
+            state.closing_sent = True
+        self.network.t_out.queue_request(client_socket, request)
+
+    def _check(self, client_socket, state):
+        """
+        Close the connection if both replies are through. Called with the
+        lock held.
+        """
+        if not (state.reply_written and state.reply_read):
+            return
+
+        del self.closing[client_socket]
+        self.finished[client_socket] = True
+        self.closed += 1
+        self.network.release(client_socket)
+        if state.parks:
+            self._unpark(state.rank)
+
+    def _park(self, state):
+        self.parking[state.rank] = self.parking.get(state.rank, 0) + 1
+
+    def _unpark(self, rank):
+        """
+        One less connection to the rank is being closed. Once none are, the
+        requests parked for it are sent on in order, over a new connection.
+        """
+        self.parking[rank] -= 1
+        if self.parking[rank]:
+            return
+        del self.parking[rank]
+
+        for request in self.parked.pop(rank, []):
+            # Requests cancelled while waiting never reach the receiver
+            if request.test_cancelled():
+                continue
+            self.network.t_out.add_out_request(request)
+        self.drained.notifyAll()
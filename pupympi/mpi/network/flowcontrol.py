@@ -0,0 +1,148 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Credit based flow control between pairs of processes.
+
+Every receiver lets every sender have FLOW_CONTROL_BUDGET bytes (headers
+included, each counted as utils.MAX_HEADER_SIZE bytes) of point to point
+messages in flight or waiting in its queue of unexpected messages. The
+sender spends credit for each message it hands to the network and the
+receiver gives it back once a receive has matched the message. Credit is
+returned in batches of a quarter of the budget with a TAG_CREDIT message,
+which is handled by the receiving network thread and never matched.
+
+A sender out of credit queues its messages locally, in order, until credit
+comes back. A message is let through as long as there is any credit left,
+so the budget can be overrun by one message. That way a sender never waits
+for credit the receiver is holding back until it has a full batch.
+
+Only messages that go through the message matcher on the other side are
+counted. Collective messages, messages to self and the replies and payloads
+of the rendezvous protocol are sent right away.
+"""
+import threading, struct, time
+from collections import deque
+
+from mpi import constants
+from mpi.network import utils
+
+CREDIT_FORMAT = "l"
+
+class FlowControl(object):
+    def __init__(self, network, budget):
+        self.network = network
+        self.budget = budget # None or 0 turns flow control off
+        self.lock = threading.Lock()
+
+        # Sending side, by global rank of the receiver
+        self.credits = {} # Bytes the receiver still has room for
+        self.stalled = {} # deque of (request, cost, time queued) waiting for credit
+
+        # Receiving side, by global rank of the sender
+        self.unreturned = {} # Bytes consumed but not given back yet
+
+        # Metrics
+        self.stalled_total = 0 # Messages that had to wait for credit
+        self.stall_time = 0.0 # Seconds they waited all together
+
+    def submit(self, request):
+        """
+        Hand a prepared send request to the network as soon as the receiver
+        has room for it.
+        """
+        if not self.budget:
+            self.network.t_out.add_out_request(request)
+            return
+
+        rank = request.global_rank
+        cost = utils.MAX_HEADER_SIZE + utils.payload_length(request.header)
+
+        # The requests are handed on under the lock so messages released
+        # by returned credit can not be overtaken by new ones
+        with self.lock:
+            credits = self.credits.get(rank, self.budget)
+            if rank in self.stalled or credits <= 0:
+                self.stalled.setdefault(rank, deque()).append( (request, cost, time.time()) )
+                self.stalled_total += 1
+                return
+
+            self.credits[rank] = credits - cost
+            self.network.t_out.add_out_request(request)
+
+    def returned(self, rank, raw_data):
+        """
+        A receiver gave credit back. Send what was waiting for it.
+        """
+        amount = struct.unpack_from(CREDIT_FORMAT, raw_data)[0]
+        now = time.time()
+
+        with self.lock:
+            credits = self.credits.get(rank, self.budget) + amount
+
+            queue = self.stalled.get(rank)
+            while queue and credits > 0:
+                (request, cost, queued) = queue.popleft()
+                self.stall_time += now - queued
+                # Requests cancelled while waiting never reach the receiver
+                if request.test_cancelled():
+                    continue
+                credits -= cost
+                self.network.t_out.add_out_request(request)
+
+            if queue is not None and not queue:
+                del self.stalled[rank]
+            self.credits[rank] = credits
+
+    def consumed(self, rank, size):
+        """
+        A message of size payload bytes from the process with the global
+        rank was matched by a receive. Its credit goes back to the sender
+        once a quarter of the budget has been consumed.
+        """
+        if not self.budget:
+            return
+
+        with self.lock:
+            amount = self.unreturned.get(rank, 0) + utils.MAX_HEADER_SIZE + size
+            if amount < self.budget / 4:
+                self.unreturned[rank] = amount
+                return
+            self.unreturned[rank] = 0
+
+        self._send_credit(rank, amount)
+
+    def _send_credit(self, rank, amount):
+        # Imported here since mpi.request needs the network package itself
+        from mpi.request import Request
+
+        world = self.network.mpi.MPI_COMM_WORLD
+        payload = struct.pack(CREDIT_FORMAT, amount)
+
+        request = Request("send", world, rank, constants.TAG_CREDIT, data=[payload])
+        request.header = utils.prepare_header(world.comm_group.rank(), cmd=constants.CMD_USER, tag=constants.TAG_CREDIT, comm_id=world.id, payload_length=len(payload))
+        request.global_rank = rank
+        request.is_prepared = True
+        self.network.t_out.add_out_request(request)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "stalled_messages" : sum(len(queue) for queue in self.stalled.values()),
+                "stalled_total" : self.stalled_total,
+                "stall_time" : self.stall_time,
+            }
@@ -0,0 +1,303 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Shared memory channels between ranks on the same host.
+
+A channel is a pair of ring buffers (one per direction) in a memory mapped
+file plus a connected unix socket used as doorbell. Payload bytes are copied
+straight into the ring by the sender and out of it by the receiver, so they
+never pass through the kernel. The doorbell only carries single bytes:
+
+    'd' - data was written to the ring the receiving end reads from
+    's' - space was freed in the ring the receiving end writes to
+
+The channel looks enough like a socket (fileno, send, recv_into, close) for
+the socket pool, the pollers and get_raw_message to handle it like any other
+connection. The doorbell socket is what the pollers watch.
+
+Each ring has a head (bytes written) and a tail (bytes read) counter that
+only grow. Only the writer moves the head and only the reader moves the
+tail, and both are aligned 64 bit stores, so no locking between the
+processes is needed. No memory barrier is issued between copying the bytes
+and publishing the new head or tail though. That is only correct when the
+CPU keeps stores in program order (total store order, as on x86). On other
+machines (ARM, POWER, ...) the other end could see the counter move before
+the bytes arrive, so channels are only used where SUPPORTED is true and
+ranks fall back to plain unix sockets elsewhere.
+"""
+import socket, struct, mmap, os, errno, tempfile, threading, platform, numpy
+
+from mpi.exceptions import MPIException
+
+# Machines with total store order, see the module docstring
+SUPPORTED = platform.machine().lower() in ("x86_64", "amd64", "i386", "i486", "i586", "i686", "x86")
+
+# Room for the head and tail counters of a ring. They are kept on separate
+# cache lines so the two processes do not fight over one.
+CONTROL_SIZE = 128
+
+# Format of the setup message the connecting side sends on the doorbell
+# socket: length of the file name and the ring size, then the file name.
+SETUP_FORMAT = "!II"
+
+DOORBELL_DATA = "d"
+DOORBELL_SPACE = "s"
+
+# How long a writer waiting for room in a full ring sleeps before it looks
+# again on its own. The reader rings the doorbell when it frees space so this
+# only matters if that doorbell is lost.
+SPACE_RETRY_INTERVAL = 0.01
+
+def _byte_array(data):
+    """
+    View a send buffer (string, bytearray, memoryview or uint8 array) as a
+    flat uint8 numpy array without copying.
+    """
+    if isinstance(data, numpy.ndarray):
+        return data.view(numpy.uint8).reshape(-1)
+    elif isinstance(data, memoryview):
+        return numpy.asarray(data)
+    else:
+        return numpy.frombuffer(data, numpy.uint8)
+
+class Ring(object):
+    """
+    One direction of a channel. The control block holds the head counter in
+    its first and the tail counter in its ninth 64 bit word.
+    """
+    def __init__(self, mm, offset, size):
+        self.size = size
+        self.control = numpy.frombuffer(mm, numpy.uint64, CONTROL_SIZE/8, offset)
+        self.data = numpy.frombuffer(mm, numpy.uint8, size, offset+CONTROL_SIZE)
+
+    def used(self):
+        return int(self.control[0]) - int(self.control[8])
+
+    def write(self, data):
+        """
+        Copy as much of data as there is room for into the ring. Returns the
+        number of bytes copied.
+        """
+        head = int(self.control[0])
+        space = self.size - (head - int(self.control[8]))
+        count = min(space, len(data))
+        if count <= 0:
+            return 0
+
+        source = _byte_array(data)
+        position = head % self.size
+        first = min(count, self.size - position)
+        self.data[position:position+first] = source[:first]
+        if count > first:
+            self.data[:count-first] = source[first:count]
+
+        # Publish the bytes only after they are in place
+        self.control[0] = head + count
+        return count
+
+    def read_into(self, buffer, nbytes):
+        """
+        Copy up to nbytes from the ring into buffer. Returns the number of
+        bytes copied and whether the ring was full before, in which case the
+        writer might be waiting for room.
+        """
+        tail = int(self.control[8])
+        used = int(self.control[0]) - tail
+        count = min(used, nbytes)
+        if count <= 0:
+            return 0, False
+
+        target = _byte_array(buffer)
+        position = tail % self.size
+        first = min(count, self.size - position)
+        target[:first] = self.data[position:position+first]
+        if count > first:
+            target[first:count] = self.data[:count-first]
+
+        self.control[8] = tail + count
+        return count, used == self.size
+
+class SharedMemoryChannel(object):
+    """
+    A bidirectional connection to a rank on the same host through shared
+    memory. See the module documentation for the protocol.
+    """
+    def __init__(self, doorbell, mm, ring_size, outgoing, path=None):
+        self.doorbell = doorbell
+        self.mm = mm
+        self.path = path # Removed again on close in case the peer never mapped it
+        rings = [Ring(mm, 0, ring_size), Ring(mm, CONTROL_SIZE+ring_size, ring_size)]
+        self.tx = rings[outgoing]
+        self.rx = rings[1-outgoing]
+
+        # Called when the peer signals that it freed room in our outgoing
+        # ring. The network thread writing to the channel hooks in here.
+        self.on_space = None
+        self.space_event = threading.Event()
+
+        self.send_lock = threading.Lock()
+        self.peer_closed = False
+
+    @classmethod
+    def connect(cls, filename, ring_size):
+        """
+        Create the shared file, connect to the shared memory listener of the
+        peer and tell it where to find the rings.
+        """
+        directory = None
+        if os.path.isdir("/dev/shm"):
+            directory = "/dev/shm"
+        fd, path = tempfile.mkstemp(prefix="pupympi-", dir=directory)
+        try:
+            os.ftruncate(fd, 2*(CONTROL_SIZE+ring_size))
+            mm = mmap.mmap(fd, 2*(CONTROL_SIZE+ring_size))
+        finally:
+            os.close(fd)
+
+        doorbell = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            doorbell.connect(filename)
+            doorbell.sendall(struct.pack(SETUP_FORMAT, len(path), ring_size) + path)
+        except socket.error:
+            os.unlink(path)
+            raise
+
+        # The acceptor removes the file once it has mapped it
+        return cls(doorbell, mm, ring_size, 0, path)
+
+    @classmethod
+    def accept(cls, doorbell):
+        """
+        Map the rings of a freshly accepted doorbell connection.
+        """
+        setup = doorbell.recv(struct.calcsize(SETUP_FORMAT), socket.MSG_WAITALL)
+        if len(setup) != struct.calcsize(SETUP_FORMAT):
+            raise MPIException("Shared memory channel closed during setup")
+
+        path_length, ring_size = struct.unpack(SETUP_FORMAT, setup)
+        path = doorbell.recv(path_length, socket.MSG_WAITALL)
+
+        fd = os.open(path, os.O_RDWR)
+        try:
+            mm = mmap.mmap(fd, 2*(CONTROL_SIZE+ring_size))
+        finally:
+            os.close(fd)
+            os.unlink(path)
+
+        return cls(doorbell, mm, ring_size, 1)
+
+    def fileno(self):
+        return self.doorbell.fileno()
+
+    def _ring(self, kind):
+        try:
+            self.doorbell.send(kind, socket.MSG_DONTWAIT)
+        except socket.error, e:
+            # A full doorbell socket is still going to wake the peer
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _handle_doorbell(self, rings):
+        """
+        React to doorbell bytes received from the peer.
+        """
+        if not rings:
+            self.peer_closed = True
+        elif DOORBELL_SPACE in rings:
+            self.space_event.set()
+            if self.on_space:
+                self.on_space()
+
+    def writable(self):
+        return self.tx.used() < self.tx.size
+
+    def send(self, data, flags=0):
+        """
+        Copy as much of data into the outgoing ring as there is room for.
+        Like a socket this blocks until something can be written unless
+        MSG_DONTWAIT is given, in which case a full ring raises EAGAIN.
+        """
+        if len(data) == 0:
+            return 0
+
+        while True:
+            self.space_event.clear()
+            with self.send_lock:
+                written = self.tx.write(data)
+            if written:
+                self._ring(DOORBELL_DATA)
+                return written
+
+            if flags & getattr(socket, "MSG_DONTWAIT", 0):
+                raise socket.error(errno.EAGAIN, "Shared memory ring is full")
+            self.space_event.wait(SPACE_RETRY_INTERVAL)
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        """
+        Copy up to nbytes from the incoming ring, waiting on the doorbell if
+        the ring is empty. Returns 0 when the peer has closed the channel.
+        """
+        if not nbytes:
+            nbytes = len(buffer)
+
+        while True:
+            received, was_full = self.rx.read_into(buffer, nbytes)
+            if received:
+                if was_full:
+                    self._ring(DOORBELL_SPACE)
+                return received
+
+            if self.peer_closed:
+                return 0
+
+            self._handle_doorbell(self.doorbell.recv(4096))
+
+    def ready(self):
+        """
+        Drain the doorbell and tell whether there is anything to read. The
+        doorbell has to be emptied before looking at the ring, otherwise data
+        arriving in between could be left without a doorbell to announce it.
+        A closed peer also counts as ready so the reader gets to see it.
+        """
+        try:
+            while True:
+                rings = self.doorbell.recv(4096, socket.MSG_DONTWAIT)
+                self._handle_doorbell(rings)
+                if not rings:
+                    break
+        except socket.error, e:
+            # A peer closing with doorbell bytes it never read resets the
+            # connection, which is just another way of closing it
+            if e.errno == errno.ECONNRESET:
+                self._handle_doorbell("")
+            elif e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        return self.rx.used() > 0 or self.peer_closed
+
+    def close(self):
+        # The mapping goes away with the last ring referring to it
+        self.doorbell.close()
+
+        # Clean up after a peer that never got as far as mapping the file
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
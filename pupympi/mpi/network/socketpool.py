@@ -17,8 +17,10 @@
 #
 import socket
 import threading
+from collections import OrderedDict
 from mpi.logger import Logger
 from mpi.exceptions import MPIException
+from mpi.network.sharedmemory import SharedMemoryChannel
 
 class SocketPool(object):
     """
@@ -29,25 +31,42 @@ class SocketPool(object):
     connection is heavily used it will probably not be removed. This way your
     call will not create and teardown the connection all the time.
 
-    ISSUES:
-    It is possible to mark a connection as mandatory persistent. This is
-    not used for now.
+    IMPLEMENTATION: The connections are kept in a dict by rank, ordered from
+    the least to the most recently used, so finding the connection for a
+    rank and keeping the order are constant time. When the pool is full the
+    least recently used connection is let go of. Connections can be marked
+    persistent, they are never let go of.
 
-    IMPLEMENTATION: This is a modified "Second change FIFO cache replacement
-    policy" algorithm. It's modified by allowing some elements to live
-    forever in the cache.
-    And also an element given a second chance is not moved to the back of the "queue".
+    A connection let go of is handed to the evict callback given to the
+    pool, which closes it (see mpi.network.disconnect). The pool itself
+    never closes anything, and the next connection asked for to that rank
+    is a new one. That way max_size really bounds the number of
+    connections.
+
+    DUPLICATES: Two processes may connect to each other at the same time.
+    Both then keep the connection opened by the lower rank, the other one
+    is evicted by the higher rank.
 
     ERRORS: It's possible to trigger an error if you fill up the cache with
     more persistent connections than the buffer can actually contain. An
     MPIException will be raised in this situation.
+
+    STRIPES: Large payloads can be split in stripes that are sent over
+    several connections to the same rank at once (see mpi.rendezvous). The
+    first stripe uses the connection from the pool, the others get extra
+    connections of their own. These are kept outside the cache, they are
+    never evicted and do not count towards max_size.
     """
 
-    def __init__(self, max_size):
-        self.sockets = []
+    def __init__(self, max_size, rank=None, evict=None):
+        self.sockets = OrderedDict() # rank -> socket, least recently used first
         self.max_size = max_size
         self.readonly = False #This will be set True during network initialization if a static socket pool is specified
-        self.metainfo = {}
+        self.metainfo = {} # socket -> (rank, accepted, force_persistent)
+        self.stripes = {} # rank -> list of extra connections for stripes 1, 2, ...
+
+        self.rank = rank # Our own global rank, to settle which of two connections to keep
+        self.evict = evict # Called with (socket, rank) for connections let go of
 
         self.sockets_lock = threading.Lock() # Hold this lock before fiddling with the class data
 
@@ -60,146 +79,186 @@ class SocketPool(object):
         with self.sockets_lock:
             client_socket = self._get_socket_for_rank(rank) # Try to find an existing socket connection
 
-        newly_created = False
+        if client_socket:
+            return client_socket, False
 
         # It's not valid to not have a socket and a readonly pool
-        if rank >= 0 and self.readonly and not client_socket:
+        if rank >= 0 and self.readonly:
             raise Exception("SocketPool is read only and we're trying to fetch a non-existing socket for rank %d" % rank)
 
-        if not client_socket: # If we didn't find one, create one
-            if connection_type == "local":
-                #Logger().debug("Creating local socket to %s" % connection_info)
-                client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                client_socket.connect( connection_info )
-                self._add(rank, client_socket, force_persistent)
-                newly_created = True
-
-            elif connection_type == "tcp":
-                #Logger().debug("Creating TCP socket to (%s, %s)" % connection_info)
-                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-                client_socket.connect( connection_info )
+        # If we didn't find one, create one
+        client_socket = self.connect(connection_info, connection_type)
+        if not client_socket:
+            return None, False
 
-                # Add the new socket to the list
-                self._add(rank, client_socket, force_persistent)
-                newly_created = True
+        if not self._add(rank, client_socket, False, force_persistent):
+            # Somebody else got a connection to the rank in the meantime.
+            # Nothing has been sent over ours yet, so it is just dropped.
+            client_socket.close()
+            with self.sockets_lock:
+                return self._get_socket_for_rank(rank), False
 
-        return client_socket, newly_created
+        return client_socket, True
 
-    def add_accepted_socket(self, socket_connection, global_rank):
+    def get_stripe_socket(self, rank, stripe, connection_info, connection_type):
         """
-        Add a socket connection to the pool, where the connection is the returned
-        value from a socket.accept - that is we are at the recieving end of a
-        connection attempt.
+        Returns the connection to use for a stripe of a large payload to a
+        specific rank, along with a flag telling if it was newly created.
+        Stripe 0 goes over the pooled connection, the others get a
+        connection each which is made the first time it is asked for.
         """
-        if global_rank >= 0 and self.readonly:
-            #Logger().debug("Bad conn to rank %i with metainfo:%s and sockets:%s" % (global_rank, self.metainfo, self.sockets))
-            raise Exception("Can't add accepted socket. We're in readonly mode")
+        if stripe == 0:
+            return self.get_socket(rank, connection_info, connection_type)
 
-        #Logger().debug("SocketPool.add_accepted_socket: Adding socket connection for rank %d: %s" % (global_rank, socket_connection))
         with self.sockets_lock:
-            known_socket = self._get_socket_for_rank(global_rank)
+            connections = self.stripes.setdefault(rank, [])
+            if stripe <= len(connections):
+                return connections[stripe-1], False
 
-        # TODO: Move this check under the if known_socket: condition since it is more specialized (i.e. saves an if-comparison in the normal case)
-        if known_socket == socket_connection:
-            Logger().error("SocketPool.add_accepted_socket: Trying to add a socket_connection that is already in the pool?!")
-            return
+        # Stripes are asked for in order by the network thread handling the
+        # go ahead for large messages, so the ones before this one exist
+        client_socket = self.connect(connection_info, connection_type)
+        with self.sockets_lock:
+            connections.append(client_socket)
+        return client_socket, True
+
+    def connect(self, connection_info, connection_type):
+        """
+        Create a new connection of the given type
+        """
+        client_socket = None
+        if connection_type == "local":
+            #Logger().debug("Creating local socket to %s" % connection_info)
+            client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client_socket.connect( connection_info )
 
-        if known_socket:
-            # When two procs send to each other simultaneously the result can be
-            # adding a duplicate connection
-            #Logger().debug("Already a socket in the pool:%s for an accepted connection:%s to rank:%i" % (known_socket,socket_connection,global_rank))
-            pass
+        elif connection_type == "shm":
+            #Logger().debug("Creating shared memory channel to %s" % connection_info[0])
+            client_socket = SharedMemoryChannel.connect(*connection_info)
 
-        self._add(global_rank, socket_connection, False)
+        elif connection_type == "tcp":
+            #Logger().debug("Creating TCP socket to (%s, %s)" % connection_info)
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            client_socket.connect( connection_info )
 
-    def _remove_element(self):
+        return client_socket
+
+    def has_socket(self, rank):
         """
-        Finds the first element that already had its second chance and
-        remove it from the lis
+        Tells if there is a connection to the specific rank in the pool
+        """
+        return rank in self.sockets
 
-        NOTE: Caller makes sure the sockets_lock is held
+    def add_connected_socket(self, rank, client_socket):
+        """
+        Add a connection to the pool that was made outside it, eg. by
+        Network.connect opening several at once. Returns False if there
+        already is a connection to the rank, which should be used instead.
+        """
+        if rank >= 0 and self.readonly:
+            raise Exception("Can't add connected socket. We're in readonly mode")
+
+        return self._add(rank, client_socket, False, False)
 
-        NOTE:
-        We don't explicitly close the socket once removed. Or remove it from the
-        socket_to_request dict.
-        This has nothing to do with correctness but it is wasteful and we should
-        clean up after ourselves.
-        See also issue #13 Socket pool does not limit connections properly
-        """
-        foundOne = False
-        for client_socket in self.sockets:
-            (srank, referenced, force_persistent) = self.metainfo[client_socket]
-            if force_persistent: # We do not remove persistent connections
-                #Logger.debug("FOUND A PERSISTENT ONE!")
-                continue
-
-            if referenced: # Mark second chance
-                self.metainfo[client_socket] = (srank, False, force_persistent)
-            else: # Has already had its second chance
-                self.sockets.remove(client_socket) # remove from socket pool
-                del self.metainfo[client_socket] # delete metainfo
-                foundOne = True
-                break
-
-        # If a pass found nothing to remove we take the first non-persistent
-        if not foundOne:
-            for client_socket in self.sockets:
-                (srank, referenced, force_persistent) = self.metainfo[client_socket]
-                if force_persistent: # skip persistent connections
-                    continue
-                else:
-                    self._remove_rank(srank, client_socket=client_socket)
-                    foundOne = True
-                    break
-
-            # If we still didn't find one, they must all have been persistant
-            if not foundOne:
-                # Alert the user, harshly
-                raise MPIException("Not possible to add a socket connection to the internal caching system. There are %d persistant connections and they fill out the cache" % self.max_size)
-
-    def _remove_rank(self, rank, client_socket=None):
+    def add_accepted_socket(self, socket_connection, global_rank):
         """
-        NOTE: Caller makes sure the sockets_lock is held
+        Add a socket connection to the pool, where the connection is the returned
+        value from a socket.accept - that is we are at the recieving end of a
+        connection attempt. Returns False if it was not added because the
+        connection we made to the same rank is kept instead.
         """
-        if not client_socket:
-            client_socket = self._get_socket_for_rank(rank)
+        if global_rank >= 0 and self.readonly:
+            #Logger().debug("Bad conn to rank %i with metainfo:%s and sockets:%s" % (global_rank, self.metainfo, self.sockets))
+            raise Exception("Can't add accepted socket. We're in readonly mode")
+
+        #Logger().debug("SocketPool.add_accepted_socket: Adding socket connection for rank %d: %s" % (global_rank, socket_connection))
+        return self._add(global_rank, socket_connection, True, False)
 
-        self.sockets.remove(client_socket)
-        del self.metainfo[client_socket]
+    def remove_socket(self, client_socket):
+        """
+        Take a connection out of the pool without evicting it, because it
+        is being closed already. Returns True if it was in the pool.
+        """
+        with self.sockets_lock:
+            info = self.metainfo.pop(client_socket, None)
+            if info is None:
+                return False
+            del self.sockets[info[0]]
+            return True
 
     def _get_socket_for_rank(self, rank):
         """
         NOTE: Caller makes sure the sockets_lock is held
 
         Attempts to find an already created socket with a connection to a
-        specific rank. If this does not exist we return None
+        specific rank and marks it as the most recently used. If this does
+        not exist we return None
         """
-        for client_socket in self.sockets:
-            (srank, referenced, fp) = self.metainfo[client_socket]
-            if srank == rank:
-                self.metainfo[client_socket] = (srank, True, fp)
-                return client_socket
+        client_socket = self.sockets.pop(rank, None)
+        if client_socket is not None:
+            self.sockets[rank] = client_socket
+        return client_socket
 
-        return None
+    def _keeps(self, rank, accepted):
+        """
+        Whether a connection to rank is the one to keep of two, that is the
+        one opened by the lower rank.
+        """
+        return accepted == (rank < self.rank)
 
-    def _add(self, rank, client_socket, force_persistent):
+    def _add(self, rank, client_socket, accepted, force_persistent):
         """
-        Add a new socket connection to the pool along with meta info
+        Add a new socket connection to the pool along with meta info. Returns
+        False if another connection to the rank is kept instead. Connections
+        thrown out to make room are handed to the evict callback.
         """
-        #Logger().debug("SocketPool._add: for rank %d: %s" % (rank, client_socket))
+        evicted = []
         with self.sockets_lock:
-            if len(self.sockets) >= self.max_size: # Throw one out if there are too many
-                self._remove_element()
+            known_socket = self.sockets.get(rank)
+            if known_socket is not None and known_socket is not client_socket:
+                if accepted == self.metainfo[known_socket][1] or not self._keeps(rank, accepted):
+                    return False
+
+                # Both processes connected at once and this is the
+                # connection they both keep
+                evicted.append( (known_socket, rank) )
+                del self.metainfo[known_socket]
+
+            self.sockets.pop(rank, None)
+            self.metainfo[client_socket] = (rank, accepted, force_persistent)
+            self.sockets[rank] = client_socket
+
+            # Throw the least recently used out if there are too many
+            if len(self.sockets) > self.max_size:
+                evicted.append(self._remove_element())
+
+        if self.evict:
+            for (evicted_socket, evicted_rank) in evicted:
+                self.evict(evicted_socket, evicted_rank)
+        return True
+
+    def _remove_element(self):
+        """
+        Remove the least recently used connection that is not persistent and
+        return it along with its rank.
+
+        NOTE: Caller makes sure the sockets_lock is held
+        """
+        for (rank, client_socket) in self.sockets.iteritems():
+            if not self.metainfo[client_socket][2]:
+                del self.sockets[rank]
+                del self.metainfo[client_socket]
+                return (client_socket, rank)
 
-            self.metainfo[client_socket] = (rank, False, force_persistent)
-            self.sockets.append(client_socket)
+        # Alert the user, harshly
+        raise MPIException("Not possible to add a socket connection to the internal caching system. There are %d persistant connections and they fill out the cache" % self.max_size)
 
     def close_all_sockets(self):
         """
         Close all sockets in the socketpool
         """
-        for s in self.sockets:
+        for s in self.sockets.values() + sum(self.stripes.values(), []):
             try:
                 #s.shutdown(2)
                 s.close()
@@ -15,14 +15,78 @@
 # You should have received a copy of the GNU General Public License 2
 # along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
 #
-import socket, struct, random, numpy
+import socket, struct, random, numpy, errno, cStringIO
 
 from mpi.logger import Logger
 from mpi.exceptions import MPIException
 from mpi import constants
 from mpi.commons import pickle
+from mpi.network import compression
 
-HEADER_FORMAT = "lllllll"
+# Every message starts with a header telling the length of the payload, the
+# rank of the sender, the msg_type (cmd), tag, ack, communicator id and the
+# collective header (class id and sequence number). Two layouts exist:
+#
+#  * Version 2 (the default) starts with three bytes: the version, flags
+#    and the length of the rest of the header. The rest is the fields as
+#    varints, signed ones zigzag encoded. Fields holding their defaults are
+#    left out and marked by the flags instead. A small point to point
+#    message has an 8 byte header and the layout is the same on all hosts.
+#  * Version 1 is a fixed layout of eight native longs, 64 bytes on 64 bit
+#    hosts and only usable between hosts of the same word size. It is
+#    quicker to decode but carries no version byte of its own, so a receiver
+#    can not tell it from version 2 and a job must use it throughout (see
+#    HEADER_VERSION in mpi.settings).
+#
+# Neither layout is the one of earlier releases (seven native longs without
+# the collective sequence number). There is no wire compatibility with
+# those, the bootstrap of the processes is not compatible either.
+HEADER_VERSION = 2
+FIXED_HEADER_VERSION = 1
+FIXED_HEADER_FORMAT = "llllllll"
+
+# Header flags of version 2
+HEADER_FLAG_ACK = 1 # ack is 1, there is no ack field
+HEADER_FLAG_ACK_VALUE = 2 # ack is in a field of its own, eg. the offset of a stripe
+HEADER_FLAG_COLLECTIVE = 4 # The collective header fields are there, otherwise they are (-1, -1)
+HEADER_FLAG_COMPRESSED = 8 # A codec id field follows the cmd, see mpi.network.compression
+
+HEADER_PREFIX_SIZE = 3 # Version, flags and length of the rest
+
+# No header of either version is longer than this. It is also what flow
+# control charges for a header (see mpi.network.flowcontrol) since both
+# sides have to agree on the cost of a message.
+MAX_HEADER_SIZE = HEADER_PREFIX_SIZE + 9*10
+
+# The layout in use by this process, see set_header_version
+header_version = HEADER_VERSION
+
+# Segments up to this size are copied together before sending so that a
+# header and a small payload go out in one system call (see gather_segments)
+SEND_COALESCE_LIMIT = 8192
+
+# Small requests queued for the same socket are written together until their
+# combined size passes this limit (see CommunicationHandler._handle_writelist)
+SEND_BATCH_LIMIT = 64*1024
+
+# Size of the buffer a MessageReader reads into. Payloads of up to a quarter
+# of it are parsed out of the buffer, larger ones are received directly.
+READ_BUFFER_SIZE = 64*1024
+
+# Numpy arrays of at least this many bytes inside a container (dict, list,
+# tuple) are sent out of band instead of being copied into the pickle, see
+# serialize_message. Their buffers start at multiples of the alignment.
+OUT_OF_BAND_MIN_SIZE = 1024
+OUT_OF_BAND_ALIGNMENT = 16
+
+# Containers are only looked through this many levels down and this many
+# items in for arrays worth sending out of band
+OUT_OF_BAND_SCAN_DEPTH = 2
+OUT_OF_BAND_SCAN_ITEMS = 64
+
+# Per call non-blocking send flag. Where the platform lacks it sends block and
+# send_segments degrades to writing a whole request in one go.
+SEND_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
 
 # DEBUG
 import inspect
@@ -66,25 +130,39 @@ def create_random_socket(min=10000, max=30000):
 
     return sock, hostname, port_no
 
-def get_raw_message(client_socket, bytecount=4096):
+def get_raw_message(client_socket, bytecount=4096, place=None):
     """
     Receive first a header and then actual payload.
     
     A message header contains among other things the size of the payload. The
     header is unpacked and the message size is used to receive the payload.
+
+    The payload is received directly into a single preallocated bytearray of
+    exactly the announced length, so no intermediate strings are built while
+    the message trickles in. Non-pickled payloads (numpy arrays and
+    bytearrays) are returned as that bytearray and can be deserialized
+    without further copying. Pickled payloads are returned as a string since
+    that is what the unpickler insists on.
+
+    The payload can be received into a buffer of the callers choosing
+    instead, see MessageReader.read_message for place.
     """
     #Logger().warning("get_raw_message(%s): on socket:%s" % (whosdaddy(), client_socket))
-    def receive_fixed(length):
+    def receive_fixed(length, message=None):
         """
-        Receive a fixed amount from a socket in batches not larger than bytecount bytes
+        Receive a fixed amount from a socket into a preallocated buffer in
+        batches not larger than bytecount bytes
         """
         #Logger().warning("recieve_fixed: length:%s on socket:%s" % (length, client_socket))
-        message = ""
-        while length > 0:
+        if message is None:
+            message = bytearray(length)
+        view = memoryview(message)
+        received = 0
+        while received < length:
             try:
-                data = client_socket.recv(min(length, bytecount))
+                received_now = client_socket.recv_into(view[received:], min(length-received, bytecount))
             except socket.error, e:
-                #Logger().debug("receive_fixed: recv() threw:%s for socket:%s length:%s message:%s" % (e,client_socket, length,message))
+                #Logger().debug("receive_fixed: recv_into() threw:%s for socket:%s length:%s received:%s" % (e,client_socket, length,received))
                 raise MPIException("receive_fixed threw socket error: %s" % e)
                 # NOTE: We can maybe recover more gracefully here but that requires
                 # throwing status besides message and rank upwards.
@@ -94,19 +172,151 @@ def get_raw_message(client_socket, bytecount=4096):
             
             # TODO: If we really receive 0 bytes on a socket that is ready to read then the other side has closed the connection and we should react accordingly
             # Other side closed
-            if len(data) == 0:
-                raise MPIException("Connection broke or something received empty (still missing length:%i)" % length)
+            if received_now == 0:
+                raise MPIException("Connection broke or something received empty (still missing length:%i)" % (length-received))
 
-            length -= len(data)
-            message += data
+            received += received_now
         
         #Logger().warning("recieve_fixed DONE: length:%s on socket:%s" % (length, client_socket))
         return message
 
-    header_size = struct.calcsize(HEADER_FORMAT)
-    header = receive_fixed(header_size)
-    lpd, rank, cmd, tag, ack, comm_id, coll_class_id = struct.unpack(HEADER_FORMAT, header)
-    return rank, cmd, tag, ack, comm_id, coll_class_id, receive_fixed(lpd)
+    if header_version == FIXED_HEADER_VERSION:
+        header = receive_fixed(struct.calcsize(FIXED_HEADER_FORMAT))
+    else:
+        header = receive_fixed(HEADER_PREFIX_SIZE)
+        header += receive_fixed(header[2])
+    lpd, rank, cmd, tag, ack, comm_id, coll_class_id, coll_sequence = unpack_header(header)
+
+    buffer = None
+    if place is not None:
+        buffer = place(rank, cmd, tag, ack, comm_id, (coll_class_id, coll_sequence), lpd)
+
+    payload = receive_fixed(lpd, buffer)
+    # Pickled payloads (system messages and vanilla user data) are unpickled
+    # from a string, raw types are handed on as the received buffer
+    if cmd <= constants.CMD_RAWTYPE and buffer is None:
+        payload = str(payload)
+
+    return rank, cmd, tag, ack, comm_id, (coll_class_id, coll_sequence), payload
+
+class MessageReader(object):
+    """
+    Reads messages from one socket through a buffer, the buffered
+    counterpart of get_raw_message.
+
+    A recv call takes in whatever has arrived, up to the size of the buffer,
+    so a burst of small messages is parsed out of a single read instead of
+    costing two recv calls per message. Payloads larger than a quarter of
+    the buffer are completed by receiving straight into the payload buffer.
+
+    Everything read from the socket has to go through the same reader since
+    the buffer may hold the start of the next message.
+    """
+    def __init__(self, client_socket, size=READ_BUFFER_SIZE, bytecount=4096):
+        self.socket = client_socket
+        self.bytecount = bytecount
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # Buffered data is buffer[start:end]
+        self.end = 0
+
+        self.small_limit = size / 4
+
+    def _recv_into(self, view, nbytes):
+        try:
+            received = self.socket.recv_into(view, nbytes)
+        except socket.error, e:
+            raise MPIException("MessageReader threw socket error: %s" % e)
+
+        # Other side closed
+        if received == 0:
+            raise MPIException("Connection broke or something received empty")
+        return received
+
+    def _fill(self, needed):
+        """
+        Block until at least needed bytes are buffered.
+        """
+        if self.start + needed > len(self.buffer):
+            # Move what is left to the front to make room
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+
+        while self.end - self.start < needed:
+            self.end += self._recv_into(self.view[self.end:], len(self.buffer) - self.end)
+
+    def _header_size(self):
+        """
+        The size of the header at the start of the buffered data, or None
+        if not enough of it is buffered to tell.
+        """
+        if header_version == FIXED_HEADER_VERSION:
+            return struct.calcsize(FIXED_HEADER_FORMAT)
+        if self.end - self.start < HEADER_PREFIX_SIZE:
+            return None
+        return HEADER_PREFIX_SIZE + self.buffer[self.start+2]
+
+    def has_message(self):
+        """
+        Tell whether a whole message is buffered, so read_message returns it
+        without touching the socket.
+        """
+        available = self.end - self.start
+        header_size = self._header_size()
+        if header_size is None or available < header_size:
+            return False
+        return available - header_size >= unpack_header(self.buffer, self.start)[0]
+
+    def read_message(self, place=None):
+        """
+        Read one message. Returns the same tuple as get_raw_message.
+
+        A large payload can be read into a buffer of the callers choosing.
+        place is then called with (rank, cmd, tag, ack, comm_id, collective
+        header, payload length) and returns a writable buffer of exactly
+        that length, or None for a fresh bytearray. A payload read into such
+        a buffer is returned as that buffer whatever its type.
+        """
+        header_size = self._header_size()
+        if header_size is None:
+            self._fill(HEADER_PREFIX_SIZE)
+            header_size = self._header_size()
+        self._fill(header_size)
+        lpd, rank, cmd, tag, ack, comm_id, coll_class_id, coll_sequence = unpack_header(self.buffer, self.start)
+        self.start += header_size
+
+        placed = None
+        if lpd <= self.small_limit:
+            self._fill(lpd)
+            payload = self.buffer[self.start:self.start+lpd]
+            self.start += lpd
+        else:
+            if place is not None:
+                placed = place(rank, cmd, tag, ack, comm_id, (coll_class_id, coll_sequence), lpd)
+            payload = placed
+            if payload is None:
+                payload = bytearray(lpd)
+
+            # Take what is buffered and receive the rest in place
+            view = memoryview(payload)
+            received = min(lpd, self.end - self.start)
+            view[:received] = self.view[self.start:self.start+received]
+            self.start += received
+
+            while received < lpd:
+                received += self._recv_into(view[received:], min(lpd-received, self.bytecount))
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        # Pickled payloads (system messages and vanilla user data) are unpickled
+        # from a string, raw types are handed on as the received buffer
+        if cmd <= constants.CMD_RAWTYPE and placed is None:
+            payload = str(payload)
+
+        return rank, cmd, tag, ack, comm_id, (coll_class_id, coll_sequence), payload
 
 
 # ... just for later inspiration
@@ -135,7 +345,39 @@ numpytypes = {
 typeint_to_type = dict( [(typeint,desc['type']) for typeint,desc in numpytypes.items()+othertypes.items() ] )
 type_to_typeint = dict( [(desc['type'],typeint) for typeint,desc in numpytypes.items()+othertypes.items() ] )
 
-def prepare_header(rank, cmd=0, tag=constants.MPI_TAG_ANY, ack=False, comm_id=0, payload_length=0, collective_header_information=()):
+def set_header_version(version):
+    """
+    Choose the header layout this process writes and reads, HEADER_VERSION
+    or FIXED_HEADER_VERSION. All processes of a job must use the same.
+    """
+    global header_version
+    if version not in (HEADER_VERSION, FIXED_HEADER_VERSION):
+        raise MPIException("Unsupported header version %s" % version)
+    header_version = version
+
+# The varints of the values 0 to 127 are the byte itself
+_SMALL_VARINTS = [ chr(value) for value in range(128) ]
+
+def _varint(value):
+    if value < 128:
+        return _SMALL_VARINTS[value]
+    parts = []
+    while value >= 128:
+        parts.append(chr(value & 127 | 128))
+        value >>= 7
+    parts.append(chr(value))
+    return "".join(parts)
+
+def _zigzag(value):
+    """
+    Map signed values to unsigned ones so small negative values (like the
+    system tags and rank -1 of mpirun) get short varints as well.
+    """
+    if value >= 0:
+        return _varint(value << 1)
+    return _varint((-value << 1) - 1)
+
+def prepare_header(rank, cmd=0, tag=constants.MPI_TAG_ANY, ack=False, comm_id=0, payload_length=0, collective_header_information=(), version=None):
     """
     Internal function to
     - construct header for a list of already serialized payloads
@@ -143,20 +385,123 @@ def prepare_header(rank, cmd=0, tag=constants.MPI_TAG_ANY, ack=False, comm_id=0,
     NOTE: Caller is assumed to know the combined length of the payloads since
           initial serialization and the segmentation has been done by the caller
 
-    The header format is the traditional
+    The header layout is the one chosen with set_header_version unless a
+    version is given, see HEADER_VERSION at the top of this module.
+
+    The collective header information is the (class id, sequence number) of
+    the collective request sending the message. get_raw_message hands it back
+    as a tuple the same way.
     """
     try:
-        coll_class_id = collective_header_information[0]
-    except IndexError, e:
-        coll_class_id = -1
-        
-    header = struct.pack(HEADER_FORMAT, payload_length, rank, cmd, tag, ack, comm_id, coll_class_id)
-    return header
+        coll_class_id, coll_sequence = collective_header_information
+    except ValueError, e:
+        coll_class_id, coll_sequence = -1, -1
+
+    if (version or header_version) == FIXED_HEADER_VERSION:
+        return struct.pack(FIXED_HEADER_FORMAT, payload_length, rank, cmd, tag, ack, comm_id, coll_class_id, coll_sequence)
+
+    flags = 0
+    codec_id = 0
+    if cmd >= constants.CMD_COMPRESSED:
+        flags |= HEADER_FLAG_COMPRESSED
+        codec_id, cmd = divmod(cmd, constants.CMD_COMPRESSED)
+
+    fields = [_varint(payload_length), _zigzag(rank), _varint(cmd), _zigzag(tag), _zigzag(comm_id)]
+    if codec_id:
+        fields.append(_varint(codec_id))
+    if (coll_class_id, coll_sequence) != (-1, -1):
+        flags |= HEADER_FLAG_COLLECTIVE
+        fields.append(_zigzag(coll_class_id))
+        fields.append(_zigzag(coll_sequence))
+    if ack == 1:
+        flags |= HEADER_FLAG_ACK
+    elif ack:
+        flags |= HEADER_FLAG_ACK_VALUE
+        fields.append(_zigzag(ack))
+
+    body = "".join(fields)
+    return chr(HEADER_VERSION) + chr(flags) + chr(len(body)) + body
+
+def unpack_header(header, offset=0, version=None):
+    """
+    Decode a header made by prepare_header, starting at offset of a string
+    or bytearray. Returns (payload length, rank, cmd, tag, ack, comm_id,
+    collective class id, collective sequence number).
+    """
+    if (version or header_version) == FIXED_HEADER_VERSION:
+        return struct.unpack_from(FIXED_HEADER_FORMAT, header, offset)
+
+    if not isinstance(header, bytearray):
+        header = bytearray(header)
+
+    if header[offset] != HEADER_VERSION:
+        raise MPIException("Received a header of unsupported version %d" % header[offset])
+    flags = header[offset+1]
+    end = offset + HEADER_PREFIX_SIZE + header[offset+2]
+
+    # Decode all the varints, the flags tell what they are. Mostly all of
+    # them are a single byte.
+    body = header[offset+HEADER_PREFIX_SIZE:end]
+    if max(body) < 128:
+        values = list(body)
+    else:
+        values = []
+        value = shift = 0
+        for byte in body:
+            value |= (byte & 127) << shift
+            if byte & 128:
+                shift += 7
+            else:
+                values.append(value)
+                value = shift = 0
+
+    lpd = values[0]
+    cmd = values[2]
+    # Undo the zigzag encoding of the signed fields
+    rank, tag, comm_id = [ (values[i] >> 1) ^ -(values[i] & 1) for i in (1, 3, 4) ]
+    position = 5
+
+    if flags & HEADER_FLAG_COMPRESSED:
+        cmd += values[position] * constants.CMD_COMPRESSED
+        position += 1
+
+    coll_class_id = coll_sequence = -1
+    if flags & HEADER_FLAG_COLLECTIVE:
+        coll_class_id, coll_sequence = [ (value >> 1) ^ -(value & 1) for value in values[position:position+2] ]
+        position += 2
+
+    ack = 0
+    if flags & HEADER_FLAG_ACK:
+        ack = 1
+    elif flags & HEADER_FLAG_ACK_VALUE:
+        ack = (values[position] >> 1) ^ -(values[position] & 1)
+
+    return lpd, rank, cmd, tag, ack, comm_id, coll_class_id, coll_sequence
+
+def payload_length(header):
+    """
+    The payload length announced in a header made by prepare_header.
+    """
+    return unpack_header(header)[0]
 
 def get_shape(shapebytes):
-    return tuple(numpy.fromstring(shapebytes,numpy.dtype(int)))
+    return tuple(numpy.frombuffer(shapebytes,numpy.dtype(int)))
+
+def restore_array(raw_data, t):
+    """
+    Restore a one-dimensional numpy array of type t from raw bytes.
 
-def prepare_message(data, rank, cmd=0, tag=constants.MPI_TAG_ANY, ack=False, comm_id=0, is_serialized=False, collective_header_information=()):
+    A bytearray is a buffer received from the network (or sliced out of one)
+    and is not referenced by anyone else, so the array is built on top of it
+    without copying. Anything else (strings, views on the sender's own arrays)
+    is copied so the result never aliases data the caller might still use.
+    """
+    if isinstance(raw_data, bytearray):
+        return numpy.frombuffer(raw_data, t)
+    else:
+        return numpy.fromstring(raw_data, t)
+
+def prepare_message(data, rank, cmd=0, tag=constants.MPI_TAG_ANY, ack=False, comm_id=0, is_serialized=False, collective_header_information=(), compressor=None, out_of_band=False):
     """
     Internal function to
     - serialize payload if needed
@@ -170,21 +515,31 @@ def prepare_message(data, rank, cmd=0, tag=constants.MPI_TAG_ANY, ack=False, com
     mpi or system tag
     acknowledge needed
     communicator id
+
+    With a compressor (see mpi.network.compression) the payload is
+    compressed when that pays off, which is then marked in the cmd.
+    out_of_band is handed on to serialize_message.
     """
     if is_serialized:
         serialized_data = [data] # boxing
         length = len(data)
     else:
-        serialized_data, cmd, length = serialize_message(data,cmd)
+        serialized_data, cmd, length = serialize_message(data,cmd,compressor=compressor,out_of_band=out_of_band)
 
     header =  prepare_header(rank, cmd=cmd, tag=tag, ack=ack, comm_id=comm_id, payload_length=length, collective_header_information=collective_header_information)
     return (header,serialized_data)
 
-def serialize_message(data, cmd=None, recipients=1):
+def serialize_message(data, cmd=None, recipients=1, compressor=None, out_of_band=False):
     """
     Internal function to
     - measure and serialize payload
     - construct proper msg_type (cmd) including possible shapebytes
+    - compress the serialized payload if a compressor is given
+
+    With out_of_band a user message (cmd CMD_USER) that is a container
+    holding large numpy arrays is sent as CMD_OUT_OF_BAND, see
+    serialize_out_of_band. Only point to point messages use it, collective
+    operations slice and forward payloads themselves.
 
     NOTE:
     - The recipients parameter only takes effect when scattering multi-dimensional
@@ -266,27 +621,140 @@ def serialize_message(data, cmd=None, recipients=1):
         #Logger().debug("prepare BYTEARRAY - cmd:%i len:%s" % (cmd,len(data)) )
         serialized_data = [data]
         length = len(data) # a bytearray has the length it has
+    elif out_of_band and cmd == constants.CMD_USER and _has_large_array(data, OUT_OF_BAND_SCAN_DEPTH):
+        serialized_data, length = serialize_out_of_band(data)
+        cmd = constants.CMD_OUT_OF_BAND
     else:
         # NOTE: cmd is not overwritten for vanilla pickling since it is up to caller to decide between eg. system message or user message
         #Logger().debug("prepare VANILLA type:%s header:%s data:%s" %  (type(data),  (rank, cmd, tag, ack, comm_id), data) )
         serialized_data = [pickle.dumps(data, pickle.HIGHEST_PROTOCOL)]
         length = len(serialized_data[0])
 
+    if compressor is not None:
+        serialized_data, cmd, length = compressor.compress(serialized_data, cmd, length)
+
     return (serialized_data, cmd, length)
 
+def _sent_out_of_band(obj):
+    """
+    Tell whether an object is a numpy array to send out of band. Subclasses
+    and types without a typeint (eg. object arrays) are pickled as usual.
+    """
+    return type(obj) is numpy.ndarray and obj.nbytes >= OUT_OF_BAND_MIN_SIZE and obj.dtype in type_to_typeint
+
+def _has_large_array(data, depth):
+    """
+    Look through a container for an array to send out of band.
+    """
+    if isinstance(data, dict):
+        items = data.itervalues()
+    elif isinstance(data, (list, tuple)):
+        items = iter(data)
+    else:
+        return False
+
+    for (count, item) in enumerate(items):
+        if count == OUT_OF_BAND_SCAN_ITEMS:
+            break
+        if _sent_out_of_band(item):
+            return True
+        if depth > 1 and _has_large_array(item, depth-1):
+            return True
+    return False
+
+def serialize_out_of_band(data):
+    """
+    Serialize an object with its large numpy arrays out of band. Returns
+    the segments and their combined length.
+
+    The object is pickled with placeholders for the arrays (through the
+    persistent_id hook of the pickler), which only hold the offset, typeint
+    and shape of each. The payload is the length of that skeleton, the
+    skeleton and the array buffers, each at an offset that is a multiple of
+    OUT_OF_BAND_ALIGNMENT. The buffers go out as views on the arrays
+    themselves so they are never copied into the pickle.
+    """
+    buffers = []
+    offsets = [0] # Offset of the next buffer from the first one
+
+    def persistent_id(obj):
+        if not _sent_out_of_band(obj):
+            return None
+        # A view on the data in memory order, copied if not contiguous
+        view = numpy.ascontiguousarray(obj).reshape(-1).view(numpy.uint8)
+        offset = offsets[0]
+        buffers.append((offset, view))
+        offsets[0] = offset + -(-view.size // OUT_OF_BAND_ALIGNMENT) * OUT_OF_BAND_ALIGNMENT
+        return (offset, type_to_typeint[obj.dtype], obj.shape)
+
+    output = cStringIO.StringIO()
+    pickler = pickle.Pickler(output, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(data)
+    skeleton = output.getvalue()
+
+    segments = [struct.pack("!l", len(skeleton)), skeleton]
+    length = 4 + len(skeleton)
+    start = -(-length // OUT_OF_BAND_ALIGNMENT) * OUT_OF_BAND_ALIGNMENT
+    for (offset, view) in buffers:
+        padding = start + offset - length
+        if padding:
+            segments.append("\0" * padding)
+        segments.append(view)
+        length = start + offset + view.size
+
+    return segments, length
+
+def deserialize_out_of_band(raw_data):
+    """
+    Restore an object serialized by serialize_out_of_band. The arrays are
+    made on top of the received buffer without copying.
+    """
+    if isinstance(raw_data, list):
+        # Serialized but not transmitted, the segments are still views on
+        # the arrays of the sender
+        joined = bytearray()
+        for segment in raw_data:
+            joined += memoryview(segment)
+        raw_data = joined
+    elif not isinstance(raw_data, bytearray):
+        raw_data = bytearray(raw_data)
+
+    skeleton_length = struct.unpack_from("!l", raw_data)[0]
+    skeleton = str(raw_data[4:4+skeleton_length])
+    start = -(-(4 + skeleton_length) // OUT_OF_BAND_ALIGNMENT) * OUT_OF_BAND_ALIGNMENT
+
+    def persistent_load(placeholder):
+        (offset, typeint, shape) = placeholder
+        t = typeint_to_type[typeint]
+        count = int(numpy.prod(shape))
+        return numpy.frombuffer(raw_data, t, count=count, offset=start+offset).reshape(shape)
+
+    unpickler = pickle.Unpickler(cStringIO.StringIO(skeleton))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
 def deserialize_message(raw_data, msg_type):
     """
     Retrieve the original message from a payload given the message type
+
+    Payloads received from the network arrive as a bytearray owned by
+    nobody else. Numpy arrays are restored on top of that buffer with
+    numpy.frombuffer instead of being copied out of it.
     """
     #Logger().debug("DESERIALIZING msgtype:%s" % msg_type)
 
+    if compression.is_compressed(msg_type):
+        raw_data, msg_type = compression.decompress(raw_data, msg_type)
+
     # Non-pickled data is recognized via msg_type
-    if msg_type > constants.CMD_RAWTYPE:
+    if msg_type == constants.CMD_OUT_OF_BAND:
+        data = deserialize_out_of_band(raw_data)
+    elif msg_type > constants.CMD_RAWTYPE:
         # Multidimensional arrays have the number of shapebytes hiding in the upper decimals
         shapelen = msg_type / 1000
         # typeint occupies the lower decimals
         typeint = msg_type % 1000
-        # FIXME: Use frombuffer instead of fromstring
         if shapelen: # Multi-dimensional
             # Multi-dimensional arrays that are part of a collective operation
             # and have not been transmitted (ie. only serialized and deserialized
@@ -295,16 +763,23 @@ def deserialize_message(raw_data, msg_type):
                 # Getshapebytes out of msg            
                 shapebytes = raw_data[0]
                 # Restore shape tuple
-                shape = tuple(numpy.fromstring(shapebytes,numpy.dtype(int)))
+                shape = get_shape(shapebytes)
                 # Lookup the numpy type
                 t = typeint_to_type[typeint]       
                 # Restore numpy array
-                data = numpy.fromstring(raw_data[1],t).reshape(shape)
+                data = restore_array(raw_data[1],t).reshape(shape)
+            elif isinstance(raw_data,bytearray):
+                # Restore shape tuple from the leading shapebytes
+                shape = tuple(numpy.frombuffer(raw_data,numpy.dtype(int),count=shapelen/numpy.dtype(int).itemsize))
+                # Lookup the numpy type
+                t = typeint_to_type[typeint]
+                # Restore numpy array on top of the received buffer
+                data = numpy.frombuffer(raw_data,t,offset=shapelen).reshape(shape)
             else:                
                 # Slice shapebytes out of msg            
                 shapebytes = raw_data[:shapelen]
                 # Restore shape tuple
-                shape = tuple(numpy.fromstring(shapebytes,numpy.dtype(int)))
+                shape = get_shape(shapebytes)
                 # Lookup the numpy type
                 t = typeint_to_type[typeint]
                 
@@ -314,32 +789,38 @@ def deserialize_message(raw_data, msg_type):
             # Numpy type or bytearray
             if msg_type == constants.CMD_BYTEARRAY:
                 # plain old bytearray
-                try:
-                    data = bytearray(raw_data)
-                except TypeError as e:
-                    # bytearrays that are part of a collective operation
-                    # and have not been transmitted (ie. only serialized and deserialized
-                    # at same node) are not a bytestring but a list
-                    data = bytearray(raw_data[0])
+                if isinstance(raw_data,bytearray):
+                    # A received buffer can be handed over as is
+                    data = raw_data
+                else:
+                    try:
+                        data = bytearray(raw_data)
+                    except TypeError as e:
+                        # bytearrays that are part of a collective operation
+                        # and have not been transmitted (ie. only serialized and deserialized
+                        # at same node) are not a bytestring but a list
+                        data = bytearray(raw_data[0])
             else:
                 # Lookup the numpy type
                 t = typeint_to_type[msg_type]
                 # Restore numpy array
                 try:                    
-                    data = numpy.fromstring(raw_data,t)
+                    data = restore_array(raw_data,t)
                 except TypeError as e:
                     # For many collective operations, the node's own data is not
                     # a received bytestring, but a list of
                     # [(byteshape as bytestring),(numpy uint array as view)]
                     # or
                     # [(numpy uint array as view)] in the one-dimensional case
-                    data = numpy.fromstring(raw_data[0],t)
+                    data = restore_array(raw_data[0],t)
                 except Exception as e:
                     Logger().error("BAD FROMSTRING caller:%s msg_type:%s len(raw_data):%i t:%s" % (whosdaddy(), msg_type,len(raw_data), t) )
                     raise e
     else:
         try:
             # Both system messages and user pickled messages are unpickled here
+            if isinstance(raw_data,bytearray):
+                raw_data = str(raw_data)
             data = pickle.loads(raw_data)
         except Exception as e:
             Logger().error("BAD PICKLE msg_type:%s raw_data:%s" % (msg_type,raw_data) )
@@ -347,29 +828,139 @@ def deserialize_message(raw_data, msg_type):
 
     return data
 
-def robust_send_multi(socket, messages):
+def get_array_info(raw_data, msg_type, size=None):
     """
-    experimental cousin of robust_send
-    if we can agree that the overhead of always considering messages a list is negligible this can be folded into regular robust_send
+    Find the dtype and shape of a numpy array message that is still
+    serialized without deserializing it. Returns None for anything that is
+    not a numpy array.
 
-    TODO: Check (eg. with wireshark) if every send produces a tcp packet or if several messages can be packed into on tcp packet (which we hope is what happens)
+    If raw_data is only the start of the payload (at least the shape bytes)
+    the size of the whole payload must be given.
     """
+    if msg_type is None or msg_type <= constants.CMD_RAWTYPE or msg_type in (constants.CMD_BYTEARRAY, constants.CMD_OUT_OF_BAND) or compression.is_compressed(msg_type):
+        return None
 
-    
+    shapelen = msg_type / 1000
+    t = typeint_to_type[msg_type % 1000]
+    if shapelen:
+        shape = tuple(numpy.frombuffer(raw_data, numpy.dtype(int), count=shapelen/numpy.dtype(int).itemsize))
+    else:
+        if size is None:
+            size = len(raw_data)
+        shape = (size / t.itemsize,)
+    return (t, shape)
+
+def check_receive_buffer(buffer):
+    """
+    Make sure a buffer passed for a receive can be written in place
+    """
+    if isinstance(buffer, bytearray):
+        return
+    if not isinstance(buffer, numpy.ndarray):
+        raise MPIException("Can only receive into a numpy array or a bytearray, not %s" % type(buffer))
+    if not buffer.flags.writeable:
+        raise MPIException("Can not receive into a read-only numpy array")
+
+def copy_into_buffer(data, buffer):
+    """
+    Copy a received message into a buffer supplied by the receiver. The
+    message must be of the same kind as the buffer and have exactly its
+    dtype and shape (or length for a bytearray), nothing is converted.
+    """
+    if isinstance(buffer, bytearray):
+        if not isinstance(data, bytearray):
+            raise MPIException("Received %s but the receive buffer is a bytearray" % type(data))
+        if len(data) != len(buffer):
+            raise MPIException("Received a bytearray of length %d but the receive buffer has length %d" % (len(data), len(buffer)))
+        buffer[:] = data
+    else:
+        if not isinstance(data, numpy.ndarray):
+            raise MPIException("Received %s but the receive buffer is a numpy array" % type(data))
+        if data.dtype != buffer.dtype or data.shape != buffer.shape:
+            raise MPIException("Received a %s array of shape %s but the receive buffer is a %s array of shape %s" % (data.dtype, data.shape, buffer.dtype, buffer.shape))
+        buffer[...] = data
+
+    return buffer
+
+def gather_segments(messages, limit=None):
+    """
+    Group a list of serialized segments (header, shapebytes, payloads) into
+    as few send buffers as possible.
+
+    Python 2 has no sendmsg/writev so the closest we get to a vectored send
+    is copying runs of small segments into one bytearray, letting a header
+    and a small payload leave in a single send call. Segments larger than
+    limit are passed through untouched since copying them would cost more
+    than the extra system call.
+    """
+    if limit is None:
+        limit = SEND_COALESCE_LIMIT
+
+    segments = []
+    run = [] # consecutive small segments waiting to be glued together
+    run_length = 0
     for message in messages:
-        target = len(message) # how many bytes to send
-        transmitted_bytes = 0
-        
+        length = len(message)
+        if run and (length > limit or run_length + length > limit):
+            segments.append(_join_segments(run))
+            run = []
+            run_length = 0
+
+        if length > limit:
+            segments.append(message)
+        else:
+            run.append(message)
+            run_length += length
+
+    if run:
+        segments.append(_join_segments(run))
+
+    return segments
+
+def slice_segments(segments, start, end):
+    """
+    Cut bytes start to end out of a list of serialized segments, as if they
+    were one buffer. The pieces are memoryviews on the original segments so
+    nothing is copied.
+    """
+    pieces = []
+    position = 0
+    for segment in segments:
+        length = len(segment)
+        if position + length > start and position < end:
+            view = memoryview(segment)
+            pieces.append(view[max(start-position, 0):min(end-position, length)])
+        position += length
+        if position >= end:
+            break
+
+    return pieces
+
+def _join_segments(run):
+    """
+    Copy a run of segments into one buffer. A lone segment is returned as is.
+    """
+    if len(run) == 1:
+        return run[0]
+
+    buf = bytearray()
+    for message in run:
+        buf += memoryview(message)
+    return buf
+
+def robust_send_multi(socket, messages):
+    """
+    Send a list of serialized segments back to back.
+
+    Small segments are coalesced with gather_segments so a typical small
+    message (header plus payload) costs one send call instead of one per
+    segment. Large segments are sent directly from the original buffer.
+    """
+    for message in gather_segments(messages):
         try:
-            while target > transmitted_bytes:
-                delta = socket.send(message)
-                transmitted_bytes += delta
-        
-                if target > transmitted_bytes: # Rare unseen case therefore relegated to if clause instead of always slicing in send
-                    message = message[transmitted_bytes:]
-                #Logger().debug("Message sliced because it was too large for one send.")
+            robust_send(socket, message)
         except Exception as e:            
-            Logger().error("BAD multisend caller:%s msg type%s len:%s of %i in all - msg:%s error:%s" % (whosdaddy(), type(message), target, len(messages), message, e ) )
+            Logger().error("BAD multisend caller:%s msg type%s len:%s of %i in all - msg:%s error:%s" % (whosdaddy(), type(message), len(message), len(messages), message, e ) )
             raise e
 
 def robust_send(socket, message):
@@ -377,17 +968,51 @@ def robust_send(socket, message):
     Python docs state that using socket.send the application is responsible for
     handling any unsent bytes. Even though we have not really seen it yet we use
     this wrapper to ensure that it all really gets sent.
+
+    On a partial write we continue from a memoryview on the message instead of
+    slicing, so the unsent remainder is never copied.
     """
     target = len(message) # how many bytes to send
-    transmitted_bytes = 0
     
     #DEBUG
     #Logger().debug("Robust SINGLE len:%i, type:%s content:%s" % (target, type(message), message))
-    while target > transmitted_bytes:
-        delta = socket.send(message)
-        transmitted_bytes += delta
+    transmitted_bytes = socket.send(message)
+
+    if target > transmitted_bytes: # Rare case therefore relegated to if clause instead of always creating a view
+        #Logger().debug("Message partially sent, continuing from a view.")
+        view = memoryview(message)
+        while target > transmitted_bytes:
+            transmitted_bytes += socket.send(view[transmitted_bytes:])
+
+def send_segments(client_socket, segments, index=0, offset=0):
+    """
+    Write as much of a list of send buffers as the kernel will take without
+    blocking, starting at segment index and byte offset. Returns the
+    (index, offset) to continue from, index == len(segments) meaning all was
+    written.
+
+    The sockets are shared with the receiving thread which relies on blocking
+    reads, so the non-blocking behaviour is asked for per call with
+    MSG_DONTWAIT rather than by switching the socket to non-blocking mode.
+    """
+    while index < len(segments):
+        segment = segments[index]
+        if offset:
+            segment = memoryview(segment)[offset:]
+
+        try:
+            sent = client_socket.send(segment, SEND_DONTWAIT)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise
+
+        offset += sent
+        if offset < len(segments[index]):
+            # The kernel buffer is full, wait for the socket to be writable
+            break
 
-        if target > transmitted_bytes: # Rare unseen case therefore relegated to if clause instead of always slicing in send
-            message = message[transmitted_bytes:]
-            #Logger().debug("Message sliced because it was too large for one send.")
+        index += 1
+        offset = 0
 
+    return index, offset
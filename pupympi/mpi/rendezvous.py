@@ -0,0 +1,339 @@
+#
+# Copyright 2010 Rune Bromer, Asser Schroeder Femoe, Frederik Hantho and Jan Wiberg
+# This file is part of pupyMPI.
+#
+# pupyMPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# pupyMPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 2
+# along with pupyMPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Rendezvous protocol for large point to point messages.
+
+Messages are normally sent eagerly, the payload goes out at once and the
+receiver keeps it until a receive matches. For large messages that means a
+receiver can end up holding any number of big payloads nobody asked for
+yet. A payload of RENDEZVOUS_THRESHOLD bytes or more is therefore sent in
+three steps instead:
+
+1. The sender keeps the serialized payload and sends a small ready to send
+   (RTS) message with the user tag, the size and the shape bytes of the
+   payload. The receiver queues it in the message matcher like any other
+   message, so the MPI ordering rules hold for large and small messages
+   alike, and probes see it.
+2. When a receive matches the RTS the receiver replies clear to send (CTS).
+3. The sender queues the payload. If the receive was given a buffer that
+   fits the payload exactly the payload is read straight into that buffer.
+
+The CTS and the payload are sent with TAG_RENDEZVOUS so they never reach
+the message matcher, the rendezvous id in the header tells which message
+they belong to.
+
+With STRIPE_CONNECTIONS above one, a payload of STRIPE_THRESHOLD bytes or
+more is split in that many stripes in step 3. Each stripe goes over its own
+connection (see SocketPool.get_stripe_socket) with its offset in the
+payload in the ack field of the header. The receiver reads the stripes
+straight to their place in the receive buffer, or in a buffer of its own,
+and completes the receive when all bytes are there.
+"""
+import threading, itertools, struct, numpy
+
+from mpi import constants
+from mpi.request import Request
+import mpi.network.utils as utils
+from mpi.network import compression
+
+SIZE_FORMAT = "l"
+
+class LargeMessage(object):
+    """
+    Stands in for the payload of a large message in the message matcher
+    until the payload is transferred. The prefix holds the shape bytes of
+    a multidimensional numpy array.
+    """
+    __slots__ = ('rendezvous_id', 'size', 'prefix', 'announcement_size')
+
+    def __init__(self, rendezvous_id, size, prefix, announcement_size):
+        self.rendezvous_id = rendezvous_id
+        self.size = size
+        self.prefix = prefix
+        self.announcement_size = announcement_size # Payload size of the RTS
+
+    def __len__(self):
+        return self.size
+
+class LargeReceive(object):
+    """
+    A receive request waiting for the payload of a large message.
+    """
+    __slots__ = ('request', 'size', 'in_place', 'buffer', 'data', 'remaining')
+
+    def __init__(self, request, size):
+        self.request = request
+        self.size = size
+        self.in_place = False # Whether the payload goes straight into request.out
+        self.buffer = None # uint8 array the stripes are read into
+        self.data = None # The payload when it is not received in place
+        self.remaining = size # Bytes of stripes still to come
+
+class Stripe(Request):
+    """
+    One stripe of a large payload. The stripes of a payload share a
+    [send request, stripes not yet sent] list, and the last one sent
+    completes the send request the way the network thread would have.
+    """
+    __slots__ = ('transfer',)
+
+    def __init__(self, transfer, communicator, participant, data, header):
+        super(Stripe, self).__init__("send", communicator, participant, constants.TAG_RENDEZVOUS, data=data, header=header)
+        self.transfer = transfer
+        self.is_prepared = True
+
+    def update(self, status, data=None, msg_type=None):
+        super(Stripe, self).update(status, data, msg_type)
+
+        # Only the network thread writing the stripes gets here
+        self.transfer[1] -= 1
+        if self.transfer[1] == 0:
+            request = self.transfer[0]
+            if request.acknowledge:
+                request.update(constants.REQUEST_UNACKED)
+            else:
+                request.update(constants.REQUEST_READY)
+
+class Rendezvous(object):
+    """
+    Keeps track of the large messages in transit from and to this process.
+
+    Announcements are matched by the MPI thread like other messages (or by
+    the receiving network thread with inline matching), replies and payloads
+    are handled by the receiving network thread as soon as they arrive.
+    Receives are matched by whichever thread posts them, so the bookkeeping
+    is done under a lock.
+    """
+    def __init__(self, mpi):
+        self.mpi = mpi
+        self.lock = threading.Lock()
+        self.sent = threading.Condition(self.lock) # Notified when a payload has been queued
+        self.ids = itertools.count()
+
+        self.sends = {} # rendezvous id -> send request waiting for CTS
+        self.receives = {} # (comm_id, sender, rendezvous id) -> LargeReceive
+
+    def is_large(self, request):
+        """
+        Tell whether a prepared send request should use the protocol.
+        Collective messages are always sent eagerly.
+        """
+        threshold = self.mpi.settings.RENDEZVOUS_THRESHOLD
+        if not threshold or request.multi or request.collective_header_information:
+            return False
+        return sum(len(segment) for segment in request.data) >= threshold
+
+    def start_send(self, request):
+        """
+        Announce a prepared send request to the receiver and keep it until
+        the receiver is ready. The header of the request is replaced with
+        the one for the payload step.
+        """
+        rendezvous_id = self.ids.next()
+
+        (length, rank, msg_type, tag, ack, comm_id, _, _) = utils.unpack_header(request.header)
+
+        # Hand on the shape of multidimensional arrays so probes can tell it
+        prefix = ""
+        if constants.CMD_RAWTYPE < msg_type < constants.CMD_COMPRESSED:
+            prefix = str(request.data[0][:msg_type / 1000])
+        payload = struct.pack(SIZE_FORMAT, length) + prefix
+
+        announcement = Request("send", request.communicator, request.participant, tag, data=[payload])
+        announcement.header = utils.prepare_header(rank, cmd=msg_type, tag=tag, ack=ack, comm_id=comm_id, payload_length=len(payload), collective_header_information=(constants.RENDEZVOUS_RTS, rendezvous_id))
+        announcement.global_rank = request.global_rank
+        announcement.is_prepared = True
+
+        request.header = utils.prepare_header(rank, cmd=msg_type, tag=constants.TAG_RENDEZVOUS, comm_id=comm_id, payload_length=length, collective_header_information=(constants.RENDEZVOUS_DATA, rendezvous_id))
+
+        with self.lock:
+            self.sends[rendezvous_id] = request
+
+        request.communicator.network.flow_control.submit(announcement)
+
+    def accept(self, request, message):
+        """
+        A receive request matched an announced message. Ask the sender for
+        the payload, the request is completed when it arrives.
+        """
+        (sender, tag, acknowledge, comm_id, msg_type, large_message) = message
+
+        with self.lock:
+            self.receives[(comm_id, sender, large_message.rendezvous_id)] = LargeReceive(request, large_message.size)
+
+        self.mpi.communicators[comm_id]._isend(None, sender, constants.TAG_RENDEZVOUS, collective_header_information=(constants.RENDEZVOUS_CTS, large_message.rendezvous_id))
+
+    def handle(self, item):
+        """
+        Handle a message that is part of the protocol, given as the same
+        tuple the MPI thread gets for any other message.
+        """
+        (rank, msg_type, tag, ack, comm_id, (step, rendezvous_id), raw_data) = item
+
+        if step == constants.RENDEZVOUS_RTS:
+            size = struct.unpack_from(SIZE_FORMAT, raw_data)[0]
+            large_message = LargeMessage(rendezvous_id, size, raw_data[struct.calcsize(SIZE_FORMAT):], len(raw_data))
+            self.mpi.deliver_message( (rank, tag, ack, comm_id, msg_type, large_message) )
+
+        elif step == constants.RENDEZVOUS_CTS:
+            with self.lock:
+                request = self.sends[rendezvous_id]
+
+            if request.test_cancelled():
+                # The receiver is waiting for the payload now, so it is sent
+                # all the same, just not on behalf of the cancelled request
+                payload = Request("send", request.communicator, request.participant, request.tag, data=request.data, header=request.header)
+                payload.global_rank = request.global_rank
+                payload.is_prepared = True
+                request = payload
+
+            settings = self.mpi.settings
+            length = utils.payload_length(request.header)
+            if settings.STRIPE_CONNECTIONS > 1 and length >= settings.STRIPE_THRESHOLD:
+                self._send_stripes(request, settings.STRIPE_CONNECTIONS, length)
+            else:
+                request.communicator.network.t_out.add_out_request(request)
+
+            # The send is only forgotten once the payload is queued, see flush
+            with self.lock:
+                del self.sends[rendezvous_id]
+                self.sent.notifyAll()
+
+        elif step == constants.RENDEZVOUS_DATA:
+            with self.lock:
+                receive = self.receives.pop((comm_id, rank, rendezvous_id))
+
+            if receive.in_place:
+                receive.request.update(constants.REQUEST_READY, data=receive.request.out)
+            else:
+                receive.request.update(constants.REQUEST_READY, data=raw_data, msg_type=msg_type)
+
+        elif step == constants.RENDEZVOUS_STRIPE:
+            key = (comm_id, rank, rendezvous_id)
+            with self.lock:
+                receive = self.receives[key]
+
+                # Small stripes are not read in place (see MessageReader)
+                if not isinstance(raw_data, numpy.ndarray):
+                    buffer = self._stripe_buffer(receive, msg_type)
+                    buffer[ack:ack+len(raw_data)] = numpy.frombuffer(raw_data, numpy.uint8)
+
+                receive.remaining -= len(raw_data)
+                if receive.remaining:
+                    return
+                del self.receives[key]
+
+            if receive.in_place:
+                receive.request.update(constants.REQUEST_READY, data=receive.request.out)
+            else:
+                receive.request.update(constants.REQUEST_READY, data=receive.data, msg_type=msg_type)
+
+    def flush(self):
+        """
+        Block until the payloads of all large messages sent from here have
+        been asked for and queued for sending, so finalize can flush them to
+        the network like any other message. Cancelled messages are not
+        waited for.
+        """
+        with self.lock:
+            while [ request for request in self.sends.values() if not request.test_cancelled() ]:
+                self.sent.wait()
+
+    def _send_stripes(self, request, count, length):
+        """
+        Split the payload of a send request in count stripes and queue each
+        on its own connection. The request completes when all are sent.
+        """
+        (_, rank, msg_type, _, _, comm_id, _, rendezvous_id) = utils.unpack_header(request.header)
+
+        stripe_size = -(-length // count)
+        offsets = range(0, length, stripe_size)
+        transfer = [request, len(offsets)]
+
+        network = request.communicator.network
+        for (stripe, offset) in enumerate(offsets):
+            end = min(offset + stripe_size, length)
+            header = utils.prepare_header(rank, cmd=msg_type, tag=constants.TAG_RENDEZVOUS, ack=offset, comm_id=comm_id, payload_length=end-offset, collective_header_information=(constants.RENDEZVOUS_STRIPE, rendezvous_id))
+            data = utils.slice_segments(request.data, offset, end)
+
+            stripe_request = Stripe(transfer, request.communicator, request.participant, data, header)
+            stripe_request.global_rank = request.global_rank
+            network.t_out.add_out_request(stripe_request, stripe)
+
+    def receive_buffer(self, rank, msg_type, tag, ack, comm_id, coll_header, length):
+        """
+        Find the buffer a payload or stripe should be read into. A payload
+        goes into the buffer given to the matching receive if it is a
+        bytearray or a one-dimensional numpy array that fits it exactly,
+        otherwise None is returned. Stripes go to their offset in that
+        buffer, or in one set aside for the whole payload. Called by the
+        network thread reading the message.
+        """
+        (step, rendezvous_id) = coll_header
+        if step not in (constants.RENDEZVOUS_DATA, constants.RENDEZVOUS_STRIPE):
+            return None
+
+        with self.lock:
+            receive = self.receives.get((comm_id, rank, rendezvous_id))
+            if receive is None:
+                return None
+
+            if step == constants.RENDEZVOUS_STRIPE:
+                return self._stripe_buffer(receive, msg_type)[ack:ack+length]
+
+            buffer = self._user_buffer(receive, msg_type)
+            if buffer is not None:
+                receive.in_place = True
+            return buffer
+
+    def _stripe_buffer(self, receive, msg_type):
+        """
+        The buffer all the stripes of a payload are read into, picked when
+        the first stripe arrives.
+
+        NOTE: Caller makes sure the lock is held
+        """
+        if receive.buffer is None:
+            receive.buffer = self._user_buffer(receive, msg_type)
+            if receive.buffer is not None:
+                receive.in_place = True
+            else:
+                receive.data = bytearray(receive.size)
+                receive.buffer = numpy.frombuffer(receive.data, numpy.uint8)
+
+        return receive.buffer
+
+    def _user_buffer(self, receive, msg_type):
+        """
+        The buffer given to a receive as a uint8 array, if the payload can
+        be read straight into it.
+        """
+        out = receive.request.out
+        if out is None or msg_type <= constants.CMD_RAWTYPE or msg_type / 1000 or msg_type == constants.CMD_OUT_OF_BAND or compression.is_compressed(msg_type):
+            return None
+
+        if msg_type == constants.CMD_BYTEARRAY:
+            if not isinstance(out, bytearray) or len(out) != receive.size:
+                return None
+            return numpy.frombuffer(out, numpy.uint8)
+
+        if not isinstance(out, numpy.ndarray) or out.ndim != 1 or not out.flags.c_contiguous:
+            return None
+        if out.dtype != utils.typeint_to_type[msg_type] or out.nbytes != receive.size:
+            return None
+        return out.view(numpy.uint8)
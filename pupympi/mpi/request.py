@@ -20,22 +20,66 @@ from mpi.logger import Logger
 from mpi import constants
 import mpi.network.utils as utils
 
-import threading
+import threading, numpy
+
+# All requests share one condition for waiting on completion instead of
+# carrying an Event each. Requests are created at a high rate and mostly
+# complete before anyone waits for them, so a per request lock and event is
+# a lot of allocation for nothing. Completing a request takes the lock and
+# notifies every waiter, who then check their own request. There is usually
+# only the one user thread waiting.
+completion_lock = threading.Lock()
+completion = threading.Condition(completion_lock)
+
+class Waiter(object):
+    """
+    A single wait_for_some call. It is registered in the waiter slot of the
+    requests it waits on and completing one of them records it here and
+    wakes up only this call, so nothing has to be scanned again.
+    """
+    __slots__ = ('condition', 'completed')
+
+    def __init__(self):
+        self.condition = threading.Condition(completion_lock)
+        self.completed = []
+
+    def signal(self, handle):
+        # Called with the completion lock held
+        self.completed.append(handle)
+        self.condition.notify()
+
+def wait_for_some(request_list):
+    """
+    Block until at least one of the requests (point to point, persistent or
+    collective) has completed and return the completed ones. If some are
+    already completed they are returned in list order, otherwise a waiter
+    is registered with every request and the ones that signal it are
+    returned in the order they completed.
+    """
+    with completion:
+        completed = [ request for request in request_list if request.test() ]
+        if completed:
+            return completed
+
+        waiter = Waiter()
+        # A persistent request completes through the request of its current
+        # start, but the caller must get the persistent request back
+        targets = [ request.active if isinstance(request, PersistentRequest) else request for request in request_list ]
+        for (target, request) in zip(targets, request_list):
+            target.waiter = (waiter, request)
+        try:
+            while not waiter.completed:
+                waiter.condition.wait()
+        finally:
+            for target in targets:
+                target.waiter = None
+        return waiter.completed
 
 class BaseRequest(object):
+    __slots__ = ('status', 'is_pickled', 'is_prepared')
+
     def __init__(self):
-        self.status = "new"
-        # Start a lock for this request object. The lock should be taken
-        # whenever we change the content. It should be legal to read
-        # information without locking (like test()). We implement the release() and
-        # acquire function on this class directly so the variable stays private
-        self._lock = threading.Lock()
-        """
-        NOTE: This lock is never used. We should consider possible race conditions
-        arising from concurrent status updates on a request object. If none are
-        plausible we should remove this lock and with it the release and acquire functions
-        below.
-        """
+        self.status = constants.REQUEST_NEW
 
         # Flag to keep track if the data is pickled. Some methods
         # will pickle directly.
@@ -43,24 +87,10 @@ class BaseRequest(object):
         # Flag to signal that header has been appended (and data serialized)
         self.is_prepared = False
 
-        # Start an event for waiting on the request
-        self._waitevent = threading.Event()
-
-    def release(self, *args, **kwargs):
-        """
-        Just forwarding method call to the internal lock
-        """
-        return self._lock.release(*args, **kwargs)
-
-    def acquire(self, *args, **kwargs):
-        """
-        Just forwarding method call to the internal lock
-        """
-        return self._lock.acquire(*args, **kwargs)
-
 class Request(BaseRequest):
+    __slots__ = ('request_type', 'communicator', 'participant', 'tag', 'acknowledge', 'data', 'header', 'multi', 'payload_size', 'cmd', 'msg_type', 'out', 'global_rank', 'collective_header_information', 'waiter')
 
-    def __init__(self, request_type, communicator, participant, tag, acknowledge=False, header=None, data=None, cmd=constants.CMD_USER, multi=False, payload_size=0, collective_header_information=()):
+    def __init__(self, request_type, communicator, participant, tag, acknowledge=False, header=None, data=None, cmd=constants.CMD_USER, multi=False, payload_size=0, collective_header_information=(), out=None):
         super(Request, self).__init__()
         if request_type not in ('bcast_send', 'send','recv'):
             raise MPIException("Invalid request_type in request creation. This should never happen. ")
@@ -76,20 +106,19 @@ class Request(BaseRequest):
         self.payload_size = payload_size # combined bytesize of payloads if single payload this is 0 for now
 
         self.cmd = cmd
+        self.msg_type = None # type of a received payload that is still serialized (is_pickled)
+        self.out = out # receive buffer supplied by the user, if any
 
         self.global_rank = None # Global rank of recipient process is None for ingoing requests and None for out requests until the request is prepared
 
         self.collective_header_information = collective_header_information
 
-        # Meta information we use to keep track of what is going on. There are some different
-        # status a request object can be in:
-        # 'new' ->       The object is newly created. If this is send the lower layer can start to
-        #                do stuff with the data
-        # 'unacked'   -> An ssend that has not been acknowledged yet.
-        # 'ready'     -> Means we have the data (in receive) or pickled the data (send) and can
-        #                safely return from a test or wait call. For an ssend this means that the
-        #                reciever has acknowledged receiving.
-        # 'cancelled' -> The user cancelled the request. A some later point this will be removed
+        self.waiter = None # (Waiter, handle) of a wait_for_some call waiting on this request
+
+        # The status (see the REQUEST_ constants) tells what is going on with
+        # the request. For an ssend the handle is the receive request for the
+        # acknowledgement, so it becomes ready when the reciever has
+        # acknowledged receiving.
 
         #Logger().debug("Request object created for communicator:%s, tag:%s, data:%s, ack:%s, request_type:%s and participant:%s" % (self.communicator.name, self.tag, self.data, self.acknowledge, self.request_type, self.participant))
 
@@ -131,42 +160,69 @@ class Request(BaseRequest):
         else:
             if not self.is_prepared:
                 # Create the proper data structure and pickle the data
-                header, payloads = utils.prepare_message(self.data, self.communicator.rank(), is_serialized=self.is_pickled, **common_kwargs)
+                # Collective requests keep the payload as it is, they may
+                # slice or forward it on the receiving side
+                compressor = None
+                out_of_band = False
+                if not self.collective_header_information:
+                    compressor = self.communicator.compressor
+                    out_of_band = True
+                header, payloads = utils.prepare_message(self.data, self.communicator.rank(), is_serialized=self.is_pickled, compressor=compressor, out_of_band=out_of_band, **common_kwargs)
                 self.data = payloads
                 self.header = header
                 # FIXME: Assign directly above
 
-    def update(self, status, data=None):
+    def update(self, status, data=None, msg_type=None):
         #Logger().debug("- changing status from %s to %s, for data: %s, tag:%s" %(self.status, status, data,self.tag))
-        if self.status not in ("finished", "cancelled"): # No updating on dead requests
-            self.status = status
-        else:
-            raise Exception("Updating a request from %s to %s" % self.status, status)
+        if self.status >= constants.REQUEST_FINISHED: # No updating on dead requests
+            raise Exception("Updating a request from %s to %s" % (self.status, status))
 
         # We only update if there is data (ie. a recv operation)
         if data is not None:
             self.data = data
+            # A received payload comes with its message type and is only
+            # deserialized when the user waits for it, so the MPI thread
+            # does not spend time on it
+            self.msg_type = msg_type
+            self.is_pickled = msg_type is not None
 
+        # The status is set last since test() reads it without locking.
         # Enable the wait operation to complete if the status is ready or cancelled
-        if status in ("ready", "cancelled"):
-            self._waitevent.set()
+        if status >= constants.REQUEST_READY:
+            with completion:
+                self.status = status
+                if self.waiter is not None:
+                    (waiter, handle) = self.waiter
+                    waiter.signal(handle)
+                completion.notifyAll()
+        else:
+            self.status = status
 
     def cancel(self):
         """
         Cancel a request. This can be used to free memory, but the request must be redone
         by all parties involved.
+
+        A receive that has already been matched with a message can not be
+        cancelled. It completes as usual and :func:`test_cancelled` stays
+        False.
         """
         # TODO: The cancel test is simplistic and we should ensure that we can actually cancel in proper MPI fashion
 
-        # We just set a status and return right away. What needs to happen can be done
-        # at a later point
-        self.update("cancelled")
+        # A receive still waiting for a message is taken out of matching. If
+        # it is not waiting any more the message is (being) delivered to it.
+        if self.request_type == 'recv' and not self.communicator.mpi.message_matcher.withdraw(self):
+            return
+
+        # Otherwise we just set a status and return right away. What needs to
+        # happen can be done at a later point
+        self.update(constants.REQUEST_CANCELLED)
 
     def test_cancelled(self):
         """
         Returns True if this request was cancelled.
         """
-        return self.status == "cancelled"
+        return self.status == constants.REQUEST_CANCELLED
 
     def wait(self):
         """
@@ -179,19 +235,29 @@ class Request(BaseRequest):
         On successfull completion the ressources occupied by this request object will
         be garbage collected.
         """
-        if self.status == "cancelled":
+        if self.status == constants.REQUEST_CANCELLED:
             #Logger().debug("WAIT on cancel illegality")
             raise MPIException("Illegal to wait on a cancelled request object")
 
-        self._waitevent.wait()
+        if self.status < constants.REQUEST_READY:
+            with completion:
+                while self.status < constants.REQUEST_READY:
+                    completion.wait()
         #Logger().info("Waiting done for request %s wait, tag: %s" % (self.request_type,self.tag) )
 
         # We're done at this point. Set the request to be completed so it can be removed
         # later.
-        self.status = 'finished'
+        self.status = constants.REQUEST_FINISHED
 
         # Return none or the data
         if self.request_type == 'recv':
+            if self.is_pickled:
+                self.data = utils.deserialize_message(self.data, self.msg_type)
+                self.is_pickled = False
+            if self.out is not None and self.data is not self.out:
+                # The received array is only a view on the network buffer
+                # so copying it is the only copy the message goes through
+                self.data = utils.copy_into_buffer(self.data, self.out)
             return self.data
 
     def test(self):
@@ -199,4 +265,102 @@ class Request(BaseRequest):
         A non-blocking check to see if the request is ready to complete. If true a
         following wait() should return very fast.
         """
-        return self._waitevent.is_set()
+        return self.status >= constants.REQUEST_READY
+
+class PersistentRequest(object):
+    """
+    A send or receive that is set up once and started many times, created
+    with :func:`send_init <mpi.communicator.Communicator.send_init>` or
+    :func:`recv_init <mpi.communicator.Communicator.recv_init>`.
+
+    Validation and routing are done when the request is created. For a send
+    from a contiguous numpy array or a bytearray the header and the views on
+    the buffer are prepared once as well, so :func:`start` only queues them
+    and the current contents of the buffer are sent. Other data is
+    serialized again on every start so changes to it are picked up too.
+
+    Every start must be completed with :func:`wait` (or a successful
+    :func:`test`) before the request is started again.
+    """
+    __slots__ = ('request_type', 'communicator', 'participant', 'tag', 'data', 'out', 'global_rank', 'header', 'segments', 'active')
+
+    def __init__(self, request_type, communicator, participant, tag, data=None, out=None):
+        self.request_type = request_type
+        self.communicator = communicator
+        self.participant = participant
+        self.tag = tag
+        self.data = data # the buffer or object to send
+        self.out = out # receive buffer supplied by the user, if any
+
+        self.global_rank = None
+        self.header = None
+        self.segments = None
+        self.active = None # The Request of the current start, if any
+
+        if request_type == "send" and participant != communicator.rank():
+            self.global_rank = communicator.group().members[participant]['global_rank']
+
+            if isinstance(data, bytearray) or (isinstance(data, numpy.ndarray) and data.flags.c_contiguous):
+                self.header, self.segments = utils.prepare_message(data, communicator.rank(), cmd=constants.CMD_USER, tag=tag, comm_id=communicator.id)
+                # Multidimensional arrays are serialized as a copy, but a view
+                # is needed to send what is in the array when started
+                self.segments[-1] = data.reshape(-1).view(numpy.uint8) if isinstance(data, numpy.ndarray) else data
+
+    def start(self):
+        """
+        Start the request. For a send the data goes out as it looks right now.
+        """
+        if not self.test():
+            raise MPIException("A persistent request can not be started while it is active")
+
+        communicator = self.communicator
+        if self.request_type == "recv":
+            request = Request("recv", communicator, self.participant, self.tag, out=self.out)
+            communicator.mpi.post_receive(request)
+        elif self.global_rank is None:
+            request = Request("send", communicator, self.participant, self.tag, data=self.data)
+            communicator._send_to_self(request)
+        else:
+            request = Request("send", communicator, self.participant, self.tag, data=self.data)
+            request.global_rank = self.global_rank
+            if self.header is not None:
+                request.header = self.header
+                request.data = list(self.segments)
+            else:
+                request.header, request.data = utils.prepare_message(self.data, communicator.rank(), cmd=constants.CMD_USER, tag=self.tag, comm_id=communicator.id, out_of_band=True)
+
+            if communicator.mpi.rendezvous.is_large(request):
+                # Only the header of this start is replaced, the prepared
+                # header and segments stay as they are for the next one
+                communicator.mpi.rendezvous.start_send(request)
+            else:
+                communicator.network.flow_control.submit(request)
+
+        self.active = request
+
+    def wait(self):
+        """
+        Wait for the current start to complete. Returns the received data for
+        a receive. Waiting for a request that is not started returns None
+        right away.
+        """
+        if self.active is None:
+            return None
+        return self.active.wait()
+
+    def test(self):
+        """
+        Test if the current start has completed. A request that is not
+        started counts as completed.
+        """
+        return self.active is None or self.active.test()
+
+    def cancel(self):
+        """
+        Cancel the current start, if any. The request can be started again.
+        """
+        if self.active is not None:
+            self.active.cancel()
+
+    def test_cancelled(self):
+        return self.active is not None and self.active.test_cancelled()
@@ -77,6 +77,53 @@ STATIC_TREE_FANOUT_COUNT = 2
 SOCKET_RECEIVE_BYTECOUNT = 4096
 SOCKET_POOL_SIZE = 10  # FIXME: Use this
 
+# Connections a process has in progress at once when it connects to the
+# others in the full network startup or prewarms connections (see
+# Network.connect)
+CONNECT_WINDOW = 64
+
+# Size in bytes of each of the two ring buffers in a shared memory channel
+# between ranks on the same host
+SHARED_MEMORY_RING_SIZE = 4*1024*1024
+
+# Point to point payloads of this many bytes or more are only sent once the
+# receiver has matched them (see mpi.rendezvous), smaller ones are sent at
+# once. None sends everything at once.
+RENDEZVOUS_THRESHOLD = 256*1024
+
+# Number of connections between a pair of processes. With more than one,
+# the payload of a large message (see RENDEZVOUS_THRESHOLD) of at least
+# STRIPE_THRESHOLD bytes is split in this many stripes that are sent over
+# separate connections at once and put together by the receiver. Smaller
+# messages always use a single connection.
+STRIPE_CONNECTIONS = 1
+STRIPE_THRESHOLD = 1024*1024
+
+# Bytes of point to point messages (headers included) a process may have in
+# flight to another process or waiting there for a matching receive. A sender
+# that has used up its budget queues further messages until the receiver
+# gives credit back (see mpi.network.flowcontrol). None turns this off.
+FLOW_CONTROL_BUDGET = 32*1024*1024
+
+# Layout of message headers, see mpi.network.utils. 2 is the compact one, 1
+# a fixed layout of native longs for hosts of the same word size. Neither
+# talks to processes of earlier releases. All processes of a job must use
+# the same. The utilities (see bin/utils) follow the setting through the
+# handle file written by mpirun.
+HEADER_VERSION = 2
+
+# Compression of point to point messages, the name of a codec from
+# mpi.network.compression ("zlib" is built in) or None for no compression.
+# Communicators can turn it on and off with set_compression.
+COMPRESSION = None
+
+# Messages smaller than this many bytes are never compressed
+COMPRESSION_MIN_SIZE = 4096
+
+# Messages that do not compress to this fraction of their size are sent
+# uncompressed, and the following few messages are sent without trying
+COMPRESSION_MAX_RATIO = 0.8
+
 if COLLECTIVE_FORCE_BINOMIAL_TREE:
     # Disable the flat tree settings.
     FLAT_TREE_MIN = 100
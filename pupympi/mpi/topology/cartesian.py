@@ -154,6 +154,37 @@ class Cartesian(object):
 
         return rank_target
 
+    def neighbours(self, rank=None):
+        """
+        The ranks one step away from a rank (by default our own) in either
+        direction along each dimension, wrapping around periodic dimensions.
+        Each rank is only listed once.
+        """
+        if rank is None:
+            rank = self.communicator.rank()
+
+        coords = self.coords(rank)
+        result = []
+        for direction in range(len(self.dims)):
+            for displacement in (-1, 1):
+                target = list(coords)
+                target[direction] += displacement
+                if self.periodic[direction]:
+                    target[direction] %= self.dims[direction]
+                elif not 0 <= target[direction] < self.dims[direction]:
+                    continue
+                neighbour = self.rank(target)
+                if neighbour != rank and neighbour not in result:
+                    result.append(neighbour)
+        return result
+
+    def prewarm(self):
+        """
+        Connect to our neighbours in the grid before the first message to
+        them, see Communicator.prewarm.
+        """
+        return self.communicator.prewarm(self.neighbours())
+
     def map(self):
         """
         MPI_CART_MAP computes an ''optimal'' placement for the calling process
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# meta-description: The contact table scattered along the bootstrap tree reaches every rank complete and correct
+# meta-expectedresult: 0
+# meta-minprocesses: 7
+
+from mpi import MPI
+from mpi.network import bootstrap
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+# Every rank is the child of exactly one other in the tree
+parents = {}
+def walk(lo, hi):
+    for (child, child_hi) in bootstrap.children(lo, hi):
+        assert child not in parents
+        parents[child] = lo
+        walk(child, child_hi)
+walk(0, size)
+assert sorted(parents) == range(1, size)
+
+# Everybody got the same table, and it tells how to reach everybody
+assert len(mpi.network.all_procs) == size
+contact = (mpi.network.hostname, mpi.network.port)
+contacts = world.allgather(contact)
+for (global_rank, info) in mpi.network.all_procs.items():
+    if info['connection_type'] == "tcp":
+        assert info['connection_info'] == contacts[global_rank]
+
+# Talk to everybody
+assert world.allgather(rank) == range(size)
+for other in range(size):
+    if other != rank:
+        world.send(rank, other)
+for other in range(size):
+    if other != rank:
+        assert world.recv(other) == other
+
+mpi.finalize()
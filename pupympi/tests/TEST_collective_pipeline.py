@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# meta-description: Deep pipelines of non-blocking collectives on several communicators each complete with their own data
+# meta-expectedresult: 0
+# meta-minprocesses: 4
+# meta-max_runtime: 60
+
+from mpi import MPI
+from mpi.collective.operations import MPI_sum
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+DEPTH = 50
+
+communicators = [world, world.comm_dup(), world.comm_dup()]
+
+handles = []
+for i in range(DEPTH):
+    for (c, comm) in enumerate(communicators):
+        root = (i + c) % size
+        data = None
+        if rank == root:
+            data = ("bcast", i, c)
+        handles.append( (("bcast", i, c), comm.ibcast(data, root)) )
+        handles.append( ((i+c)*size + sum(range(size)), comm.iallreduce(i+c+rank, MPI_sum)) )
+
+# Wait in reverse order of posting
+for (expected, handle) in reversed(handles):
+    assert handle.wait() == expected
+
+mpi.finalize()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# meta-description: Compressed messages of all kinds arrive intact, incompressible data is sent as it is
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+from mpi.exceptions import MPIException
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+table = dict(("key %d" % i, "value %d" % (i % 10)) for i in range(2000))
+zeros = numpy.zeros((100, 50), dtype=numpy.float32)
+counting = bytearray("abcd" * 5000)
+noise = numpy.random.RandomState(1).bytes(50000)
+
+world.set_compression("zlib", min_size=1024)
+
+if rank == 0:
+    world.send(table, 1)
+    world.send(zeros, 1)
+    world.send(counting, 1)
+    world.ssend(numpy.arange(10000), 1)
+    world.send("too small to compress", 1)
+    world.send(noise, 1)
+
+    assert world.compressor.ratio() < 0.5
+    assert world.compressor.bypass > 0
+
+    try:
+        world.set_compression("no such codec")
+        assert False, "An unknown codec should fail"
+    except MPIException:
+        pass
+
+elif rank == 1:
+    assert world.recv(0) == table
+
+    message = world.mprobe(0)
+    assert message.dtype == numpy.float32 and message.shape == (100, 50)
+    received = world.mrecv(message, out=numpy.ones((100, 50), dtype=numpy.float32))
+    assert (received == zeros).all()
+
+    assert world.recv(0) == counting
+    assert (world.recv(0) == numpy.arange(10000)).all()
+    assert world.recv(0) == "too small to compress"
+    assert world.recv(0) == noise
+
+    # Nothing compressed here yet, not even tried
+    assert world.compressor.ratio() == 1.0
+
+# Collectives are not compressed but work alongside
+assert world.bcast(table if rank == 0 else None, 0) == table
+
+world.set_compression(None)
+assert world.compressor is None
+
+mpi.finalize()
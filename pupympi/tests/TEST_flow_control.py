@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# meta-description: A fast sender is held back by the credit of a slow receiver and all messages arrive in order
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import time
+from mpi import MPI
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+# A small budget so the test does not need much data
+BUDGET = 64*1024
+mpi.network.flow_control.budget = BUDGET
+world.barrier()
+
+COUNT = 1000
+message = "x" * 1000
+
+if rank == 0:
+    handles = [world.isend((i, message), 1) for i in range(COUNT)]
+    handles.append(world.isend("done", 1))
+
+    # Most of the messages can not leave before the receiver catches up
+    time.sleep(0.5)
+    assert mpi.get_metrics()["stalled_messages"] > COUNT / 2
+
+    world.waitall(handles)
+
+    metrics = mpi.get_metrics()
+    assert metrics["stalled_messages"] == 0
+    assert metrics["stalled_total"] > COUNT / 2
+    assert metrics["stall_time"] > 0
+
+elif rank == 1:
+    # Let the sender run into the budget
+    time.sleep(1)
+
+    metrics = mpi.get_metrics()
+    assert 0 < metrics["unexpected_messages"] <= BUDGET / len(message) + 1
+
+    for i in range(COUNT):
+        assert world.recv(0) == (i, message)
+    assert world.recv(0) == "done"
+
+    assert mpi.get_metrics()["unexpected_messages_peak"] <= BUDGET / len(message) + 1
+
+world.barrier()
+
+mpi.finalize()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# meta-description: Message headers of both layouts decode to what was encoded and small ones are compact
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+from mpi import MPI
+from mpi import constants
+from mpi.network import utils
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+# (payload length, rank, cmd, tag, ack, comm_id, collective class id, collective sequence)
+cases = [
+    (0, 0, constants.CMD_USER, 0, 0, 0, -1, -1),
+    (12, 3, constants.CMD_USER, constants.MPI_TAG_ANY, 1, 1, -1, -1),
+    (8, -1, constants.CMD_PING, constants.TAG_CREDIT, 0, 0, -1, -1),
+    (2**40, 1023, constants.CMD_RAWTYPE+105+3000, 2**31-1, 2**33, 2**20, constants.RENDEZVOUS_STRIPE, 2**40),
+    (4096, 5, constants.CMD_COMPRESSED + constants.CMD_USER, 7, 0, 2, 12, 123456),
+    (100, 2, 3*constants.CMD_COMPRESSED + constants.CMD_RAWTYPE+111, -300, 1, 3, -1, 0),
+]
+
+for version in (utils.HEADER_VERSION, utils.FIXED_HEADER_VERSION):
+    for (lpd, r, cmd, tag, ack, comm_id, coll_class_id, coll_sequence) in cases:
+        header = utils.prepare_header(r, cmd=cmd, tag=tag, ack=ack, comm_id=comm_id, payload_length=lpd, collective_header_information=(coll_class_id, coll_sequence), version=version)
+        decoded = utils.unpack_header(header, version=version)
+        assert tuple(decoded) == (lpd, r, cmd, tag, ack, comm_id, coll_class_id, coll_sequence), (version, decoded)
+
+        # From the middle of a buffer as well
+        buffer = bytearray("junk") + bytearray(header)
+        assert tuple(utils.unpack_header(buffer, 4, version=version)) == tuple(decoded)
+
+# A small point to point message has an 8 byte header (unless the job is
+# run with the fixed layout)
+header = utils.prepare_header(rank, cmd=constants.CMD_USER, tag=1, comm_id=world.id, payload_length=20)
+if utils.header_version == utils.HEADER_VERSION:
+    assert len(header) == 8
+assert utils.payload_length(header) == 20
+
+# Messages of all sizes and with odd tags still get through
+for (length, tag) in ((0, 0), (1, 1), (127, 64), (128, 2**20), (70000, 2**31-1)):
+    data = "x" * length
+    if rank == 0:
+        for other in range(1, size):
+            world.send(data, other, tag)
+    else:
+        assert world.recv(0, tag) == data
+
+mpi.finalize()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# meta-description: Point to point messages matched inline by the network thread are acknowledged, kept in order and large ones get through
+# meta-expectedresult: 0
+# meta-minprocesses: 3
+# meta-max_runtime: 30
+
+import time
+import numpy
+from mpi import MPI
+from mpi import constants
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+# Same as running with --inline-matching, but only from here on so nothing
+# is in transit when it is turned on
+world.barrier()
+mpi.network.t_in.inline_matching = True
+world.barrier()
+
+# Synchronized sends are only complete once the receiver has acknowledged,
+# both with the receive posted first and with the message arriving first
+if rank == 0:
+    world.ssend("early", 1, 1)
+    start = time.time()
+    world.ssend("late", 1, 2)
+    assert time.time() - start > 0.4
+elif rank == 1:
+    request = world.irecv(0, 1)
+    assert request.wait() == "early"
+    time.sleep(0.5)
+    assert world.recv(0, 2) == "late"
+
+world.barrier()
+
+# Wildcard receives get the messages of every sender in the order they were
+# sent, whether they were posted before or after the messages arrived
+COUNT = 50
+if rank == 0:
+    posted = [ world.irecv(constants.MPI_SOURCE_ANY, constants.MPI_TAG_ANY) for i in range(COUNT) ]
+world.barrier()
+
+if rank == 0:
+    received = [ request.wait() for request in posted ]
+    received.extend( world.recv(constants.MPI_SOURCE_ANY, constants.MPI_TAG_ANY) for i in range(COUNT*(size-1) - COUNT) )
+
+    expected = dict( (sender, 0) for sender in range(1, size) )
+    for (sender, i) in received:
+        assert i == expected[sender], (sender, i, expected[sender])
+        expected[sender] += 1
+    assert all( n == COUNT for n in expected.values() )
+else:
+    for i in range(COUNT):
+        world.send((rank, i), 0, 1 + i % 3)
+
+world.barrier()
+
+# Large messages go through the rendezvous protocol, announced to and
+# accepted by the network thread
+large = numpy.arange(mpi.settings.RENDEZVOUS_THRESHOLD / 4, dtype=numpy.float64)
+if rank == 0:
+    request = world.irecv(1, 3)
+    world.send(large, 1, 4)
+    assert (request.wait() == large).all()
+    assert (world.recv(constants.MPI_SOURCE_ANY, 5) == large * 2).all()
+elif rank == 1:
+    world.send(large, 0, 3)
+    time.sleep(0.2)
+    assert (world.recv(0, 4) == large).all()
+    world.ssend(large * 2, 0, 5)
+
+world.barrier()
+
+mpi.finalize()
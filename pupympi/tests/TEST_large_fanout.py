@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# meta-description: Large sends to several peers at once are interleaved, none of them may be corrupted
+# meta-expectedresult: 0
+# meta-minprocesses: 4
+# meta-max_runtime: 60
+
+import numpy
+from mpi import MPI
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+LARGE_TAG = 1
+SMALL_TAG = 2
+
+ELEMENTS = 4*1024*1024 # 32 MB of float64 per peer
+
+if rank == 0:
+    handles = []
+    for peer in range(1, size):
+        large = numpy.arange(ELEMENTS, dtype=numpy.float64) + peer
+        handles.append(world.isend(large, peer, LARGE_TAG))
+        handles.append(world.isend("small message for %d" % peer, peer, SMALL_TAG))
+
+    world.waitall(handles)
+else:
+    large = world.recv(0, LARGE_TAG)
+    small = world.recv(0, SMALL_TAG)
+
+    assert small == "small message for %d" % rank
+    assert large.shape == (ELEMENTS,)
+    assert (large == numpy.arange(ELEMENTS, dtype=numpy.float64) + rank).all()
+
+# Close the sockets down nicely
+mpi.finalize()
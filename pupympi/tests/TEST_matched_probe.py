@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# meta-description: Matched probes take the message out of the matching so only mrecv gets it
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+from mpi import constants
+from mpi.exceptions import MPIException
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+if rank == 0:
+    world.send(numpy.arange(12.0).reshape(3,4), 1, 1)
+    world.send("first", 1, 2)
+    world.send("second", 1, 2)
+    # Only completes when the receiver has received it
+    world.ssend(bytearray("synchronized"), 1, 3)
+    world.barrier()
+
+elif rank == 1:
+    assert world.improbe(0, 4) is None
+
+    message = world.mprobe(0, 1)
+    assert (message.source, message.tag) == (0, 1)
+    assert message.dtype == numpy.float64 and message.shape == (3,4)
+    buffer = numpy.empty(message.shape, message.dtype)
+    assert world.mrecv(message, out=buffer) is buffer
+    assert (buffer == numpy.arange(12.0).reshape(3,4)).all()
+
+    # Each message can only be received once
+    try:
+        world.mrecv(message)
+        assert False, "Receiving a message twice should fail"
+    except MPIException:
+        pass
+
+    # A wildcard receive posted after the probe can not steal the message
+    message = world.mprobe(constants.MPI_SOURCE_ANY, constants.MPI_TAG_ANY)
+    handle = world.irecv(constants.MPI_SOURCE_ANY, constants.MPI_TAG_ANY)
+    assert handle.wait() == "second"
+    assert message.dtype is None
+    assert world.mrecv(message) == "first"
+
+    while True:
+        message = world.improbe(0, 3)
+        if message:
+            break
+    assert message.size == len("synchronized")
+    assert world.imrecv(message).wait() == bytearray("synchronized")
+    world.barrier()
+
+else:
+    world.barrier()
+
+mpi.finalize()
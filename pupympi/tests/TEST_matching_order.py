@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# meta-description: Many outstanding receives and unexpected messages are matched in MPI order, also with wildcards
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+from mpi import MPI
+from mpi import constants
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+COUNT = 500
+TAG_A = 5
+TAG_B = 6
+
+if rank == 0:
+    # Matched against receives posted up front
+    for i in range(COUNT):
+        world.send(i, 1, TAG_A)
+
+    # These arrive before any receive is posted
+    for i in range(COUNT):
+        world.send(("a", i), 1, TAG_A)
+        world.send(("b", i), 1, TAG_B)
+
+    world.barrier()
+
+elif rank == 1:
+    handles = [ world.irecv(0, TAG_A) for i in range(COUNT) ]
+    assert world.waitall(handles) == range(COUNT)
+
+    world.barrier()
+
+    # Exact receives only see their own tag, in order
+    for i in range(COUNT/2):
+        assert world.recv(0, TAG_B) == ("b", i)
+
+    # The any tag wildcard takes the oldest message whatever the tag
+    for i in range(COUNT/2):
+        assert world.recv(0, constants.MPI_TAG_ANY) == ("a", i)
+
+    remaining = [ world.recv(constants.MPI_SOURCE_ANY, constants.MPI_TAG_ANY) for i in range(COUNT) ]
+    assert remaining[0] == ("a", COUNT/2)
+    assert [ m for m in remaining if m[0] == "a" ] == [ ("a", i) for i in range(COUNT/2, COUNT) ]
+    assert [ m for m in remaining if m[0] == "b" ] == [ ("b", i) for i in range(COUNT/2, COUNT) ]
+
+    assert not world.iprobe()
+
+else:
+    world.barrier()
+
+mpi.finalize()
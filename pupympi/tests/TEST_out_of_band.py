@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# meta-description: Containers holding numpy arrays are sent with the arrays out of band and come back equal, writable and without copies
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+from mpi import constants
+from mpi.network import utils
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+def make(n):
+    return {
+        "u": numpy.arange(1000*n, dtype=numpy.float64).reshape(100, 10*n),
+        "v": numpy.arange(3000, dtype=numpy.int32)[::3], # Not contiguous
+        "small": numpy.arange(4, dtype=numpy.int16), # Pickled as usual
+        "nested": [numpy.ones(500, dtype=numpy.complex128), (n, "text")],
+        "step": n,
+    }
+
+def check(received, n):
+    expected = make(n)
+    assert sorted(received) == sorted(expected)
+    assert received["step"] == n
+    assert received["nested"][1] == (n, "text")
+    for (got, want) in ((received["u"], expected["u"]), (received["v"], expected["v"]), (received["small"], expected["small"]), (received["nested"][0], expected["nested"][0])):
+        assert got.dtype == want.dtype and got.shape == want.shape
+        assert (got == want).all()
+
+    # The large arrays live in the received buffer and can be written to
+    assert not received["u"].flags.owndata
+    assert received["u"].flags.aligned and received["u"].flags.writeable
+    received["u"][0, 0] = -1
+
+# Only containers with large arrays use the out of band layout
+(_, cmd, _) = utils.serialize_message(make(1), constants.CMD_USER, out_of_band=True)
+assert cmd == constants.CMD_OUT_OF_BAND
+(_, cmd, _) = utils.serialize_message({"small": numpy.arange(4)}, constants.CMD_USER, out_of_band=True)
+assert cmd == constants.CMD_USER
+(_, cmd, _) = utils.serialize_message(make(1), constants.CMD_USER)
+assert cmd == constants.CMD_USER
+
+# Serialized and restored without the network
+(segments, cmd, _) = utils.serialize_message(make(2), constants.CMD_USER, out_of_band=True)
+check(utils.deserialize_message(segments, cmd), 2)
+
+# Sizes below and above the rendezvous threshold, in order
+sizes = [1, 2, 40, 3]
+if rank == 0:
+    world.waitall([ world.isend(make(n), 1, 1) for n in sizes ])
+    world.send(make(5), 1, 2)
+    world.send(make(6), 0, 3)
+    check(world.recv(0, 3), 6)
+
+    # Compressed as well
+    world.set_compression("zlib", min_size=1024)
+    world.send(make(7), 1, 4)
+    world.set_compression(None)
+elif rank == 1:
+    for n in sizes:
+        check(world.recv(0, 1), n)
+    check(world.recv(0, 2), 5)
+    check(world.recv(0, 4), 7)
+
+mpi.finalize()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# meta-description: Persistent sends and receives started many times deliver the current contents of their buffers
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+from mpi.exceptions import MPIException
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+ROUNDS = 50
+
+right = (rank + 1) % size
+left = (rank - 1) % size
+
+row = numpy.zeros(10)
+matrix = numpy.zeros((3,4), dtype=numpy.int32)
+raw = bytearray(4)
+state = {"round" : None}
+
+sends = [ world.send_init(row, right, 1), world.send_init(matrix, right, 2), world.send_init(raw, right, 3), world.send_init(state, right, 4) ]
+
+received_row = numpy.zeros(10)
+receives = [ world.recv_init(left, 1, out=received_row), world.recv_init(left, 2), world.recv_init(left, 3), world.recv_init(left, 4) ]
+
+# Nothing is started yet, so everything counts as completed
+assert world.testall(sends + receives)
+
+for i in range(ROUNDS):
+    row[:] = i + rank
+    matrix[:] = i * rank
+    raw[:] = bytearray("%4d" % i)
+    state["round"] = i
+
+    world.startall(receives)
+    world.startall(sends)
+
+    world.waitall(sends)
+    (r, m, b, s) = world.waitall(receives)
+
+    assert r is received_row
+    assert (r == i + left).all()
+    assert m.shape == (3,4) and (m == i * left).all()
+    assert b == bytearray("%4d" % i)
+    assert s == {"round" : i}
+
+# Large persistent sends go through the rendezvous protocol each start
+large = numpy.zeros(mpi.settings.RENDEZVOUS_THRESHOLD / 8 + 1000)
+received_large = numpy.zeros(large.shape)
+large_send = world.send_init(large, right, 7)
+large_receive = world.recv_init(left, 7, out=received_large)
+for i in range(5):
+    large[:] = i + rank
+    large_receive.start()
+    large_send.start()
+    large_send.wait()
+    assert large_receive.wait() is received_large
+    assert (received_large == i + left).all()
+
+# The receive is started late, so the message waits as an announcement
+large[:] = -rank
+large_send.start()
+world.barrier()
+large_receive.start()
+assert (large_receive.wait() == -left).all()
+large_send.wait()
+
+# Nothing is ever sent with this tag, so the receive stays active
+never = world.recv_init(left, 6)
+never.start()
+try:
+    never.start()
+    assert False, "Starting an active request should fail"
+except MPIException:
+    pass
+never.cancel()
+assert never.test_cancelled()
+
+# Persistent sends to self
+to_self = world.send_init(row, rank, 5)
+from_self = world.recv_init(rank, 5)
+for i in range(ROUNDS):
+    row[:] = i
+    from_self.start()
+    to_self.start()
+    to_self.wait()
+    assert (from_self.wait() == i).all()
+
+mpi.finalize()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# meta-description: Connections prewarmed for a topology and opened all at once for the full network are pooled on both sides
+# meta-expectedresult: 0
+# meta-minprocesses: 6
+
+from mpi import MPI
+from mpi.network import mesh_peers
+from mpi.topology.cartesian import Cartesian
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+pool = mpi.network.socket_pool
+
+# Every pair of processes is connected once in the full network
+for n in range(1, 10):
+    pairs = [ tuple(sorted((r, peer))) for r in range(n) for peer in mesh_peers(r, n) ]
+    assert sorted(pairs) == sorted(set(pairs))
+    assert len(pairs) == n*(n-1)/2
+
+# A periodic 3x2 grid. The neighbours are the other two in our row and
+# the one above or below us.
+grid = Cartesian(world, [3, 2], [True, True])
+neighbours = grid.neighbours()
+assert len(neighbours) == 3
+(x, y) = grid.coords(rank)
+assert sorted(neighbours) == sorted([grid.rank([(x+1) % 3, y]), grid.rank([(x-1) % 3, y]), grid.rank([x, 1-y])])
+
+# Nothing has been sent yet, so every connection comes from prewarming.
+# Whoever prewarms a pair first opens the connection.
+connected = grid.prewarm()
+assert set(connected) <= set(neighbours)
+
+def exchange():
+    # Messages follow the greeting on the same connection, so once one has
+    # arrived from a neighbour its connection is pooled here as well
+    for neighbour in neighbours:
+        world.send(rank, neighbour)
+    for neighbour in neighbours:
+        assert world.recv(neighbour) == neighbour
+
+exchange()
+assert grid.prewarm() == []
+for neighbour in neighbours:
+    assert pool.has_socket(neighbour)
+for other in range(size):
+    if other != rank and other not in neighbours:
+        assert not pool.has_socket(other)
+
+# Nobody connects to the rest before everybody has checked the above. A
+# round of exchanges can only be finished once the neighbours have started
+# it, so the grid is synchronised after as many rounds as it is wide.
+for _ in range(size):
+    exchange()
+
+# Open the rest of the network
+mpi.network.start_full_network()
+for other in range(size):
+    if other != rank:
+        assert pool.has_socket(other)
+
+metrics = mpi.get_metrics()
+for phase in ("bootstrap", "connect", "handshake", "prewarm"):
+    assert metrics["startup_%s_time" % phase] > 0
+
+# Talk to everybody without making new connections
+sockets = len(pool.sockets)
+for other in range(size):
+    if other != rank:
+        world.send(rank, other)
+for other in range(size):
+    if other != rank:
+        assert world.recv(other) == other
+assert len(pool.sockets) == sockets
+
+mpi.finalize()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# meta-description: Receiving into preallocated numpy arrays and bytearrays fills and returns the given buffer
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+from mpi.exceptions import MPIException
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+ROWS = 10
+
+if rank == 0:
+    for i in range(ROWS):
+        world.send(numpy.arange(100, dtype=numpy.float64) + i, 1)
+
+    world.send(numpy.arange(12, dtype=numpy.int32).reshape(3,4), 1)
+    world.send(bytearray("raw bytes"), 1)
+    world.send(numpy.zeros(5, dtype=numpy.float32), 1)
+
+    # Received into a row of the sending rank's own matrix
+    world.sendrecv(numpy.ones(8), 0, out=numpy.zeros((2,8))[1])
+
+elif rank == 1:
+    row = numpy.zeros(100, dtype=numpy.float64)
+    for i in range(ROWS):
+        received = world.recv(0, out=row)
+        assert received is row
+        assert (row == numpy.arange(100, dtype=numpy.float64) + i).all()
+
+    matrix = numpy.zeros((3,4), dtype=numpy.int32)
+    handle = world.irecv(0, out=matrix)
+    assert handle.wait() is matrix
+    assert (matrix == numpy.arange(12).reshape(3,4)).all()
+
+    buffer = bytearray(9)
+    assert world.recv(0, out=buffer) is buffer
+    assert buffer == bytearray("raw bytes")
+
+    # A mismatching dtype is an error
+    try:
+        world.recv(0, out=numpy.zeros(5, dtype=numpy.float64))
+        assert False, "Receiving a float32 array into a float64 buffer should fail"
+    except MPIException:
+        pass
+
+# Only real buffers are accepted
+try:
+    world.irecv(0, out=[0, 0, 0])
+    assert False, "Receiving into a list should fail"
+except MPIException:
+    pass
+
+mpi.finalize()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# meta-description: Large messages are only transferred once matched, keep MPI ordering and can be received in place
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+SMALL = 50
+large = numpy.arange(500000, dtype=numpy.float64)
+matrix = numpy.arange(300000, dtype=numpy.int32).reshape(600, 500)
+text = "pickled " * 100000
+
+assert len(large.data) >= mpi.settings.RENDEZVOUS_THRESHOLD
+
+if rank == 0:
+    handles = [world.isend(large, 1, 1)]
+    handles += [world.isend(i, 1, 2) for i in range(SMALL)]
+    handles.append(world.isend(matrix, 1, 1))
+    handles.append(world.isend(text, 1, 1))
+    world.waitall(handles)
+
+    world.ssend(large, 1, 3)
+
+elif rank == 1:
+    # The small messages are not held up by the large ones before them
+    assert [world.recv(0, 2) for i in range(SMALL)] == range(SMALL)
+
+    # Only the announcement is here, it is probed like any other message
+    message = world.mprobe(0, 1)
+    assert message.dtype == numpy.float64 and message.shape == large.shape
+    assert message.size == len(large.data)
+
+    out = numpy.zeros(large.shape, dtype=numpy.float64)
+    assert world.mrecv(message, out=out) is out
+    assert (out == large).all()
+
+    assert (world.recv(0, 1) == matrix).all()
+    assert world.recv(0, 1) == text
+
+    handle = world.irecv(0, 3, out=out)
+    assert handle.wait() is out
+    assert (out == large).all()
+
+# Both sides sending large messages before receiving
+peer = (rank + 1) % 2
+if rank < 2:
+    handle = world.isend(large + rank, peer)
+    assert (world.recv(peer) == large + peer).all()
+    handle.wait()
+
+mpi.finalize()
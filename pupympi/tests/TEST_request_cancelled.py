@@ -11,6 +11,9 @@ world = mpi.MPI_COMM_WORLD
 TAG = 1
 
 if world.rank() == 1:
+    # Only send once the receive on the other end is cancelled
+    world.recv(0, TAG+3)
+
     req1 = world.isend( "My message 1", 0, TAG)
 
     assert not req1.test_cancelled()
@@ -27,4 +30,34 @@ else:
     
     assert req1.test_cancelled()
 
-mpi.finalize()
\ No newline at end of file
+    if world.rank() == 0:
+        world.send("Go", 1, TAG+3)
+
+# Cancelled receives are taken out of matching right away so they do not
+# pile up, and the next receive gets the message
+if world.rank() == 0:
+    for i in range(100):
+        world.irecv(1, TAG+1).cancel()
+    assert not mpi.message_matcher.posted
+
+    world.send("Go", 1, TAG+2)
+    assert world.recv(1, TAG+1) == "After the cancels"
+elif world.rank() == 1:
+    world.recv(0, TAG+2)
+    world.send("After the cancels", 0, TAG+1)
+
+# A receive that is already matched can not be cancelled, the message is
+# not lost
+if world.rank() == 0:
+    req2 = world.irecv(1, TAG+4)
+    world.send("Go", 1, TAG+5)
+    while not req2.test():
+        pass
+    req2.cancel()
+    assert not req2.test_cancelled()
+    assert req2.wait() == "Matched"
+elif world.rank() == 1:
+    world.recv(0, TAG+5)
+    world.send("Matched", 0, TAG+4)
+
+mpi.finalize()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# meta-description: Bursts of tiny isends mixed with larger messages to one peer arrive complete and in order
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+BURST = 2000
+TAG_SMALL = 3
+TAG_LARGE = 4
+
+def large(i):
+    return numpy.arange(20000, dtype=numpy.int32) + i
+
+if rank == 0:
+    handles = []
+    for i in range(BURST):
+        handles.append(world.isend(i, 1, TAG_SMALL))
+        if i % 250 == 0:
+            handles.append(world.isend(large(i), 1, TAG_LARGE))
+            handles.append(world.isend(bytearray("%d" % i), 1, TAG_SMALL))
+    world.waitall(handles)
+
+elif rank == 1:
+    for i in range(BURST):
+        assert world.recv(0, TAG_SMALL) == i
+        if i % 250 == 0:
+            assert world.recv(0, TAG_SMALL) == bytearray("%d" % i)
+
+    for i in range(0, BURST, 250):
+        assert (world.recv(0, TAG_LARGE) == large(i)).all()
+
+mpi.finalize()
@@ -68,6 +68,14 @@ while rRequests or sRequests:
 f.write("Rank %d: requests finished\n" % (rank))
 f.flush()
 
+# Everybody is done with the traffic above before the pool is looked at. A
+# last message around the ring leaves at least that connection in the pool,
+# as no rank makes more than two new connections from here on.
+mpi.MPI_COMM_WORLD.barrier()
+sRequest = mpi.MPI_COMM_WORLD.isend(content, (rank+1) % size, DUMMY_TAG)
+assert mpi.MPI_COMM_WORLD.recv((rank-1) % size, DUMMY_TAG) == "Message from rank %d" % ((rank-1) % size)
+sRequest.wait()
+
 
 
 # This test only makes sense for a dynamic socket pool
@@ -79,15 +87,17 @@ else:
     f.write("\t %s \n" % mpi.network.socket_pool.sockets)
     f.flush()
     pool_size = len(mpi.network.socket_pool.sockets)
-    # There should only be 5 connections as specified in meta-socket-pool-size (or 4???)
-    if pool_size != 5:
-        f.write("whoops pool size was not 5 but %i pool:\n" % (pool_size,mpi.network.socket_pool.metainfo) )
+    # There should be at most 5 connections as specified in meta-socket-pool-size.
+    # Connections are closed on both sides when either side evicts them, so
+    # there may be fewer, but not none after all this talking.
+    if not 0 < pool_size <= 5:
+        f.write("whoops pool size was not between 1 and 5 but %i pool: %s\n" % (pool_size,mpi.network.socket_pool.metainfo) )
         f.flush()
     else:
         f.write("Done for rank %d\n" % rank)
         f.flush()
     
-    assert pool_size == 5
+    assert 0 < pool_size <= 5
 
 f.close()
 
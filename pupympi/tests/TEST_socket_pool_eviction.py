@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# meta-description: Connections evicted from a small socket pool are closed for real and messages keep their order across reconnects
+# meta-expectedresult: 0
+# meta-minprocesses: 6
+# meta-socket-pool-size: 2
+
+from mpi import MPI
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+ROUNDS = 5
+MESSAGES = 4
+DUMMY_TAG = 1
+
+pool = mpi.network.socket_pool
+
+# Every rank talks to everybody else, round after round, with a few
+# non-blocking messages at a time. The pool can not hold all connections
+# so they are evicted and made again all along.
+for r in range(ROUNDS):
+    requests = []
+    for other in range(size):
+        if other != rank:
+            for i in range(MESSAGES):
+                requests.append(world.isend((rank, r, i), other, DUMMY_TAG))
+
+    for other in range(size):
+        if other != rank:
+            for i in range(MESSAGES):
+                assert world.recv(other, DUMMY_TAG) == (other, r, i)
+
+    world.waitall(requests)
+
+    if not pool.readonly:
+        assert len(pool.sockets) <= pool.max_size
+
+world.barrier()
+
+if not pool.readonly:
+    # Evicted connections were closed with the handshake
+    closed = world.allreduce(mpi.get_metrics()["connections_closed"], sum)
+    assert closed > 0
+
+mpi.finalize()
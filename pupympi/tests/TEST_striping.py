@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# meta-description: Large payloads split over several connections arrive whole, in order and in place
+# meta-expectedresult: 0
+# meta-minprocesses: 2
+
+import numpy
+from mpi import MPI
+
+mpi = MPI()
+
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+
+mpi.settings.STRIPE_CONNECTIONS = 4
+mpi.settings.STRIPE_THRESHOLD = 512*1024
+
+large = numpy.arange(300001, dtype=numpy.float64)
+matrix = numpy.arange(400000, dtype=numpy.int32).reshape(800, 500)
+text = "striped " * 200000
+raw = bytearray("b" * 1000000)
+below = numpy.arange(40000, dtype=numpy.float64) # Over the rendezvous threshold only
+
+if rank == 0:
+    handles = [world.isend(large, 1, 1), world.isend(below, 1, 1), world.isend(matrix, 1, 1)]
+    handles.append(world.isend(text, 1, 1))
+    world.waitall(handles)
+
+    world.ssend(raw, 1, 2)
+
+    # The stripes beyond the first got connections of their own
+    peer = world.group().members[1]['global_rank']
+    assert len(mpi.network.socket_pool.stripes[peer]) == 3
+
+    # Small stripes are not read in place but copied to where they belong
+    mpi.settings.STRIPE_CONNECTIONS = 32
+    mpi.settings.STRIPE_THRESHOLD = len(below.data)
+    world.send(below, 1, 3)
+
+elif rank == 1:
+    assert (world.recv(0, 1) == large).all()
+    assert (world.recv(0, 1) == below).all()
+    assert (world.recv(0, 1) == matrix).all()
+    assert world.recv(0, 1) == text
+
+    out = bytearray(len(raw))
+    assert world.recv(0, 2, out=out) is out
+    assert out == raw
+
+    out = numpy.zeros(below.shape, dtype=numpy.float64)
+    assert world.recv(0, 3, out=out) is out
+    assert (out == below).all()
+
+mpi.finalize()
@@ -3,6 +3,8 @@
 # meta-expectedresult: 0
 # meta-minprocesses: 2
 
+import time
+
 from mpi import MPI
 
 mpi = MPI()
@@ -23,4 +25,29 @@ else:
     for i in range(10):
         world.send( "Message", 0)
 
+# Point to point, persistent and collective requests in the same list that
+# complete while waitany is already waiting
+if world.rank() == 0:
+    persistent = world.recv_init(1, 5)
+    persistent.start()
+    plain = world.irecv(1, 6)
+    request_list = [plain, persistent, world.ibarrier()]
+    world.send("go", 1, 4)
+
+    received = {}
+    while request_list:
+        (request, data) = world.waitany(request_list)
+        request_list.remove(request)
+        received[request] = data
+    assert received[plain] == "plain"
+    assert received[persistent] == "persistent"
+else:
+    if world.rank() == 1:
+        world.recv(0, 4)
+        time.sleep(0.2)
+        world.send("plain", 0, 6)
+        time.sleep(0.2)
+        world.send("persistent", 0, 5)
+    world.ibarrier().wait()
+
 mpi.finalize()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# meta-description: A master hands out many small tasks with waitany and waitsome, which must wake up as soon as a worker answers
+# meta-expectedresult: 0
+# meta-minprocesses: 3
+# meta-max_runtime: 10
+
+from mpi import MPI
+
+mpi = MPI()
+world = mpi.MPI_COMM_WORLD
+rank = world.rank()
+size = world.size()
+
+TASKS = 300
+TASK_TAG = 1
+RESULT_TAG = 2
+
+if rank == 0:
+    workers = range(1, size)
+    results = []
+    next_task = 0
+
+    # Each task is a round trip, so any delay in noticing an answer adds up
+    pending = {}
+    for worker in workers:
+        world.send(next_task, worker, TASK_TAG)
+        pending[world.irecv(worker, RESULT_TAG)] = worker
+        next_task += 1
+
+    while pending:
+        if next_task % 2:
+            completed = [ world.waitany(pending.keys()) ]
+        else:
+            completed = world.waitsome(pending.keys())
+
+        for (request, result) in completed:
+            results.append(result)
+            worker = pending.pop(request)
+            if next_task < TASKS:
+                world.send(next_task, worker, TASK_TAG)
+                pending[world.irecv(worker, RESULT_TAG)] = worker
+                next_task += 1
+
+    for worker in workers:
+        world.send(None, worker, TASK_TAG)
+
+    assert sorted(results) == [ task*task for task in range(TASKS) ]
+else:
+    while True:
+        task = world.recv(0, TASK_TAG)
+        if task is None:
+            break
+        world.send(task*task, 0, RESULT_TAG)
+
+mpi.finalize()